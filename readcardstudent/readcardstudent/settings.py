@@ -75,12 +75,38 @@ WSGI_APPLICATION = 'readcardstudent.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. Connections use WAL and a busy timeout (students/db.py), and
+# transactions take the write lock when they start, so concurrent writers queue
+# instead of failing with "database is locked" halfway through.
+# For several worker processes, set DB_ENGINE=postgresql and DB_NAME, DB_USER,
+# DB_PASSWORD, DB_HOST, DB_PORT in the environment to use a server database.
+if os.environ.get('DB_ENGINE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'readcardstudent'),
+            'USER': os.environ.get('DB_USER', ''),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', ''),
+            'PORT': os.environ.get('DB_PORT', ''),
+            # Keep connections open across requests and jobs
+            'CONN_MAX_AGE': 60,
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+
+STUDENT_CARD_SQLITE_WAL = True
+STUDENT_CARD_SQLITE_BUSY_TIMEOUT = 20  # Seconds a writer waits for the lock
 
 
 # Password validation
@@ -128,3 +154,173 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Student card OCR settings
+# 'tesserocr' keeps the Tesseract language model loaded in-process between calls,
+# 'pytesseract' runs the tesseract binary for every call (used as a fallback
+# when tesserocr is not installed)
+STUDENT_CARD_OCR_ENGINE = 'tesserocr'
+
+# Path to the tesseract binary for the pytesseract engine (needed on Windows),
+# e.g. r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+STUDENT_CARD_TESSERACT_CMD = None
+
+# Directory containing the traineddata files, None uses tesseract's default
+STUDENT_CARD_TESSDATA_PATH = None
+
+# Adaptive OCR cascade: passes are ranked by fields found per second once they
+# have STUDENT_CARD_CASCADE_MIN_SAMPLES attempts recorded, and extraction stops
+# when every field has a value whose combined OCR confidence across passes
+# reaches STUDENT_CARD_MIN_FIELD_CONFIDENCE (0-1)
+STUDENT_CARD_CASCADE_LEARNING = True
+STUDENT_CARD_CASCADE_MIN_SAMPLES = 20
+# Every this many cards the least sampled pass runs first, so passes ranked low
+# early on keep getting samples and the ranking can change (0 disables it)
+STUDENT_CARD_CASCADE_EXPLORE_EVERY = 20
+STUDENT_CARD_MIN_FIELD_CONFIDENCE = 0.85
+STUDENT_CARD_CASCADE_REFRESH_INTERVAL = 60  # Seconds between reloads of the pass statistics
+STUDENT_CARD_CASCADE_FLUSH_INTERVAL = 30  # Seconds pass outcomes are summed in memory before one write
+
+# Upload processing: 'sync' runs OCR inside the request, 'async' saves the card
+# as pending and lets the database backed worker pool process it
+STUDENT_CARD_PROCESSING_MODE = 'sync'
+STUDENT_CARD_JOB_WORKERS = 2  # Maximum number of cards processed concurrently per process
+STUDENT_CARD_JOB_TIMEOUT = 120  # Seconds a job may run before it stops with the fields read so far
+STUDENT_CARD_JOB_MAX_RETRIES = 2
+STUDENT_CARD_JOB_POLL_INTERVAL = 2  # Seconds between queue polls and status page refreshes
+# Start workers inside the web process on first upload; disable when running
+# `manage.py run_card_workers` separately
+STUDENT_CARD_JOB_START_IN_PROCESS = True
+
+# Parallel OCR passes within one card: 'serial', 'thread' or 'process'.
+# STUDENT_CARD_OCR_WORKERS = None sizes the pool to the number of cores.
+# Tesseract's own OpenMP threads are capped to STUDENT_CARD_TESSERACT_THREADS
+# so the two kinds of parallelism don't oversubscribe the CPU.
+STUDENT_CARD_OCR_EXECUTOR = 'thread'
+STUDENT_CARD_OCR_WORKERS = None
+STUDENT_CARD_TESSERACT_THREADS = 1
+# Full-card passes run at the same time; once every field is settled the
+# remaining passes are skipped, which a wave as large as the pool never allows
+STUDENT_CARD_OCR_WAVE_SIZE = 2
+
+# Bulk ingestion (manage.py ingest_cards and the multi-file upload page)
+STUDENT_CARD_INGEST_BATCH_SIZE = 100  # Rows written per bulk_create
+STUDENT_CARD_INGEST_WORKERS = 4  # Images processed in parallel
+DATA_UPLOAD_MAX_NUMBER_FILES = 1000  # Files accepted in one bulk upload request
+# Uploaded images (or archive members) over this size and archives holding
+# more images than this are rejected as failed cards without being extracted
+STUDENT_CARD_INGEST_MAX_IMAGE_BYTES = 20 * 1024 * 1024
+STUDENT_CARD_INGEST_MAX_ARCHIVE_IMAGES = 1000
+
+# Reuse OCR results of cards processed from the same image (same SHA-256).
+# With STUDENT_CARD_PHASH_DEDUP, near-duplicates with the same perceptual hash
+# (re-encoded or resized copies) are reused too, once the student ID read from
+# the card's ID zone confirms them (cards without a known layout never are).
+STUDENT_CARD_RESULT_CACHE = True
+STUDENT_CARD_PHASH_DEDUP = False
+
+# Card localization: find the card in the photo, perspective-warp and deskew
+# it to a fixed size (width, height) before preprocessing and OCR.
+# The default is an ID-1 card at 300 DPI.
+STUDENT_CARD_NORMALIZE = True
+STUDENT_CARD_CANONICAL_SIZE = (1012, 638)
+
+# Card layouts: JSON files with field zones, character whitelists and PSM per
+# field. The layout is picked by matching header keywords, and each field is
+# read with one targeted OCR call. Layouts in students/card_layouts are always
+# loaded, add directories here for other institutions.
+STUDENT_CARD_USE_LAYOUTS = True
+STUDENT_CARD_LAYOUT_DIRS = []
+
+# Region detection: characters are merged into text lines, boxes overlapping a
+# larger box by more than STUDENT_CARD_REGION_OVERLAP are dropped and at most
+# STUDENT_CARD_MAX_REGIONS lines are kept and OCR'd in one stitched call
+STUDENT_CARD_MAX_REGIONS = 40
+STUDENT_CARD_REGION_OVERLAP = 0.5
+
+# Visualizations are rendered with OpenCV when a page first requests them and
+# cached under MEDIA_ROOT/visualizations, evicting least recently used files
+STUDENT_CARD_VISUALIZATION_CACHE_MAX_BYTES = 500 * 1024 * 1024
+STUDENT_CARD_VISUALIZATION_CACHE_MAX_AGE = 30 * 24 * 3600  # Seconds since last request
+
+# Card list page size and the thumbnails generated at upload for it
+STUDENT_CARD_LIST_PAGE_SIZE = 50
+STUDENT_CARD_THUMBNAIL_SIZE = 120  # Longer side in pixels
+STUDENT_CARD_THUMBNAIL_QUALITY = 80
+
+# TrueType font used to render synthetic cards for `manage.py benchmark_cards`,
+# None tries common fonts with Vietnamese glyphs
+STUDENT_CARD_BENCHMARK_FONT = None
+
+# Per-stage timers and counters, exported at /metrics/ in the Prometheus text
+# format and stored per card in StudentCard.timings. Metrics are kept per process.
+STUDENT_CARD_METRICS = True
+
+# Storage for original card images, an alias of STORAGES. Uploads up to
+# FILE_UPLOAD_MAX_MEMORY_SIZE stay in memory and are decoded from there;
+# with STUDENT_CARD_ASYNC_IMAGE_SAVE the original is written in the background
+# while OCR runs, and the card is saved once the write is done.
+STUDENT_CARD_IMAGE_STORAGE = 'default'
+STUDENT_CARD_ASYNC_IMAGE_SAVE = True
+FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
+
+# Build the shared StudentCardProcessor and load the OCR language data in every
+# OCR thread (or OCR worker process) when a server or worker process starts:
+# runserver, run_card_workers, ingest_cards, gunicorn, uvicorn, daphne,
+# hypercorn and uwsgi, or any process started with
+# STUDENT_CARD_PRELOAD_PROCESS=1 in its environment. The warm-up also runs every
+# stage once on a synthetic card so the first upload isn't slower than the rest.
+STUDENT_CARD_PRELOAD = True
+STUDENT_CARD_WARMUP = False
+
+# JSON API under /api/. When tokens are set, clients must send
+# "Authorization: Token <token>".
+STUDENT_CARD_API_TOKENS = []
+STUDENT_CARD_API_MAX_BATCH = 50  # Images per batch request
+
+# Synchronous processing of uploads and API requests, served best by an ASGI
+# server (e.g. `uvicorn readcardstudent.asgi:application`). At most
+# STUDENT_CARD_MAX_CONCURRENT cards (None: one per CPU) are processed at once and
+# STUDENT_CARD_MAX_QUEUED more may wait, further requests get a 429 with Retry-After.
+STUDENT_CARD_MAX_CONCURRENT = None
+STUDENT_CARD_MAX_QUEUED = 16
+STUDENT_CARD_RETRY_AFTER = 2  # Seconds
+
+# Verification against the roster of EnrolledStudent (POST /api/cards/verify/):
+# minimum name similarity (0-1) to confirm a student, and how often in seconds
+# each process reloads the roster to see changes made elsewhere
+STUDENT_CARD_ROSTER_NAME_THRESHOLD = 0.8
+STUDENT_CARD_ROSTER_REFRESH = 300
+
+# Live capture (`manage.py read_card_stream`): frames are scored on a copy of
+# STUDENT_CARD_STREAM_SCORE_SIZE pixels and only the sharpest frame with a card
+# in each window of STUDENT_CARD_STREAM_WINDOW frames is OCR'd. Read fields are
+# kept until no card is seen for STUDENT_CARD_STREAM_RESET_AFTER windows.
+STUDENT_CARD_STREAM_WINDOW = 15
+STUDENT_CARD_STREAM_MIN_SHARPNESS = 50.0  # Variance of the Laplacian
+STUDENT_CARD_STREAM_SCORE_SIZE = 320
+STUDENT_CARD_STREAM_RESET_AFTER = 2
+
+# Storage lifecycle, see `manage.py card_storage`. With STUDENT_CARD_ORIGINAL_FORMAT
+# ('jpeg' or 'webp') new originals are downscaled to STUDENT_CARD_ORIGINAL_MAX_SIDE
+# and re-encoded when that makes them smaller, None stores uploads as they are.
+# Thumbnails and visualizations are written in STUDENT_CARD_DERIVATIVE_FORMAT.
+# Files no card refers to are deleted once they are STUDENT_CARD_ORPHAN_GRACE seconds old.
+STUDENT_CARD_ORIGINAL_FORMAT = None
+STUDENT_CARD_ORIGINAL_QUALITY = 90
+STUDENT_CARD_ORIGINAL_MAX_SIDE = 2000
+STUDENT_CARD_DERIVATIVE_FORMAT = 'webp'
+STUDENT_CARD_VISUALIZATION_QUALITY = 80
+STUDENT_CARD_ORPHAN_GRACE = 3600
+
+# Per-card budgets. Larger images are decoded at reduced scale and downscaled
+# to STUDENT_CARD_MAX_PIXELS, region detection looks at no more than
+# STUDENT_CARD_MAX_CONTOURS contours, and OCR stops with the fields read so far
+# after STUDENT_CARD_DEADLINE seconds. Exceeded budgets are stored in
+# StudentCard.budget_violations. While the process uses more than
+# STUDENT_CARD_MAX_MEMORY bytes (None: no limit) new requests are refused with a 429.
+STUDENT_CARD_MAX_PIXELS = 24_000_000
+STUDENT_CARD_MAX_CONTOURS = 2000
+STUDENT_CARD_DEADLINE = 20
+STUDENT_CARD_MAX_MEMORY = 2 * 1024 * 1024 * 1024
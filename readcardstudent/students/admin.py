@@ -1,9 +1,27 @@
 from django.contrib import admin
-from .models import StudentCard
+from .models import EnrolledStudent, StudentCard, OCRPassStat
 
 @admin.register(StudentCard)
 class StudentCardAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'student_id', 'university', 'uploaded_at')
-    search_fields = ('name', 'student_id')
-    list_filter = ('university', 'uploaded_at')
-    readonly_fields = ('uploaded_at',)
+    list_display = ('id', 'name', 'student_id', 'university', 'status', 'uploaded_at')
+    search_fields = ('name', 'student_id', 'job_id')
+    list_filter = ('status', 'university', 'uploaded_at')
+    readonly_fields = (
+        'uploaded_at', 'job_id', 'attempts', 'started_at', 'finished_at', 'field_confidence', 'timings', 'budget_violations',
+    )
+    date_hierarchy = 'uploaded_at'
+    # Counting every row for the "x of y" line is slow on large tables
+    show_full_result_count = False
+
+
+@admin.register(OCRPassStat)
+class OCRPassStatAdmin(admin.ModelAdmin):
+    list_display = ('variant', 'config', 'attempts', 'fields_found', 'total_time')
+    list_filter = ('variant', 'config')
+
+
+@admin.register(EnrolledStudent)
+class EnrolledStudentAdmin(admin.ModelAdmin):
+    list_display = ('student_id', 'name', 'dob', 'class_name', 'cohort', 'updated_at')
+    search_fields = ('student_id', 'name')
+    list_filter = ('cohort', 'university')
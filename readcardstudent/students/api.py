@@ -0,0 +1,216 @@
+import functools
+import itertools
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import metrics
+from .ingest import READ_ERRORS, iter_upload_sources
+from .jobs import enqueue_card
+from .limits import CapacityExceeded, get_limiter
+from .models import StudentCard
+from .result_cache import get_result_cache
+from .services import (
+    CardProcessingError, card_to_dict, create_card_from_upload, process_upload, recognize_upload, verify_upload,
+)
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def option(request, name, default):
+    """Boolean option from the query string or form data"""
+    value = request.GET.get(name, request.POST.get(name))
+    if value is None:
+        return default
+    return value.strip().lower() in TRUE_VALUES
+
+
+def error_response(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+def authorized(request):
+    """Check the API token when settings.STUDENT_CARD_API_TOKENS is set"""
+    tokens = getattr(settings, 'STUDENT_CARD_API_TOKENS', None)
+    if not tokens:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() in ('token', 'bearer') and token in tokens
+
+
+def api_view(view):
+    """Common handling of the async JSON API views: POST only, no CSRF, token check, 429 when busy"""
+    @functools.wraps(view)
+    @csrf_exempt
+    @require_POST
+    async def wrapper(request, *args, **kwargs):
+        if not authorized(request):
+            return error_response("Invalid or missing API token", 401)
+        try:
+            return await view(request, *args, **kwargs)
+        except CapacityExceeded as exc:
+            response = error_response(str(exc), 429)
+            response['Retry-After'] = str(exc.retry_after)
+            return response
+
+    return wrapper
+
+
+def uploaded_image(request):
+    """The posted image: the 'image' form file, or a raw image/* request body"""
+    if request.content_type and request.content_type.startswith('image/'):
+        extension = request.content_type.split('/', 1)[1].split(';')[0].strip()
+        return SimpleUploadedFile(f"upload.{extension}", request.body, request.content_type)
+    return request.FILES.get('image')
+
+
+def submit_job(image_file):
+    """Store an upload as a pending card and queue it"""
+    student_card = create_card_from_upload(image_file)
+    enqueue_card()
+    return {
+        'job_id': str(student_card.job_id),
+        'status': student_card.status,
+        'status_url': reverse('job_status_json', kwargs={'job_id': student_card.job_id}),
+    }
+
+
+def recognize(image_file, persist=True, visualize=True, fields_only=False):
+    """Process one upload for the API
+
+    fields_only skips the result cache, persistence, thumbnails and
+    visualizations and returns nothing but the fields. Without persist the
+    result cache is still used but nothing is written.
+
+    Returns:
+        JSON friendly result
+    """
+    start = time.perf_counter()
+    if fields_only or not persist:
+        info, cached = recognize_upload(image_file, result_cache=None if fields_only else get_result_cache())
+        confidence = info.pop('confidence', {})
+        violations = info.pop('budget_violations')
+        result = {'fields': info, 'confidence': confidence, 'budget_violations': violations}
+        if not fields_only:
+            result['cached'] = cached
+    else:
+        student_card = process_upload(image_file)
+        metrics.card_finished(StudentCard.STATUS_DONE)
+        result = card_to_dict(student_card)
+        if visualize:
+            result['visualizations'] = student_card.visualization_urls()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+@api_view
+async def api_recognize(request):
+    """Extract the fields of one card image
+
+    Options, as query or form parameters:
+        async: Queue the card and return its job for polling (202)
+        persist: Store the card and its image (default on)
+        visualize: Include visualization URLs of a stored card (default on)
+        fields_only: Return only the extracted fields, as fast as possible
+    """
+    image_file = uploaded_image(request)
+    if image_file is None:
+        return error_response("Post the card image as the 'image' file or as an image/* body", 400)
+
+    if option(request, 'async', False):
+        return JsonResponse(await sync_to_async(submit_job)(image_file), status=202)
+
+    try:
+        result = await get_limiter().run(
+            recognize,
+            image_file,
+            persist=option(request, 'persist', True),
+            visualize=option(request, 'visualize', True),
+            fields_only=option(request, 'fields_only', False),
+        )
+    except CardProcessingError as exc:
+        return error_response(str(exc), 422)
+    return JsonResponse(result)
+
+
+def verify(image_file):
+    """Verify one upload against the roster for the API"""
+    start = time.perf_counter()
+    result = verify_upload(image_file)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+@api_view
+async def api_verify(request):
+    """Identify the enrolled student a card image belongs to
+
+    Reads only the ID, name and date of birth of the card and matches them
+    against the roster, falling back to full extraction when that fails.
+    Nothing is stored.
+    """
+    image_file = uploaded_image(request)
+    if image_file is None:
+        return error_response("Post the card image as the 'image' file or as an image/* body", 400)
+
+    try:
+        result = await get_limiter().run(verify, image_file)
+    except CardProcessingError as exc:
+        return error_response(str(exc), 422)
+    return JsonResponse(result)
+
+
+def recognize_batch(images, run_async, options):
+    """Process (name, bytes or the error reading them) images in order, a failed image gets an error entry"""
+    results = []
+    for name, data in images:
+        if isinstance(data, Exception):
+            results.append({'name': name, 'error': f"Could not read image: {data}"})
+            continue
+        image_file = SimpleUploadedFile(name, data)
+        try:
+            result = submit_job(image_file) if run_async else recognize(image_file, **options)
+        except CardProcessingError as exc:
+            result = {'error': str(exc)}
+        results.append({'name': name, **result})
+    return results
+
+
+@api_view
+async def api_recognize_batch(request):
+    """Extract the fields of many card images (or ZIP archives of them) posted as 'images'
+
+    Takes the same options as api_recognize. The batch takes one slot of the
+    processing pool and its images are processed in order.
+    """
+    uploaded_files = request.FILES.getlist('images')
+    if not uploaded_files:
+        return error_response("Post the card images as 'images' files", 400)
+
+    # Read while iterating, images inside archives can't be read once the archive is closed
+    max_batch = getattr(settings, 'STUDENT_CARD_API_MAX_BATCH', 50)
+    images = []
+    for source in itertools.islice(iter_upload_sources(uploaded_files), max_batch + 1):
+        try:
+            images.append((source.name, source.read()))
+        except READ_ERRORS as exc:
+            # Corrupt or oversized archives fail their entry, not the whole batch
+            images.append((source.name, exc))
+    if len(images) > max_batch:
+        return error_response(f"At most {max_batch} images per batch", 413)
+
+    run_async = option(request, 'async', False)
+    options = {
+        'persist': option(request, 'persist', True),
+        'visualize': option(request, 'visualize', True),
+        'fields_only': option(request, 'fields_only', False),
+    }
+
+    results = await get_limiter().run(recognize_batch, images, run_async, options)
+    return JsonResponse({'results': results}, status=202 if run_async else 200)
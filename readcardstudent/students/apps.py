@@ -1,6 +1,26 @@
+import logging
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
 
 
 class StudentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'students'
+
+    def ready(self):
+        # Connect the signal handlers: SQLite connection setup, roster index updates and file cleanup
+        from . import db, roster, storage
+
+        # Load the processor and OCR data at boot instead of on the first request
+        from .registry import preload, serving_process
+
+        if not getattr(settings, 'STUDENT_CARD_PRELOAD', True) or not serving_process():
+            return
+        try:
+            preload(warm_up=getattr(settings, 'STUDENT_CARD_WARMUP', False))
+        except Exception:
+            # The first card will report the problem, the process can still start
+            logger.exception("Could not preload the student card processor")
@@ -0,0 +1,441 @@
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .cascade import OCRCascade
+from .geometry import CARD_SIZE
+from .ingest import is_image_name
+from .parser import normalize
+from .utils import StudentCardProcessor
+
+# Name of the file mapping image file names to their expected field values
+LABELS_FILE = 'labels.json'
+
+# Fonts with Vietnamese glyphs, tried in order when no font is configured
+FONT_CANDIDATES = (
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans.ttf',
+    '/Library/Fonts/Arial Unicode.ttf',
+    'C:\\Windows\\Fonts\\arial.ttf',
+)
+
+FAMILY_NAMES = ('Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ')
+MIDDLE_NAMES = ('Văn', 'Thị', 'Hữu', 'Đức', 'Minh', 'Ngọc', 'Thanh', 'Quốc', 'Thu', 'Gia')
+GIVEN_NAMES = ('An', 'Bình', 'Châu', 'Dũng', 'Hà', 'Hùng', 'Khánh', 'Linh', 'Long', 'Mai', 'Nam', 'Phúc', 'Quân', 'Thảo', 'Trang', 'Việt')
+CLASS_PREFIXES = ('ST', 'CS', 'KT', 'QT', 'NN', 'DL')
+
+# Stages timed for every card, in pipeline order. preprocess, layout and
+# regions are part of extract and are only timed when metrics are enabled;
+# visualization is rendered on request when serving, so it is not in total.
+STAGES = ('decode', 'normalize', 'extract', 'layout', 'preprocess', 'regions', 'ocr', 'parse', 'total', 'visualization')
+
+# Stages timed inside extraction, taken from the card's metrics trace
+TRACED_STAGES = ('layout', 'preprocess', 'regions')
+
+
+def load_font(size, path=None):
+    """TrueType font able to draw Vietnamese text, or Pillow's default font"""
+    from PIL import ImageFont
+
+    path = path or getattr(settings, 'STUDENT_CARD_BENCHMARK_FONT', None)
+    for candidate in ([path] if path else FONT_CANDIDATES):
+        if os.path.exists(candidate):
+            return ImageFont.truetype(candidate, size)
+    return ImageFont.load_default()
+
+
+def random_card_fields(rng):
+    """Plausible field values for one synthetic Dong A University card"""
+    start_year = rng.randint(2015, 2024)
+    return {
+        'university': 'ĐẠI HỌC ĐÔNG Á',
+        'student_card': 'THẺ SINH VIÊN',
+        'name': f"{rng.choice(FAMILY_NAMES)} {rng.choice(MIDDLE_NAMES)} {rng.choice(GIVEN_NAMES)}",
+        'dob': f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{start_year - rng.randint(17, 20)}",
+        'student_id': str(rng.randint(10000, 999999)),
+        'class': f"{rng.choice(CLASS_PREFIXES)}{start_year % 100}{rng.choice('ABCD')}",
+        'cohort': f"{start_year}-{start_year + 4}",
+    }
+
+
+def render_synthetic_card(fields, rng=None, font_path=None, size=CARD_SIZE, margin=60):
+    """Draw a card with the given field values, placed like the Dong A layout
+
+    The card is drawn on a dark background with a small random rotation
+    and noise, so normalization and preprocessing have work to do.
+
+    Returns:
+        BGR image
+    """
+    from PIL import Image, ImageDraw
+
+    rng = rng or random.Random(0)
+    width, height = size
+    card = Image.new('RGB', size, (250, 250, 245))
+    draw = ImageDraw.Draw(card)
+    large, medium, small = (load_font(int(height * ratio), font_path) for ratio in (0.075, 0.065, 0.055))
+
+    def text(x, y, value, font):
+        draw.text((int(x * width), int(y * height)), value, font=font, fill=(20, 20, 20))
+
+    # Header band and photo placeholder
+    draw.rectangle([0, 0, width, int(0.19 * height)], fill=(225, 235, 250))
+    draw.rectangle([int(0.06 * width), int(0.24 * height), int(0.32 * width), int(0.72 * height)], fill=(170, 170, 170))
+
+    text(0.40, 0.05, fields['university'], large)
+    text(0.40, 0.24, fields['student_card'], large)
+    text(0.40, 0.37, fields['name'], medium)
+    text(0.40, 0.52, "Ngày sinh:", small)
+    text(0.66, 0.52, fields['dob'], small)
+    text(0.40, 0.64, "Lớp:", small)
+    text(0.66, 0.64, fields['class'], small)
+    text(0.40, 0.77, "Khóa:", small)
+    text(0.66, 0.77, fields['cohort'], small)
+    text(0.09, 0.77, fields['student_id'], small)
+
+    image = cv2.cvtColor(np.array(card), cv2.COLOR_RGB2BGR)
+
+    # Place the card on a dark background, slightly rotated, with sensor noise
+    canvas = np.full((height + 2 * margin, width + 2 * margin, 3), 40, dtype=np.uint8)
+    canvas[margin:margin + height, margin:margin + width] = image
+    center = (canvas.shape[1] / 2, canvas.shape[0] / 2)
+    matrix = cv2.getRotationMatrix2D(center, rng.uniform(-3, 3), 1.0)
+    canvas = cv2.warpAffine(canvas, matrix, (canvas.shape[1], canvas.shape[0]), borderValue=(40, 40, 40))
+    noise = np.random.default_rng(rng.randint(0, 2 ** 31)).normal(0, 6, canvas.shape)
+    return np.clip(canvas + noise, 0, 255).astype(np.uint8)
+
+
+def generate_synthetic_cards(directory, count, seed=0, font_path=None):
+    """Render labelled synthetic cards into a directory
+
+    Returns:
+        List of (image path, expected fields)
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    cards, labels = [], {}
+    for index in range(count):
+        fields = random_card_fields(rng)
+        filename = f"synthetic_{index:04d}.png"
+        path = os.path.join(directory, filename)
+        cv2.imwrite(path, render_synthetic_card(fields, rng, font_path))
+        cards.append((path, fields))
+        labels[filename] = fields
+
+    with open(os.path.join(directory, LABELS_FILE), 'w', encoding='utf-8') as f:
+        json.dump(labels, f, ensure_ascii=False, indent=2)
+    return cards
+
+
+def load_labelled_cards(directory):
+    """Images of a directory with their expected fields from labels.json
+
+    Images without labels are still timed but not scored.
+
+    Returns:
+        List of (image path, expected fields)
+    """
+    labels = {}
+    labels_path = os.path.join(directory, LABELS_FILE)
+    if os.path.exists(labels_path):
+        with open(labels_path, encoding='utf-8') as f:
+            labels = json.load(f)
+
+    return [
+        (os.path.join(directory, filename), labels.get(filename, {}))
+        for filename in sorted(os.listdir(directory))
+        if is_image_name(filename)
+    ]
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, None where it can't be measured"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def values_match(expected, actual):
+    """Compare field values ignoring case, Unicode composition and spacing"""
+    if actual is None:
+        return False
+    return ' '.join(normalize(expected).casefold().split()) == ' '.join(normalize(actual).casefold().split())
+
+
+def summarize(values):
+    """Total, mean, median, 95th percentile and maximum of a list of seconds"""
+    if not values:
+        return {'count': 0, 'total': 0.0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+    ordered = sorted(values)
+    return {
+        'count': len(ordered),
+        'total': sum(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': ordered[len(ordered) // 2],
+        'p95': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+        'max': ordered[-1],
+    }
+
+
+class TimingEngine:
+    """Wraps an OCR engine and records the duration of every call
+
+    Calls made inside worker processes of the process executor are not seen.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.name = engine.name
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _timed(self, method, image, config):
+        start = time.perf_counter()
+        try:
+            return method(image, config=config)
+        finally:
+            with self._lock:
+                self.calls.append((config, time.perf_counter() - start))
+
+    def image_to_string(self, image, config=''):
+        return self._timed(self.engine.image_to_string, image, config)
+
+    def image_to_data(self, image, config=''):
+        return self._timed(self.engine.image_to_data, image, config)
+
+    def take_calls(self):
+        with self._lock:
+            calls, self.calls = self.calls, []
+        return calls
+
+
+class TimingParser:
+    """Wraps a FieldParser and accumulates the time spent parsing"""
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.seconds = 0.0
+
+    def parse_lines(self, lines, result=None):
+        start = time.perf_counter()
+        try:
+            return self.parser.parse_lines(lines, result)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def parse(self, text, source=None, result=None):
+        return self.parser.parse(text, source, result)
+
+    def take_seconds(self):
+        seconds, self.seconds = self.seconds, 0.0
+        return seconds
+
+
+class RecordingCascade(OCRCascade):
+    """Default pass order that keeps the outcome of every pass instead of storing it
+
+    Benchmarks must neither depend on nor change the learned pass statistics.
+    """
+
+    def __init__(self):
+        super().__init__(learning=False)
+        self.outcomes = []
+
+    def record(self, outcomes):
+        self.outcomes.extend(outcomes)
+
+    def take_outcomes(self):
+        outcomes, self.outcomes = self.outcomes, []
+        return outcomes
+
+
+class BenchmarkRunner:
+    """Runs the card pipeline over labelled images and reports timings and accuracy
+
+    Cards go through the pipeline as it runs when serving: preprocessed
+    images and text regions are only built when extraction asks for them,
+    so the timings and the number of variants built show what the lazy
+    pipeline actually costs.
+    """
+
+    def __init__(self, processor=None, executor=None, visualize=True):
+        self.cascade = RecordingCascade()
+        self.processor = processor or StudentCardProcessor(cascade=self.cascade, executor=executor)
+        self.processor.cascade = self.cascade
+        self.engine = TimingEngine(self.processor.engine)
+        self.processor.engine = self.engine
+        self.parser = TimingParser(self.processor.parser)
+        self.processor.parser = self.parser
+        self.visualize = visualize
+
+    def run_card(self, path, expected):
+        """Process one image, timing every stage
+
+        Returns:
+            Dictionary with the card's timings, OCR passes and extracted fields
+        """
+        processor = self.processor
+        timings = {}
+
+        def timed(stage, func, *args):
+            start = time.perf_counter()
+            result = func(*args)
+            timings[stage] = time.perf_counter() - start
+            return result
+
+        start = time.perf_counter()
+        image = timed('decode', cv2.imread, path)
+        if image is None:
+            return {'path': path, 'error': "Could not read image"}
+
+        prepared = timed('normalize', processor.prepare_image, image)
+        graph = processor.preprocess(prepared)
+        with metrics.card_trace() as trace:
+            info, _ = timed('extract', processor.extract_card_info, prepared, None, graph)
+        timings['total'] = time.perf_counter() - start
+        if trace is not None:
+            timings.update({stage: trace.stages[stage] for stage in TRACED_STAGES if stage in trace.stages})
+        variants = len(set(graph.built) & set(processor.OCR_METHODS))
+
+        if self.visualize:
+            from .visualization import render_visualizations
+
+            def visualize():
+                regions = processor.detect_text_regions(prepared, graph)
+                processed = graph[processor.PREPROCESSING_METHODS[0]]
+                render_visualizations(prepared, processed, processor.visualize_text_regions(prepared, regions))
+
+            timed('visualization', visualize)
+
+        calls = self.engine.take_calls()
+        timings['ocr'] = sum(seconds for _, seconds in calls)
+        timings['parse'] = self.parser.take_seconds()
+
+        confidence = info.pop('confidence', {})
+        return {
+            'path': path,
+            'timings': timings,
+            'ocr_calls': len(calls),
+            'variants': variants,
+            'regions': trace.counts.get('regions', 0) if trace is not None else None,
+            'passes': [
+                {'variant': variant, 'config': config, 'fields_found': found, 'seconds': seconds}
+                for variant, config, found, seconds in self.cascade.take_outcomes()
+            ],
+            'fields': info,
+            'confidence': confidence,
+            'expected': expected,
+            'correct': {field: values_match(value, info.get(field)) for field, value in expected.items()},
+        }
+
+    def run(self, cards, repeat=1):
+        """Benchmark a list of (image path, expected fields)
+
+        Returns:
+            JSON serializable report
+        """
+        records = []
+        started_at = timezone.now()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for path, expected in cards:
+                records.append(self.run_card(path, expected))
+        elapsed = time.perf_counter() - start
+        return self.build_report(records, elapsed, started_at, repeat)
+
+    def build_report(self, records, elapsed, started_at, repeat):
+        processed = [record for record in records if 'error' not in record]
+
+        stages = {
+            stage: summarize([record['timings'][stage] for record in processed if stage in record['timings']])
+            for stage in STAGES
+        }
+
+        passes = {}
+        for record in processed:
+            for outcome in record['passes']:
+                key = f"{outcome['variant']}/{outcome['config']}"
+                passes.setdefault(key, []).append(outcome['seconds'])
+
+        accuracy = {}
+        for record in processed:
+            for field, correct in record['correct'].items():
+                counts = accuracy.setdefault(field, {'correct': 0, 'labelled': 0})
+                counts['labelled'] += 1
+                counts['correct'] += int(correct)
+        for counts in accuracy.values():
+            counts['accuracy'] = counts['correct'] / counts['labelled']
+        labelled = sum(counts['labelled'] for counts in accuracy.values())
+
+        return {
+            'meta': {
+                'started_at': started_at.isoformat(),
+                'processor_version': self.processor.version,
+                'engine': self.engine.name,
+                'executor': self.processor.executor.kind,
+                'ocr_workers': self.processor.executor.workers,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'repeat': repeat,
+            },
+            'cards': len(records),
+            'failed': len(records) - len(processed),
+            'elapsed': elapsed,
+            'throughput': len(processed) / elapsed if elapsed else 0.0,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': stages,
+            'passes': {key: summarize(seconds) for key, seconds in passes.items()},
+            'ocr_calls_per_card': summarize([record['ocr_calls'] for record in processed])['mean'],
+            'variants_per_card': summarize([record['variants'] for record in processed])['mean'],
+            'accuracy': accuracy,
+            'overall_accuracy': (
+                sum(counts['correct'] for counts in accuracy.values()) / labelled if labelled else None
+            ),
+            'records': records,
+        }
+
+
+def compare_reports(baseline, report, max_slowdown=0.1, max_accuracy_drop=0.02):
+    """Find performance and accuracy regressions of a report against a baseline
+
+    Returns:
+        List of human readable regressions, empty when there are none
+    """
+    regressions = []
+
+    for stage in ('total', 'ocr', 'extract'):
+        before = baseline['stages'].get(stage, {}).get('mean')
+        after = report['stages'].get(stage, {}).get('mean')
+        if before and after and after > before * (1 + max_slowdown):
+            regressions.append(
+                f"Stage {stage} mean went from {before:.3f}s to {after:.3f}s (+{(after / before - 1):.0%})"
+            )
+
+    before, after = baseline.get('throughput'), report.get('throughput')
+    if before and after is not None and after < before * (1 - max_slowdown):
+        regressions.append(f"Throughput went from {before:.2f} to {after:.2f} cards/s")
+
+    for field, counts in baseline.get('accuracy', {}).items():
+        current = report.get('accuracy', {}).get(field)
+        if current is not None and current['accuracy'] < counts['accuracy'] - max_accuracy_drop:
+            regressions.append(
+                f"Accuracy of {field} went from {counts['accuracy']:.1%} to {current['accuracy']:.1%}"
+            )
+
+    return regressions
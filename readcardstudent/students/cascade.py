@@ -0,0 +1,166 @@
+import atexit
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import F
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OCRCascade:
+    """Decides in which order the preprocessing variant / OCR config passes run
+
+    Every pass records how many fields it yielded and how long it took in
+    OCRPassStat. Once a pass has been seen often enough, passes are ranked by
+    fields found per second so the cheapest productive passes run first and
+    the processor can stop as soon as every field is settled. Passes without
+    enough samples keep their default position.
+
+    Passes that never run get no new samples, so every explore_every cards
+    the pass with the fewest samples runs first. A ranking learned from a
+    few unlucky early cards is corrected instead of kept forever.
+
+    Outcomes are summed in memory and written at most every flush_interval
+    seconds in one transaction, instead of a few writes per card.
+    """
+
+    def __init__(self, learning=None, min_samples=None, refresh_interval=None, flush_interval=None,
+                 explore_every=None):
+        self.learning = getattr(settings, 'STUDENT_CARD_CASCADE_LEARNING', True) if learning is None else learning
+        self.min_samples = getattr(settings, 'STUDENT_CARD_CASCADE_MIN_SAMPLES', 20) if min_samples is None else min_samples
+        self.refresh_interval = (
+            getattr(settings, 'STUDENT_CARD_CASCADE_REFRESH_INTERVAL', 60)
+            if refresh_interval is None else refresh_interval
+        )
+        self.flush_interval = (
+            getattr(settings, 'STUDENT_CARD_CASCADE_FLUSH_INTERVAL', 30)
+            if flush_interval is None else flush_interval
+        )
+        self.explore_every = (
+            getattr(settings, 'STUDENT_CARD_CASCADE_EXPLORE_EVERY', 20)
+            if explore_every is None else explore_every
+        )
+        self._plans = itertools.count(1)
+        self._stats = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        # (variant, config) -> [attempts, fields_found, seconds] not written yet
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+        self._flush_lock = threading.Lock()
+        if self.learning:
+            atexit.register(self.flush)
+
+    def _load_stats(self):
+        """Reload the pass statistics from the database at most every refresh_interval seconds"""
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+            return self._stats
+
+        from .models import OCRPassStat
+
+        with self._lock:
+            self._stats = {
+                (stat.variant, stat.config): stat
+                for stat in OCRPassStat.objects.all()
+            }
+            self._loaded_at = now
+        return self._stats
+
+    def plan(self, variants, configs):
+        """Return the (variant, config) pairs in the order they should be tried"""
+        passes = [(variant, config) for variant in variants for config in configs]
+        if not self.learning:
+            return passes
+
+        stats = self._load_stats()
+
+        def score(item):
+            index, key = item
+            stat = stats.get(key)
+            if stat is None or stat.attempts < self.min_samples:
+                # Unknown passes keep their default order after the learned ones
+                return (1, 0, index)
+            fields_per_second = stat.fields_found / max(stat.total_time, 1e-6)
+            return (0, -fields_per_second, index)
+
+        ranked = [key for _, key in sorted(enumerate(passes), key=score)]
+        if self.explore_every and next(self._plans) % self.explore_every == 0:
+            explored = min(ranked, key=lambda key: self._samples(stats, key))
+            ranked.remove(explored)
+            ranked.insert(0, explored)
+            metrics.count('cascade_explored')
+        return ranked
+
+    def _samples(self, stats, key):
+        """Attempts recorded for a pass, including the ones not written yet"""
+        stat = stats.get(key)
+        with self._flush_lock:
+            pending = self._pending.get(key, (0,))[0]
+        return (stat.attempts if stat is not None else 0) + pending
+
+    def record(self, outcomes):
+        """Add the results of the passes that ran for one card
+
+        Args:
+            outcomes: List of (variant, config, fields_found, seconds) tuples
+        """
+        if not self.learning or not outcomes:
+            return
+
+        self._add({
+            (variant, config): (1, fields_found, seconds)
+            for variant, config, fields_found, seconds in outcomes
+        })
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            try:
+                self.flush()
+            except DatabaseError:
+                # The statistics only order the passes, a failed write must not fail the card
+                logger.warning("Could not store OCR pass statistics, retrying at the next flush", exc_info=True)
+
+    def _add(self, totals):
+        with self._flush_lock:
+            for key, (attempts, fields_found, seconds) in totals.items():
+                pending = self._pending.setdefault(key, [0, 0, 0.0])
+                pending[0] += attempts
+                pending[1] += fields_found
+                pending[2] += seconds
+
+    def flush(self):
+        """Write the outcomes recorded since the last flush to OCRPassStat in one transaction"""
+        with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+
+        from .models import OCRPassStat
+
+        try:
+            with transaction.atomic():
+                for (variant, config), (attempts, fields_found, seconds) in pending.items():
+                    def add():
+                        return OCRPassStat.objects.filter(variant=variant, config=config).update(
+                            attempts=F('attempts') + attempts,
+                            fields_found=F('fields_found') + fields_found,
+                            total_time=F('total_time') + seconds,
+                        )
+
+                    if not add():
+                        _, created = OCRPassStat.objects.get_or_create(
+                            variant=variant, config=config,
+                            defaults={'attempts': attempts, 'fields_found': fields_found, 'total_time': seconds},
+                        )
+                        if not created:
+                            # Another process created the row since the update
+                            add()
+        except DatabaseError:
+            self._add(pending)
+            raise
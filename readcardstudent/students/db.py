@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Set up every new SQLite connection for concurrent web requests and workers
+
+    WAL lets readers work while a card is being written, and the busy
+    timeout makes a writer wait for the lock instead of failing with
+    "database is locked". Other databases are left alone.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    busy_timeout = getattr(settings, 'STUDENT_CARD_SQLITE_BUSY_TIMEOUT', 20)
+    with connection.cursor() as cursor:
+        if getattr(settings, 'STUDENT_CARD_SQLITE_WAL', True):
+            cursor.execute('PRAGMA journal_mode=WAL')
+            # Durable at every checkpoint instead of every commit, safe with WAL
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)}')
@@ -0,0 +1,177 @@
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .ocr_engines import get_ocr_engine, limit_tesseract_threads
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def timed_ocr(engine, image, config, data=False):
+    """Run one OCR call and measure it
+
+    Returns:
+        Tuple of (text, seconds), or (list of (line, confidence), seconds) with data=True
+    """
+    start = time.perf_counter()
+    if data:
+        result = engine.image_to_data(image, config=config)
+    else:
+        result = engine.image_to_string(image, config=config)
+    return result, time.perf_counter() - start
+
+
+def run_on_every_thread(pool, threads, func, *args, timeout=60):
+    """Run func once on each thread of a ThreadPoolExecutor, starting the threads that don't exist yet
+
+    The calls wait for each other before running, so no thread takes two of them.
+    """
+    barrier = threading.Barrier(threads)
+
+    def run():
+        barrier.wait(timeout)
+        func(*args)
+
+    for future in [pool.submit(run) for _ in range(threads)]:
+        future.result()
+
+
+def run_ocr_task(image, config, data=False):
+    """Entry point for OCR calls in worker processes, using the process' own engine"""
+    return timed_ocr(get_ocr_engine(), image, config, data)
+
+
+def _started():
+    pass
+
+
+def _init_ocr_process(configs=()):
+    # Needed when worker processes are spawned instead of forked
+    import django
+    from django.apps import apps
+
+    from .registry import disable_preload
+
+    # A spawned worker sees the server's argv, it must not build its own processor and pool
+    disable_preload()
+    if not apps.ready:
+        django.setup()
+    limit_tesseract_threads()
+    if configs:
+        get_ocr_engine().preload(configs)
+
+
+class SerialOCRExecutor:
+    """Runs OCR calls one after another in the calling thread"""
+    kind = 'serial'
+    workers = 1
+
+    def preload(self, engine, configs):
+        """Load what the configs need in every thread or process that will run OCR calls
+
+        Serial OCR runs in the threads processing cards: the request
+        limiter's threads are loaded here, job and ingestion threads load
+        the engine on their first card.
+        """
+        from .limits import get_limiter
+
+        get_limiter().run_on_every_thread(engine.preload, tuple(configs))
+
+    def map_ocr(self, engine, images, configs, data=False):
+        """Run OCR for each (image, config) pair
+
+        Returns:
+            List of timed_ocr results, in the same order as the inputs
+        """
+        return [timed_ocr(engine, image, config, data) for image, config in zip(images, configs)]
+
+    def shutdown(self):
+        pass
+
+
+class ThreadOCRExecutor(SerialOCRExecutor):
+    """Runs OCR calls on a thread pool
+
+    Both OCR engines release the GIL while tesseract works, so threads
+    scale without the cost of copying images to other processes.
+    """
+    kind = 'thread'
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocr')
+
+    def preload(self, engine, configs):
+        run_on_every_thread(self._pool, self.workers, engine.preload, tuple(configs))
+
+    def map_ocr(self, engine, images, configs, data=False):
+        return list(self._pool.map(functools.partial(timed_ocr, engine, data=data), images, configs))
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+class ProcessOCRExecutor(SerialOCRExecutor):
+    """Runs OCR calls on a process pool
+
+    Worker processes use the engine from settings, not the engine passed
+    to map_ocr, since engines hold state that can't be sent between processes.
+    """
+    kind = 'process'
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._configs = ()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers, initializer=_init_ocr_process, initargs=(self._configs,),
+                    )
+        return self._pool
+
+    def preload(self, engine, configs):
+        """Start the worker processes, each loading what the configs need as it starts"""
+        self._configs = tuple(configs)
+        pool = self._get_pool()
+        wait([pool.submit(_started) for _ in range(self.workers)])
+
+    def map_ocr(self, engine, images, configs, data=False):
+        return list(self._get_pool().map(functools.partial(run_ocr_task, data=data), images, configs))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+def create_ocr_executor(kind=None, workers=None):
+    """Create the OCR executor selected in settings"""
+    kind = kind or getattr(settings, 'STUDENT_CARD_OCR_EXECUTOR', 'serial')
+    workers = workers or getattr(settings, 'STUDENT_CARD_OCR_WORKERS', None) or os.cpu_count() or 1
+
+    if kind == 'serial' or workers == 1:
+        return SerialOCRExecutor()
+    if kind == 'thread':
+        return ThreadOCRExecutor(workers)
+    if kind == 'process':
+        return ProcessOCRExecutor(workers)
+    raise ValueError(f"Unknown OCR executor: {kind!r}")
+
+
+def get_ocr_executor():
+    """Return the OCR executor shared by the whole process"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = create_ocr_executor()
+    return _executor
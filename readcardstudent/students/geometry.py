@@ -0,0 +1,128 @@
+import math
+
+import cv2
+import numpy as np
+
+# ISO/IEC 7810 ID-1 card (85.60 x 53.98 mm) at 300 DPI
+CARD_SIZE = (1012, 638)
+
+
+def order_corners(points):
+    """Order four points as top-left, top-right, bottom-right, bottom-left"""
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array([
+        points[np.argmin(sums)],
+        points[np.argmin(diffs)],
+        points[np.argmax(sums)],
+        points[np.argmax(diffs)],
+    ], dtype=np.float32)
+
+
+def limit_size(image, max_side):
+    """Downscale an image so its longer side is at most max_side pixels"""
+    height, width = image.shape[:2]
+    scale = max_side / float(max(height, width))
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def find_card_quad(image, work_side=800, min_area_ratio=0.2):
+    """Find the corners of the card in a photo
+
+    The search runs on a downscaled copy, so its cost does not depend on
+    the camera resolution.
+
+    Returns:
+        4x2 array of corners in the coordinates of the input image, or None
+    """
+    small = limit_size(image, work_side)
+    scale = image.shape[1] / float(small.shape[1])
+
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    edges = cv2.Canny(blurred, 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8), iterations=1)
+
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = small.shape[0] * small.shape[1] * min_area_ratio
+
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area:
+            break
+        perimeter = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            return order_corners(approx) * scale
+
+    return None
+
+
+def warp_card(image, corners, size=CARD_SIZE):
+    """Perspective-warp the card corners onto a landscape image of the given size"""
+    tl, tr, br, bl = corners
+    width = max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl))
+    height = max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr))
+    if height > width:
+        # Card photographed in portrait orientation, turn it to landscape
+        corners = np.array([bl, tl, tr, br], dtype=np.float32)
+
+    out_width, out_height = size
+    target = np.array([
+        [0, 0],
+        [out_width - 1, 0],
+        [out_width - 1, out_height - 1],
+        [0, out_height - 1],
+    ], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), target)
+    return cv2.warpPerspective(image, matrix, (out_width, out_height), flags=cv2.INTER_AREA)
+
+
+def skew_angle(image):
+    """Angle in degrees of the dominant text direction, in (-45, 45]"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    coords = cv2.findNonZero(binary)
+    if coords is None:
+        return 0.0
+
+    # Use the longer edge of the minimum area rectangle, this does not depend
+    # on the angle convention of the OpenCV version
+    box = cv2.boxPoints(cv2.minAreaRect(coords))
+    edge_a = box[1] - box[0]
+    edge_b = box[2] - box[1]
+    dx, dy = edge_a if np.hypot(*edge_a) >= np.hypot(*edge_b) else edge_b
+    angle = math.degrees(math.atan2(dy, dx))
+
+    while angle > 45:
+        angle -= 90
+    while angle <= -45:
+        angle += 90
+    return angle
+
+
+def deskew(image, min_angle=0.5):
+    """Rotate the image so text lines are horizontal"""
+    angle = skew_angle(image)
+    if abs(angle) < min_angle:
+        return image
+
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(image, matrix, (width, height),
+                          flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def normalize_card(image, size=CARD_SIZE):
+    """Crop, straighten and resize a card photo to the canonical card size
+
+    When the card outline is found it is perspective-warped to exactly
+    ``size``. Otherwise the whole image is downscaled to fit ``size`` and
+    deskewed, so later stages always work on a small image.
+    """
+    corners = find_card_quad(image)
+    if corners is not None:
+        return warp_card(image, corners, size)
+    return deskew(limit_size(image, max(size)))
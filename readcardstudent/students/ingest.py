@@ -0,0 +1,452 @@
+import itertools
+import logging
+import os
+import time
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+
+from . import metrics
+from .limits import card_budget, get_limiter, result_is_partial
+from .models import StudentCard, card_image_storage
+from .registry import get_processor
+from .result_cache import file_digest, find_stored_image, get_result_cache, image_digest
+from .services import CACHED_RESULT_FIELDS, card_fields_from_info, decode_image, same_student_id, thumbnail_for
+from .storage import encode_original
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp'}
+
+
+class SourceTooLarge(ValueError):
+    """Raised when reading an upload over the ingestion size limits"""
+
+
+# Errors reading one source, which fail that source only
+READ_ERRORS = (OSError, zipfile.BadZipFile, SourceTooLarge)
+
+
+class ImageSource:
+    """One card image to ingest, identified by a stable key used for resuming"""
+
+    def __init__(self, key, name, reader):
+        self.key = key
+        self.name = name
+        self._reader = reader
+
+    def read(self):
+        return self._reader()
+
+    @classmethod
+    def unreadable(cls, key, name, error):
+        """Source whose read() raises error, to record it as a failed card"""
+        def reader():
+            raise error
+        return cls(key, name, reader)
+
+
+def is_image_name(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_directory_sources(path):
+    """Yield the images below a directory in a stable order"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            if not is_image_name(filename):
+                continue
+            file_path = os.path.join(root, filename)
+
+            def reader(file_path=file_path):
+                with open(file_path, 'rb') as f:
+                    return f.read()
+
+            yield ImageSource(os.path.abspath(file_path), filename, reader)
+
+
+def iter_zip_sources(path):
+    """Yield the images inside a ZIP archive in archive order"""
+    archive_key = os.path.abspath(path)
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not is_image_name(info.filename):
+                continue
+            yield ImageSource(
+                f"{archive_key}:{info.filename}",
+                os.path.basename(info.filename),
+                lambda info=info: archive.read(info),
+            )
+
+
+def iter_image_sources(path):
+    """Yield ImageSources for a directory or a ZIP archive"""
+    if os.path.isdir(path):
+        return iter_directory_sources(path)
+    if zipfile.is_zipfile(path):
+        return iter_zip_sources(path)
+    raise ValueError(f"{path} is neither a directory nor a ZIP archive")
+
+
+def iter_upload_sources(uploaded_files):
+    """Yield ImageSources for files posted in a multi-file upload, expanding ZIP archives
+
+    Uploads have no stable path, so they are keyed by the SHA-256 of their
+    content: only an upload with exactly the same bytes counts as already
+    ingested. Archive members are extracted once, for their key, and kept.
+
+    Images over settings.STUDENT_CARD_INGEST_MAX_IMAGE_BYTES, archives with
+    more than settings.STUDENT_CARD_INGEST_MAX_ARCHIVE_IMAGES images and
+    files that are not valid archives are never extracted: their sources
+    raise a READ_ERRORS exception when read.
+    """
+    max_bytes = getattr(settings, 'STUDENT_CARD_INGEST_MAX_IMAGE_BYTES', 20 * 1024 * 1024)
+    max_images = getattr(settings, 'STUDENT_CARD_INGEST_MAX_ARCHIVE_IMAGES', 1000)
+    for uploaded_file in uploaded_files:
+        if uploaded_file.name.lower().endswith('.zip'):
+            upload_key = f"upload:{file_digest(uploaded_file)}"
+            try:
+                archive = zipfile.ZipFile(uploaded_file)
+            except zipfile.BadZipFile as exc:
+                yield ImageSource.unreadable(upload_key, uploaded_file.name, exc)
+                continue
+            with archive:
+                members = [
+                    info for info in archive.infolist() if not info.is_dir() and is_image_name(info.filename)
+                ]
+                if len(members) > max_images:
+                    yield ImageSource.unreadable(upload_key, uploaded_file.name, SourceTooLarge(
+                        f"{uploaded_file.name} holds {len(members)} images, at most {max_images} are accepted"
+                    ))
+                    continue
+                for info in members:
+                    name = os.path.basename(info.filename)
+                    # zipfile never extracts more than the size the member declares
+                    if info.file_size > max_bytes:
+                        yield ImageSource.unreadable(f"{upload_key}:{info.filename}", name, SourceTooLarge(
+                            f"{info.filename} is larger than {max_bytes} bytes"
+                        ))
+                        continue
+                    try:
+                        data = archive.read(info)
+                    except Exception as exc:
+                        # Corrupt data, unsupported compression or encryption
+                        yield ImageSource.unreadable(f"{upload_key}:{info.filename}", name, zipfile.BadZipFile(
+                            f"Could not extract {info.filename}: {exc}"
+                        ))
+                        continue
+                    yield ImageSource(f"upload:{image_digest(data)}", name, lambda data=data: data)
+        elif is_image_name(uploaded_file.name):
+            upload_key = f"upload:{file_digest(uploaded_file)}"
+            if uploaded_file.size > max_bytes:
+                yield ImageSource.unreadable(upload_key, uploaded_file.name, SourceTooLarge(
+                    f"{uploaded_file.name} is larger than {max_bytes} bytes"
+                ))
+                continue
+            yield ImageSource(upload_key, uploaded_file.name, uploaded_file.read)
+
+
+def queue_sources(sources, batch_size=None):
+    """Store images as pending StudentCards for the background workers, see students.jobs
+
+    Nothing is processed here, so a large upload only costs the time to
+    store it. Each distinct image is stored once, and a file already stored
+    for the same bytes is reused. Sources already ingested or queued under
+    the same key are skipped, sources that can't be read are stored as
+    failed cards. The cards share a batch_id to follow their progress by,
+    see views.bulk_status.
+
+    Returns:
+        Tuple of (batch id, cards queued, sources skipped, sources failed)
+    """
+    batch_size = batch_size or getattr(settings, 'STUDENT_CARD_INGEST_BATCH_SIZE', 100)
+    batch_id = uuid.uuid4()
+    storage = card_image_storage()
+    reencode = getattr(settings, 'STUDENT_CARD_ORIGINAL_FORMAT', None)
+    stored = {}
+    keys = set()
+    queued = skipped = failed = 0
+
+    sources = iter(sources)
+    while True:
+        batch = list(itertools.islice(sources, batch_size))
+        if not batch:
+            break
+        existing = set(
+            StudentCard.objects.filter(source__in=[source.key for source in batch])
+            .values_list('source', flat=True)
+        )
+        cards = []
+        for source in batch:
+            if source.key in existing or source.key in keys:
+                skipped += 1
+                continue
+            keys.add(source.key)
+            try:
+                data = source.read()
+            except READ_ERRORS as exc:
+                failed += 1
+                cards.append(StudentCard(
+                    source=source.key,
+                    batch_id=batch_id,
+                    status=StudentCard.STATUS_FAILED,
+                    attempts=1,
+                    error=f"Could not read image: {exc}",
+                    finished_at=timezone.now(),
+                ))
+                continue
+            digest = image_digest(data)
+            name = stored.get(digest) or find_stored_image(digest)
+            if name is None:
+                content, extension = encode_original(
+                    data, os.path.splitext(source.name)[1].lower(), decode_image(data) if reencode else None,
+                )
+                name = storage.save(f"student_cards/{uuid.uuid4().hex}{extension}", ContentFile(content))
+            stored[digest] = name
+            cards.append(StudentCard(image=name, image_sha256=digest, source=source.key, batch_id=batch_id))
+            queued += 1
+        StudentCard.objects.bulk_create(cards)
+    return batch_id, queued, skipped, failed
+
+
+class IngestStats:
+    """Counters reported while ingesting"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        """Cards per second processed so far"""
+        return (self.processed + self.failed) / max(self.elapsed, 1e-6)
+
+    def __str__(self):
+        return (
+            f"{self.processed} processed, {self.failed} failed, {self.skipped} skipped "
+            f"in {self.elapsed:.1f}s ({self.rate:.2f} cards/sec)"
+        )
+
+
+class BulkIngestor:
+    """Runs many card images through StudentCardProcessor and stores them in batches
+
+    Images are processed on a bounded thread pool and the StudentCard rows
+    are written with bulk_create. Each row records its source key, so an
+    interrupted run can be restarted and skips what was already stored.
+    Images with the same bytes as one already seen in the run are not
+    processed again, their cards share its file, thumbnail and result.
+    """
+
+    def __init__(self, processor=None, batch_size=None, workers=None, resume=True, progress=None):
+        self.processor = processor or get_processor()
+        self.result_cache = get_result_cache()
+        self.batch_size = batch_size or getattr(settings, 'STUDENT_CARD_INGEST_BATCH_SIZE', 100)
+        self.workers = workers or getattr(settings, 'STUDENT_CARD_INGEST_WORKERS', 4)
+        self.resume = resume
+        # Called with the IngestStats after every batch written
+        self.progress = progress
+
+    def _failed_card(self, source, error):
+        return StudentCard(
+            source=source.key,
+            status=StudentCard.STATUS_FAILED,
+            attempts=1,
+            error=error,
+            finished_at=timezone.now(),
+        )
+
+    def _shared_fields(self, card):
+        """Fields of a processed card that the cards of later sources with the same bytes reuse"""
+        return {
+            'image': card.image.name or '',
+            'thumbnail': card.thumbnail.name,
+            'status': card.status,
+            'error': card.error,
+            'image_sha256': card.image_sha256,
+            'image_phash': card.image_phash,
+            'budget_violations': card.budget_violations,
+            **{name: getattr(card, name) for name in CACHED_RESULT_FIELDS},
+        }
+
+    def _duplicate_card(self, shared, source):
+        """Card for a source with the same bytes as an image already processed in this run"""
+        return StudentCard(source=source.key, attempts=1, finished_at=timezone.now(), **shared)
+
+    def _process(self, source, data, digest):
+        """Process one image in a worker thread and build its (unsaved) StudentCard
+
+        Waits for a slot of the limiter shared with requests and job workers,
+        so a bulk import doesn't starve interactive uploads of CPU. Any error,
+        including storing the image or its thumbnail, gives a failed card
+        instead of stopping the run.
+        """
+        with get_limiter().slot():
+            with card_budget() as budget, metrics.card_trace() as trace, metrics.stage('total'):
+                try:
+                    card = self._build_card(source, data, digest)
+                except Exception as exc:
+                    logger.exception("Could not ingest %s", source.key)
+                    card = self._failed_card(source, f"Processing failed: {exc}")
+        metrics.card_finished(card.status)
+        card.budget_violations = budget.violations
+        if trace is not None:
+            card.timings = trace.as_dict()
+        return card
+
+    def _build_card(self, source, data, digest):
+        with metrics.stage('decode'):
+            image = decode_image(data)
+        if image is None:
+            return self._failed_card(source, "Could not decode image")
+
+        phash = self.result_cache.phash(image)
+
+        cached = self.result_cache.lookup(
+            self.processor.version, digest, phash, confirm=same_student_id(self.processor, image),
+        )
+        if cached is not None:
+            fields = {name: getattr(cached, name) for name in CACHED_RESULT_FIELDS}
+        else:
+            try:
+                info, _ = self.processor.extract_card_info(self.processor.prepare_image(image))
+            except Exception as exc:
+                return self._failed_card(source, f"OCR failed: {exc}")
+            fields = card_fields_from_info(info)
+            fields['processor_version'] = None if result_is_partial() else self.processor.version
+
+        # Store each distinct image only once
+        image_name = find_stored_image(digest)
+        if image_name is None:
+            content, extension = encode_original(data, os.path.splitext(source.name)[1].lower(), image)
+            image_name = card_image_storage().save(f"student_cards/{uuid.uuid4()}{extension}", ContentFile(content))
+
+        return StudentCard(
+            image=image_name,
+            source=source.key,
+            status=StudentCard.STATUS_DONE,
+            attempts=1,
+            finished_at=timezone.now(),
+            image_sha256=digest,
+            image_phash=phash,
+            thumbnail=thumbnail_for(image, cached),
+            **fields,
+        )
+
+    def _skip_ingested(self, sources, stats):
+        """Drop the sources already stored by a previous run"""
+        existing = set(
+            StudentCard.objects.filter(source__in=[source.key for source in sources])
+            .values_list('source', flat=True)
+        )
+        stats.skipped += len(existing)
+        return [source for source in sources if source.key not in existing]
+
+    def _add(self, card, cards, stats):
+        if card.status == StudentCard.STATUS_FAILED:
+            stats.failed += 1
+        else:
+            stats.processed += 1
+        cards.append(card)
+
+    def _collect(self, futures, running, shared, duplicates, cards, stats):
+        """Add the cards of finished images, and of the duplicates waiting for them
+
+        Only the fields duplicates reuse are kept from a finished card, the
+        card itself is released once it is written.
+        """
+        for future in futures:
+            card = future.result()
+            shared[running.pop(future)] = self._shared_fields(card)
+            self._add(card, cards, stats)
+        waiting = []
+        for digest, source in duplicates:
+            if digest in shared:
+                metrics.count('cache_hits')
+                self._add(self._duplicate_card(shared[digest], source), cards, stats)
+            else:
+                waiting.append((digest, source))
+        duplicates[:] = waiting
+
+    def _flush(self, cards, stats):
+        if cards:
+            StudentCard.objects.bulk_create(cards, batch_size=self.batch_size)
+            cards.clear()
+        if self.progress:
+            self.progress(stats)
+
+    def ingest(self, sources):
+        """Ingest an iterable of ImageSources
+
+        Returns:
+            IngestStats for the run
+        """
+        stats = IngestStats()
+        cards = []
+        # Futures of the images being processed, to their digest
+        running = {}
+        # Digest of each image processed to the fields its duplicates reuse
+        shared = {}
+        # (digest, source) of sources waiting for an image with the same bytes
+        duplicates = []
+        keys = set()
+        # Bound the number of images held in memory at once
+        max_in_flight = self.workers * 2
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ingest') as pool:
+            batch = []
+            sources = iter(sources)
+            while True:
+                source = next(sources, None)
+                if source is not None:
+                    batch.append(source)
+                    if len(batch) < self.batch_size:
+                        continue
+                if not batch:
+                    break
+
+                if self.resume:
+                    batch = self._skip_ingested(batch, stats)
+
+                for item in batch:
+                    if item.key in keys:
+                        # Listed twice, e.g. the same file uploaded twice
+                        stats.skipped += 1
+                        continue
+                    keys.add(item.key)
+                    try:
+                        data = item.read()
+                    except READ_ERRORS as exc:
+                        self._add(self._failed_card(item, f"Could not read image: {exc}"), cards, stats)
+                        continue
+                    digest = image_digest(data)
+                    if digest in shared or digest in running.values():
+                        duplicates.append((digest, item))
+                        continue
+                    running[pool.submit(self._process, item, data, digest)] = digest
+                    if len(running) >= max_in_flight:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        self._collect(done, running, shared, duplicates, cards, stats)
+                        if len(cards) >= self.batch_size:
+                            self._flush(cards, stats)
+                batch = []
+
+                if source is None:
+                    break
+
+            done, _ = wait(running)
+            self._collect(done, running, shared, duplicates, cards, stats)
+
+        self._flush(cards, stats)
+        return stats
@@ -0,0 +1,241 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .limits import ProcessingCancelled, cancel_on, get_limiter
+from .models import StudentCard
+from .registry import get_processor
+from .services import CardProcessingError, run_card_pipeline
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def background_processing_enabled():
+    return getattr(settings, 'STUDENT_CARD_PROCESSING_MODE', 'sync') == 'async'
+
+
+def claim_next_job():
+    """Atomically move the oldest pending card to processing
+
+    The conditional update makes this safe with several workers, in this
+    process or others, polling the same database.
+
+    Returns:
+        The claimed StudentCard, or None when the queue is empty
+    """
+    while True:
+        card_id = (
+            StudentCard.objects.filter(status=StudentCard.STATUS_PENDING)
+            .order_by('uploaded_at', 'id')
+            .values_list('id', flat=True)
+            .first()
+        )
+        if card_id is None:
+            return None
+
+        claimed = StudentCard.objects.filter(id=card_id, status=StudentCard.STATUS_PENDING).update(
+            status=StudentCard.STATUS_PROCESSING,
+            attempts=F('attempts') + 1,
+            started_at=timezone.now(),
+        )
+        if claimed:
+            return StudentCard.objects.get(id=card_id)
+
+
+def requeue_stale_jobs(timeout, max_retries):
+    """Recover jobs left in processing by a worker that died
+
+    Returns:
+        Number of jobs requeued or failed
+    """
+    cutoff = timezone.now() - timedelta(seconds=timeout * 2)
+    stale = StudentCard.objects.filter(status=StudentCard.STATUS_PROCESSING, started_at__lt=cutoff)
+
+    with transaction.atomic():
+        failed = stale.filter(attempts__gt=max_retries).update(
+            status=StudentCard.STATUS_FAILED,
+            error="Worker stopped while processing the card",
+            finished_at=timezone.now(),
+        )
+        requeued = stale.update(status=StudentCard.STATUS_PENDING)
+    return failed + requeued
+
+
+class CardJobWorkerPool:
+    """Pool of threads processing pending StudentCards from the database"""
+
+    def __init__(self, workers=None, timeout=None, max_retries=None, poll_interval=None, processor=None):
+        self.workers = workers or getattr(settings, 'STUDENT_CARD_JOB_WORKERS', 2)
+        self.timeout = timeout or getattr(settings, 'STUDENT_CARD_JOB_TIMEOUT', 120)
+        self.max_retries = getattr(settings, 'STUDENT_CARD_JOB_MAX_RETRIES', 2) if max_retries is None else max_retries
+        self.poll_interval = poll_interval or getattr(settings, 'STUDENT_CARD_JOB_POLL_INTERVAL', 2)
+        self.processor = processor or get_processor()
+
+        self._threads = []
+        # Looking for stale jobs takes the write lock, so the workers do it once per timeout
+        self._next_requeue = 0
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        """Start the worker threads if they are not running yet"""
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._worker_loop, name=f'card-worker-{i + 1}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wakeup.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def requeue_stale_jobs(self, force=False):
+        """Requeue stale jobs unless a worker of this pool did it less than timeout seconds ago"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now < self._next_requeue:
+                return 0
+            self._next_requeue = now + self.timeout
+        return requeue_stale_jobs(self.timeout, self.max_retries)
+
+    def notify(self):
+        """Wake idle workers up after a new job was queued"""
+        self._wakeup.set()
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            # Jobs take a slot of the limiter shared with requests and bulk ingestion
+            with get_limiter().slot():
+                card = None
+                try:
+                    self.requeue_stale_jobs()
+                    card = claim_next_job()
+                except Exception:
+                    logger.exception("Failed to claim a student card job")
+
+                if card is not None:
+                    try:
+                        self.run_job(card)
+                    except Exception:
+                        logger.exception("Failed to update student card job %s", card.job_id)
+                    finally:
+                        connections.close_all()
+
+            if card is None:
+                connections.close_all()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def run_pending(self):
+        """Process queued jobs in the calling thread until the queue is empty
+
+        Returns:
+            Number of jobs processed
+        """
+        processed = 0
+        self.requeue_stale_jobs(force=True)
+        while True:
+            with get_limiter().slot():
+                card = claim_next_job()
+                if card is None:
+                    return processed
+                self.run_job(card)
+            processed += 1
+
+    def job_deadline(self):
+        """Seconds a job may take: the job timeout, or the card deadline when it is shorter"""
+        deadline = getattr(settings, 'STUDENT_CARD_DEADLINE', 20)
+        return min(deadline, self.timeout) if deadline else self.timeout
+
+    def run_job(self, card):
+        """Process one claimed card in the calling thread, enforcing the per-job timeout
+
+        The timeout is the card's budget deadline: once it has passed, no
+        more OCR passes start and the job finishes with the fields read so
+        far, see students.limits.CardBudget. Stopping the pool cancels the
+        running job at the pipeline's next check and puts it back in the queue.
+        """
+        try:
+            with cancel_on(self._stop):
+                fields, _ = run_card_pipeline(card, self.processor, deadline=self.job_deadline())
+        except ProcessingCancelled:
+            self._fail(card, "Worker stopped while processing the card", retry=True)
+        except Exception as exc:
+            logger.warning("Student card job %s failed", card.job_id, exc_info=True)
+            # Unreadable images will not get better by trying again
+            self._fail(card, str(exc), retry=not isinstance(exc, CardProcessingError))
+        else:
+            self._finish(card, fields)
+
+    def _current_attempt(self, card):
+        """Queryset matching the card only while this attempt still owns it"""
+        return StudentCard.objects.filter(
+            id=card.id, status=StudentCard.STATUS_PROCESSING, attempts=card.attempts
+        )
+
+    def _finish(self, card, fields):
+        self._current_attempt(card).update(
+            status=StudentCard.STATUS_DONE,
+            error='',
+            finished_at=timezone.now(),
+            **fields,
+        )
+        metrics.card_finished(StudentCard.STATUS_DONE)
+
+    def _fail(self, card, error, retry):
+        if retry and card.attempts <= self.max_retries:
+            self._current_attempt(card).update(status=StudentCard.STATUS_PENDING, error=error)
+            metrics.card_finished('retried')
+        else:
+            self._current_attempt(card).update(
+                status=StudentCard.STATUS_FAILED,
+                error=error,
+                finished_at=timezone.now(),
+            )
+            metrics.card_finished(StudentCard.STATUS_FAILED)
+
+
+def get_worker_pool():
+    """Return the worker pool of this process"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = CardJobWorkerPool()
+    return _pool
+
+
+def enqueue_card():
+    """Queue saved pending StudentCards for background processing
+
+    Wakes the worker pool of this process up, starting it first, unless
+    settings.STUDENT_CARD_JOB_START_IN_PROCESS leaves the queue to
+    run_card_workers processes. Pending cards saved in bulk need one call.
+    """
+    if getattr(settings, 'STUDENT_CARD_JOB_START_IN_PROCESS', True):
+        pool = get_worker_pool()
+        pool.start()
+        pool.notify()
@@ -0,0 +1,190 @@
+import json
+import os
+import re
+import threading
+
+from django.conf import settings
+
+from . import metrics
+from .parser import fold, normalize
+
+# Layout files shipped with the app
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'card_layouts')
+
+_layouts = None
+_layouts_lock = threading.Lock()
+
+
+def strip_diacritics(text):
+    """Uppercase ASCII approximation of Vietnamese text, used for fuzzy keyword matching"""
+    return fold(normalize(text)).upper()
+
+
+def crop_relative(image, rect):
+    """Crop a rectangle given as (x, y, width, height) fractions of the image size"""
+    height, width = image.shape[:2]
+    x, y, w, h = rect
+    left, top = int(round(x * width)), int(round(y * height))
+    right, bottom = int(round((x + w) * width)), int(round((y + h) * height))
+    return image[max(top, 0):min(bottom, height), max(left, 0):min(right, width)]
+
+
+def build_config(lang, psm, whitelist=None):
+    """Tesseract config string for one targeted OCR call"""
+    config = f'--oem 3 --psm {psm} -l {lang}'
+    if whitelist:
+        config += f' -c tessedit_char_whitelist={whitelist}'
+    return config
+
+
+class FieldZone:
+    """Where one field sits on the card and how to OCR it"""
+
+    def __init__(self, name, data, lang):
+        self.name = name
+        self.rect = tuple(data['rect'])
+        self.config = build_config(lang, data.get('psm', 7), data.get('whitelist'))
+        pattern = data.get('pattern')
+        self.pattern = re.compile(pattern, re.IGNORECASE) if pattern else None
+
+    def parse(self, text):
+        """Extract the field value from the zone's OCR text, None if it doesn't look valid"""
+        text = ' '.join(text.split())
+        if not text:
+            return None
+        if self.pattern is None:
+            return text
+        match = self.pattern.search(text)
+        return match.group(0).strip() if match else None
+
+
+class CardLayout:
+    """Declarative layout of one institution's card
+
+    Rectangles are fractions of the normalized card, so layouts don't
+    depend on the canonical card size.
+    """
+
+    def __init__(self, data):
+        self.name = data['name']
+        self.version = data.get('version', 1)
+        self.institution = data.get('institution', self.name)
+        self.lang = data.get('lang', 'vie')
+
+        header = data['header']
+        self.header_rect = tuple(header['rect'])
+        self.header_config = build_config(self.lang, header.get('psm', 6))
+        self.header_keywords = [strip_diacritics(keyword) for keyword in header['keywords']]
+        self.min_score = header.get('min_score', 0.5)
+
+        self.fields = [FieldZone(name, zone, self.lang) for name, zone in data['fields'].items()]
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    @property
+    def key(self):
+        return f"{self.name}@{self.version}"
+
+    def match_score(self, header_text):
+        """Fraction of the header keywords found in the header's OCR text"""
+        normalized = strip_diacritics(header_text)
+        found = sum(1 for keyword in self.header_keywords if keyword in normalized)
+        return found / len(self.header_keywords)
+
+
+def load_layouts(directories):
+    """Load every layout file from the given directories"""
+    layouts = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.json'):
+                layouts.append(CardLayout.from_file(os.path.join(directory, filename)))
+    return layouts
+
+
+def get_layouts():
+    """Layouts from the app and settings.STUDENT_CARD_LAYOUT_DIRS, loaded once per process"""
+    global _layouts
+    if _layouts is None:
+        with _layouts_lock:
+            if _layouts is None:
+                directories = [LAYOUT_DIR, *getattr(settings, 'STUDENT_CARD_LAYOUT_DIRS', [])]
+                _layouts = load_layouts(directories)
+    return _layouts
+
+
+class LayoutExtractor:
+    """Reads fields from a normalized card with one small OCR call per field"""
+
+    def __init__(self, layouts=None):
+        self.layouts = get_layouts() if layouts is None else layouts
+
+    @property
+    def key(self):
+        return ','.join(layout.key for layout in self.layouts)
+
+    def match(self, image, engine, executor):
+        """Pick the layout whose header keywords best match the card
+
+        Layouts sharing a header zone and config share one OCR call.
+
+        Returns:
+            The best matching CardLayout, or None
+        """
+        headers = []
+        for layout in self.layouts:
+            header = (layout.header_rect, layout.header_config)
+            if header not in headers:
+                headers.append(header)
+        if not headers:
+            return None
+
+        results = executor.map_ocr(
+            engine,
+            [crop_relative(image, rect) for rect, _ in headers],
+            [config for _, config in headers],
+        )
+        metrics.count('ocr_calls', len(headers))
+        header_texts = {header: text for header, (text, _) in zip(headers, results)}
+
+        best, best_score = None, 0
+        for layout in self.layouts:
+            score = layout.match_score(header_texts[(layout.header_rect, layout.header_config)])
+            if score >= layout.min_score and score > best_score:
+                best, best_score = layout, score
+        return best
+
+    def extract(self, image, layout, engine, executor, fields=None):
+        """OCR the field zones of the layout
+
+        Args:
+            fields: Names of the fields to read, all of the layout's fields by default
+
+        Returns:
+            Dictionary of field name to (value, confidence from 0 to 1) for
+            the fields that were read and looked valid
+        """
+        zones = [
+            zone for zone in layout.fields
+            if (fields is None or zone.name in fields) and crop_relative(image, zone.rect).size > 0
+        ]
+        results = executor.map_ocr(
+            engine,
+            [crop_relative(image, zone.rect) for zone in zones],
+            [zone.config for zone in zones],
+            data=True,
+        )
+        metrics.count('ocr_calls', len(zones))
+
+        found = {}
+        for zone, (lines, _) in zip(zones, results):
+            value = zone.parse(' '.join(text for text, _ in lines))
+            if value:
+                confidence = sum(conf for _, conf in lines) / len(lines)
+                found[zone.name] = (value, min(max(confidence / 100.0, 0.0), 1.0))
+        return found
@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+
+_limiter = None
+_limiter_lock = threading.Lock()
+_local = threading.local()
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Budgets whose violation stops the pipeline early, leaving a partial result
+PARTIAL_BUDGETS = ('deadline',)
+
+
+class CapacityExceeded(Exception):
+    """Raised when every processing slot and queue place is taken"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many cards in progress, retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class ProcessingCancelled(Exception):
+    """Raised inside the pipeline once the request it runs for has gone away"""
+
+
+def check_cancelled():
+    """Stop the card processed in this thread if its request was cancelled
+
+    Called by the pipeline between stages and OCR waves. Costs one
+    attribute lookup when nothing can cancel the work.
+    """
+    event = getattr(_local, 'cancelled', None)
+    if event is not None and event.is_set():
+        raise ProcessingCancelled()
+
+
+def current_rss_bytes():
+    """Resident memory of this process, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_exceeded(max_memory):
+    """Whether this process uses more than max_memory bytes, False without a limit"""
+    if not max_memory:
+        return False
+    rss = current_rss_bytes()
+    return rss is not None and rss > max_memory
+
+
+class CardBudget:
+    """Time budget of the card processed in the current thread
+
+    Exceeding the budget doesn't raise: the pipeline checks budget_exhausted()
+    between stages and OCR waves and returns the fields read so far. Every
+    budget exceeded, including the pixel and region limits enforced by
+    decoding and region detection, is recorded once in ``violations`` and
+    counted in the metrics. Those limits are what bound a card's memory;
+    process memory is shared by every card in flight, so it is only checked
+    when a request is admitted, see ProcessingLimiter.
+    """
+
+    def __init__(self, deadline=None):
+        seconds = getattr(settings, 'STUDENT_CARD_DEADLINE', 20) if deadline is None else deadline
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.violations = []
+
+    def violate(self, budget):
+        if budget not in self.violations:
+            self.violations.append(budget)
+            metrics.budget_violation(budget)
+
+    def exhausted(self):
+        """Check the deadline, recording a violation"""
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.violate('deadline')
+            return True
+        return False
+
+    @property
+    def partial(self):
+        """Whether the pipeline stopped early, so the result must not be reused"""
+        return any(budget in self.violations for budget in PARTIAL_BUDGETS)
+
+
+class _CardBudgetContext:
+    __slots__ = ('deadline', 'budget', 'previous')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'budget', None)
+        self.budget = _local.budget = CardBudget(deadline=self.deadline)
+        return self.budget
+
+    def __exit__(self, *exc_info):
+        _local.budget = self.previous
+
+
+def card_budget(deadline=None):
+    """Enforce a CardBudget on the card processed in this thread
+
+    Args:
+        deadline: Seconds the card may take, settings.STUDENT_CARD_DEADLINE by default
+
+    Returns:
+        Context manager giving the CardBudget
+    """
+    return _CardBudgetContext(deadline)
+
+
+@contextlib.contextmanager
+def cancel_on(event):
+    """Make check_cancelled() raise ProcessingCancelled in this thread once the event is set"""
+    previous = getattr(_local, 'cancelled', None)
+    _local.cancelled = event
+    try:
+        yield
+    finally:
+        _local.cancelled = previous
+
+
+def budget_exhausted():
+    """Whether the card processed in this thread ran out of time"""
+    budget = getattr(_local, 'budget', None)
+    return budget is not None and budget.exhausted()
+
+
+def budget_violation(budget):
+    """Record a budget enforced outside the pipeline checks, e.g. an image downscaled to fit"""
+    current = getattr(_local, 'budget', None)
+    if current is not None:
+        current.violate(budget)
+    else:
+        metrics.budget_violation(budget)
+
+
+def result_is_partial():
+    """Whether the card processed in this thread was stopped early by its budget"""
+    budget = getattr(_local, 'budget', None)
+    return budget is not None and budget.partial
+
+
+class ProcessingLimiter:
+    """Runs card processing on a bounded thread pool with a bounded queue
+
+    At most ``workers`` cards are processed at once and ``max_queued`` more
+    may wait. Anything beyond that, or any request while the process is over
+    settings.STUDENT_CARD_MAX_MEMORY, is rejected right away with
+    CapacityExceeded, so a burst of clients gets a quick 429 instead of
+    piling up blocked threads.
+
+    Job workers and bulk ingestion take the same processing slots through
+    slot(), so together they never process more than ``workers`` cards.
+    """
+
+    def __init__(self, workers=None, max_queued=None, retry_after=None, max_memory=None):
+        self.workers = workers or getattr(settings, 'STUDENT_CARD_MAX_CONCURRENT', None) or os.cpu_count() or 1
+        self.max_queued = getattr(settings, 'STUDENT_CARD_MAX_QUEUED', 16) if max_queued is None else max_queued
+        self.retry_after = retry_after or getattr(settings, 'STUDENT_CARD_RETRY_AFTER', 2)
+        self.max_memory = getattr(settings, 'STUDENT_CARD_MAX_MEMORY', None) if max_memory is None else max_memory
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='card')
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _acquire(self):
+        if memory_exceeded(self.max_memory):
+            metrics.count('rejected_memory')
+            raise CapacityExceeded(self.retry_after)
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queued:
+                metrics.count('rejected')
+                raise CapacityExceeded(self.retry_after)
+            self._in_flight += 1
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _run(self, cancelled, func, args, kwargs):
+        try:
+            with cancel_on(cancelled), self.slot():
+                return func(*args, **kwargs)
+        finally:
+            self._release()
+            close_old_connections()
+
+    def run_on_every_thread(self, func, *args):
+        """Run func once on each processing thread, e.g. to load per-thread OCR state"""
+        from .executors import run_on_every_thread
+
+        run_on_every_thread(self._executor, self.workers, func, *args)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one processing slot, waiting for it, around blocking card processing"""
+        with self._slots:
+            yield
+
+    @contextlib.contextmanager
+    def admitted(self):
+        """Process in the calling thread as if through run(): refused when full, then holding a slot
+
+        Raises:
+            CapacityExceeded: When every slot and queue place is taken
+        """
+        self._acquire()
+        try:
+            with self.slot():
+                yield
+        finally:
+            self._release()
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking function on the pool and wait for it without blocking the event loop
+
+        If the awaiting task is cancelled, e.g. because the client
+        disconnected, queued work is dropped and running work stops at the
+        pipeline's next check_cancelled().
+        """
+        self._acquire()
+        cancelled = threading.Event()
+        try:
+            future = self._executor.submit(self._run, cancelled, func, args, kwargs)
+        except BaseException:
+            self._release()
+            raise
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            cancelled.set()
+            if future.cancel():
+                # Never started, so _run won't release the slot
+                self._release()
+            raise
+
+
+def _in_flight():
+    return {(): _limiter.in_flight if _limiter is not None else 0}
+
+
+metrics.registry.register(metrics.CallbackGauge(
+    'student_card_in_flight', "Cards being processed or queued by the request limiter", [], _in_flight,
+))
+
+
+def get_limiter():
+    """Return the processing limiter of this process"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = ProcessingLimiter()
+    return _limiter
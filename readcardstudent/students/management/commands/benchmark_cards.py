@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from students.benchmark import BenchmarkRunner, compare_reports, generate_synthetic_cards, load_labelled_cards
+from students.executors import create_ocr_executor
+
+
+class Command(BaseCommand):
+    help = "Benchmark the card pipeline on labelled images and check for regressions against a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="Directory of card images with an optional labels.json")
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help="Render this many labelled synthetic cards into path (or a temporary directory) first")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic cards")
+        parser.add_argument('--font', help="TrueType font with Vietnamese glyphs for the synthetic cards")
+        parser.add_argument('--repeat', type=int, default=1, help="Number of times every image is processed")
+        parser.add_argument('--executor', choices=('serial', 'thread', 'process'),
+                            help="OCR executor (default: STUDENT_CARD_OCR_EXECUTOR)")
+        parser.add_argument('--workers', type=int, help="OCR workers (default: STUDENT_CARD_OCR_WORKERS)")
+        parser.add_argument('--no-visualization', action='store_true', help="Skip rendering visualizations")
+        parser.add_argument('--output', help="Write the JSON report to this file")
+        parser.add_argument('--baseline', help="JSON report to compare against, fails on regressions")
+        parser.add_argument('--max-slowdown', type=float, default=0.1,
+                            help="Allowed relative slowdown against the baseline (default: 0.1)")
+        parser.add_argument('--max-accuracy-drop', type=float, default=0.02,
+                            help="Allowed drop of per-field accuracy against the baseline (default: 0.02)")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if options['synthetic']:
+            path = path or tempfile.mkdtemp(prefix='card_benchmark_')
+            generate_synthetic_cards(path, options['synthetic'], options['seed'], options['font'])
+            self.stdout.write(f"Rendered {options['synthetic']} synthetic cards in {path}")
+        if not path or not os.path.isdir(path):
+            raise CommandError("Give a directory of card images or --synthetic N")
+
+        cards = load_labelled_cards(path)
+        if not cards:
+            raise CommandError(f"No card images found in {path}")
+
+        executor = None
+        if options['executor'] or options['workers']:
+            executor = create_ocr_executor(options['executor'], options['workers'])
+
+        runner = BenchmarkRunner(executor=executor, visualize=not options['no_visualization'])
+        report = runner.run(cards, repeat=options['repeat'])
+        if executor is not None:
+            executor.shutdown()
+
+        self.print_summary(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+            regressions = compare_reports(
+                baseline, report, options['max_slowdown'], options['max_accuracy_drop'],
+            )
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f"{len(regressions)} regression(s) against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def print_summary(self, report):
+        self.stdout.write(
+            f"{report['cards']} cards, {report['failed']} failed, "
+            f"{report['throughput']:.2f} cards/s, {report['ocr_calls_per_card']:.1f} OCR calls and "
+            f"{report['variants_per_card']:.1f} preprocessed images per card"
+        )
+        if report['peak_rss_bytes']:
+            self.stdout.write(f"Peak RSS: {report['peak_rss_bytes'] / (1024 * 1024):.1f} MiB")
+        for stage, stats in report['stages'].items():
+            if stats['count']:
+                self.stdout.write(f"  {stage:<14} mean {stats['mean'] * 1000:8.1f} ms  p95 {stats['p95'] * 1000:8.1f} ms")
+        for field, counts in report['accuracy'].items():
+            self.stdout.write(f"  {field:<14} {counts['correct']}/{counts['labelled']} ({counts['accuracy']:.1%})")
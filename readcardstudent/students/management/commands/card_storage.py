@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from students.storage import StorageManager
+
+
+class Command(BaseCommand):
+    help = "Report the space used by card images and their derivatives, and reclaim it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reclaim', action='store_true',
+                            help="Delete orphaned files and apply the visualization cache limits")
+        parser.add_argument('--reencode', action='store_true',
+                            help="Re-encode stored originals with STUDENT_CARD_ORIGINAL_FORMAT")
+        parser.add_argument('--grace', type=int,
+                            help="Seconds a file must be old to count as orphaned (default: STUDENT_CARD_ORPHAN_GRACE)")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted or re-encoded")
+
+    def handle(self, *args, **options):
+        manager = StorageManager(grace=options['grace'])
+
+        for area, usage in manager.report().items():
+            self.stdout.write(
+                f"{area}: {usage['files']} files, {filesizeformat(usage['bytes'])}, "
+                f"{usage['orphans']} orphaned ({filesizeformat(usage['orphan_bytes'])})"
+            )
+
+        dry_run = options['dry_run']
+        verb = "Would free" if dry_run else "Freed"
+        if options['reclaim']:
+            deleted, freed = manager.collect_orphans(dry_run=dry_run)
+            self.stdout.write(self.style.SUCCESS(f"{verb} {filesizeformat(freed)} from {deleted} orphaned files"))
+            if not dry_run:
+                deleted, freed = manager.evict_visualizations()
+                self.stdout.write(self.style.SUCCESS(f"{verb} {filesizeformat(freed)} from {deleted} cached visualizations"))
+        if options['reencode']:
+            converted, freed = manager.reencode_originals(dry_run=dry_run)
+            self.stdout.write(self.style.SUCCESS(f"{verb} {filesizeformat(freed)} by re-encoding {converted} originals"))
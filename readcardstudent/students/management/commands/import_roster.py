@@ -0,0 +1,40 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from students.models import EnrolledStudent
+from students.roster import invalidate_roster
+
+COLUMNS = ('student_id', 'name', 'dob', 'class_name', 'cohort', 'university')
+
+
+class Command(BaseCommand):
+    help = "Create or update enrolled students from a CSV file with a header row"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help=f"CSV file with the columns {', '.join(COLUMNS)} (student_id and name required)")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows per bulk upsert")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                rows = list(csv.DictReader(f))
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        students = {}
+        for line, row in enumerate(rows, start=2):
+            values = {column: (row.get(column) or '').strip() for column in COLUMNS}
+            if not values['student_id'] or not values['name']:
+                raise CommandError(f"Line {line}: student_id and name are required")
+            students[values['student_id']] = EnrolledStudent(**values)
+
+        EnrolledStudent.objects.bulk_create(
+            students.values(),
+            batch_size=options['batch_size'],
+            update_conflicts=True,
+            unique_fields=['student_id'],
+            update_fields=[*COLUMNS[1:], 'updated_at'],
+        )
+        invalidate_roster()
+        self.stdout.write(self.style.SUCCESS(f"Imported {len(students)} students"))
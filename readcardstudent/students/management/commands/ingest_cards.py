@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from students.ingest import BulkIngestor, iter_image_sources
+
+
+class Command(BaseCommand):
+    help = "Process a directory or ZIP archive of student card images and store the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Directory or ZIP archive containing card images")
+        parser.add_argument('--batch-size', type=int, help="Rows per bulk insert (default: STUDENT_CARD_INGEST_BATCH_SIZE)")
+        parser.add_argument('--workers', type=int, help="Images processed in parallel (default: STUDENT_CARD_INGEST_WORKERS)")
+        parser.add_argument('--no-resume', action='store_true', help="Process images again even if they were already ingested")
+
+    def handle(self, *args, **options):
+        try:
+            sources = iter_image_sources(options['path'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        ingestor = BulkIngestor(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            resume=not options['no_resume'],
+            progress=lambda stats: self.stdout.write(str(stats)),
+        )
+        stats = ingestor.ingest(sources)
+        self.stdout.write(self.style.SUCCESS(f"Done: {stats}"))
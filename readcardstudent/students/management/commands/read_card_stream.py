@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from students.stream import StreamReader, iter_video_frames
+
+
+class Command(BaseCommand):
+    help = "Read a student card from a video file, stream URL or camera, OCRing only the best frame of each window"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Video file, stream URL (e.g. MJPEG over HTTP) or camera index")
+        parser.add_argument('--window', type=int, help="Frames per window (default: STUDENT_CARD_STREAM_WINDOW)")
+        parser.add_argument('--min-sharpness', type=float,
+                            help="Sharpness a frame needs to be read (default: STUDENT_CARD_STREAM_MIN_SHARPNESS)")
+        parser.add_argument('--max-frames', type=int, help="Stop after this many frames")
+        parser.add_argument('--until-settled', action='store_true', help="Stop once every field is settled")
+
+    def handle(self, *args, **options):
+        reader = StreamReader(window=options['window'], min_sharpness=options['min_sharpness'])
+        try:
+            frames = iter_video_frames(options['source'], options['max_frames'])
+            for result in reader.run(frames):
+                self.stdout.write(json.dumps(result, ensure_ascii=False))
+                if options['until_settled'] and result['settled']:
+                    break
+        except ValueError as exc:
+            raise CommandError(str(exc))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from students.jobs import CardJobWorkerPool
+
+
+class Command(BaseCommand):
+    help = "Process queued student card uploads in a dedicated worker process"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Number of worker threads (default: STUDENT_CARD_JOB_WORKERS)")
+        parser.add_argument('--timeout', type=int, help="Seconds a job may run (default: STUDENT_CARD_JOB_TIMEOUT)")
+        parser.add_argument('--once', action='store_true', help="Process the jobs currently queued and exit")
+
+    def handle(self, *args, **options):
+        pool = CardJobWorkerPool(workers=options['workers'], timeout=options['timeout'])
+
+        if options['once']:
+            processed = pool.run_pending()
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} job(s)"))
+            return
+
+        self.stdout.write(f"Starting {pool.workers} card worker(s), press CTRL-C to stop")
+        pool.start()
+        try:
+            while pool.running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers...")
+            pool.stop()
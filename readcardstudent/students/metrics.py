@@ -0,0 +1,253 @@
+import threading
+import time
+from contextlib import nullcontext
+
+from django.conf import settings
+
+# Histogram buckets in seconds, from a single small OCR call to a stuck card
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = None
+_local = threading.local()
+_NULL_STAGE = nullcontext()
+
+
+def is_enabled():
+    """Whether settings.STUDENT_CARD_METRICS is on, read once per process"""
+    global _enabled
+    if _enabled is None:
+        _enabled = getattr(settings, 'STUDENT_CARD_METRICS', True)
+    return _enabled
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [*zip(labelnames, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic count, one value per combination of label values"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Label values -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(data)) for key, data in self._values.items()]
+        for key, data in values:
+            for bound, count in zip(self.buckets, data):
+                yield f'{self.name}_bucket', _format_labels(self.labelnames, key, [('le', bound)]), count
+            yield f'{self.name}_bucket', _format_labels(self.labelnames, key, [('le', '+Inf')]), data[-1]
+            yield f'{self.name}_sum', _format_labels(self.labelnames, key), data[-2]
+            yield f'{self.name}_count', _format_labels(self.labelnames, key), data[-1]
+
+
+class CallbackGauge:
+    """Value read when the metrics are scraped, e.g. the queue depth from the database
+
+    The callback returns a dictionary of label value tuples to values.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames, callback):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def samples(self):
+        for key, value in self.callback().items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class MetricsRegistry:
+    """The metrics of this process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    'student_card_stage_seconds', "Time spent in each stage of the card pipeline", ['stage'],
+))
+EVENTS = registry.register(Counter(
+    'student_card_events_total', "Pipeline events such as OCR calls, text regions and cache hits", ['event'],
+))
+CARDS = registry.register(Counter(
+    'student_card_cards_total', "Cards finished, by outcome", ['outcome'],
+))
+BUDGET_VIOLATIONS = registry.register(Counter(
+    'student_card_budget_violations_total', "Cards that exceeded a resource budget, by budget", ['budget'],
+))
+
+
+def _queue_depth():
+    from django.db.models import Count
+
+    from .models import StudentCard
+
+    depth = {(StudentCard.STATUS_PENDING,): 0, (StudentCard.STATUS_PROCESSING,): 0}
+    rows = (
+        StudentCard.objects.filter(status__in=[StudentCard.STATUS_PENDING, StudentCard.STATUS_PROCESSING])
+        .values('status').annotate(count=Count('id'))
+    )
+    for row in rows:
+        depth[(row['status'],)] = row['count']
+    return depth
+
+
+registry.register(CallbackGauge(
+    'student_card_queue_depth', "Cards waiting for or being processed by the job workers", ['status'], _queue_depth,
+))
+
+
+class CardTrace:
+    """Stage timings and event counts of one card, stored on the card for slow request analysis"""
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_count(self, event, amount):
+        self.counts[event] = self.counts.get(event, 0) + amount
+
+    def as_dict(self):
+        return {
+            'stages': {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            **self.counts,
+        }
+
+
+class _CardTraceContext:
+    __slots__ = ('trace', 'previous')
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'trace', None)
+        self.trace = _local.trace = CardTrace()
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        _local.trace = self.previous
+
+
+class _Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(seconds, stage=self.name)
+        trace = getattr(_local, 'trace', None)
+        if trace is not None:
+            trace.add_time(self.name, seconds)
+
+
+def card_trace():
+    """Collect the stages and events of the card processed in this thread
+
+    Returns:
+        Context manager giving the CardTrace, or None when metrics are disabled
+    """
+    if not is_enabled():
+        return _NULL_STAGE
+    return _CardTraceContext()
+
+
+def stage(name):
+    """Time a block as one pipeline stage, a shared no-op when metrics are disabled"""
+    if not is_enabled():
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(event, amount=1):
+    """Count a pipeline event for this process and the card being traced"""
+    if not is_enabled():
+        return
+    EVENTS.inc(amount, event=event)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add_count(event, amount)
+
+
+def card_finished(outcome):
+    """Count a card that finished processing with the given outcome"""
+    if is_enabled():
+        CARDS.inc(outcome=outcome)
+
+
+def budget_violation(budget):
+    """Count a card that exceeded a resource budget, see students.limits.CardBudget"""
+    if is_enabled():
+        BUDGET_VIOLATIONS.inc(budget=budget)
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-17 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OCRPassStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variant', models.CharField(max_length=50)),
+                ('config', models.CharField(max_length=50)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('fields_found', models.PositiveIntegerField(default=0)),
+                ('total_time', models.FloatField(default=0)),
+            ],
+            options={
+                'unique_together': {('variant', 'config')},
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.1 on 2026-10-17 09:30
+
+import uuid
+
+from django.db import migrations, models
+
+
+def gen_job_ids(apps, schema_editor):
+    StudentCard = apps.get_model('students', 'StudentCard')
+    for card in StudentCard.objects.all():
+        card.job_id = uuid.uuid4()
+        card.save(update_fields=['job_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0002_ocrpassstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='job_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, null=True),
+        ),
+        migrations.RunPython(gen_job_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='studentcard',
+            name='job_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        # Cards uploaded before background processing existed were processed synchronously
+        migrations.AddField(
+            model_name='studentcard',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='done', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='studentcard',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='visualization_base',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0003_studentcard_job_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='source',
+            field=models.CharField(blank=True, db_index=True, max_length=500, null=True),
+        ),
+    ]
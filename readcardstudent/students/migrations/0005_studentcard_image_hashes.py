@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-17 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0004_studentcard_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='image_sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='image_phash',
+            field=models.CharField(blank=True, db_index=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='studentcard',
+            name='processor_version',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-17 11:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0005_studentcard_image_hashes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='studentcard',
+            name='visualization_base',
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-17 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0006_remove_studentcard_visualization_base'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='thumbnail',
+            field=models.ImageField(blank=True, null=True, upload_to='thumbnails/'),
+        ),
+        migrations.AddIndex(
+            model_name='studentcard',
+            index=models.Index(fields=['-uploaded_at', '-id'], name='card_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentcard',
+            index=models.Index(fields=['student_id'], name='card_student_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentcard',
+            index=models.Index(fields=['name'], name='card_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentcard',
+            index=models.Index(fields=['university'], name='card_university_idx'),
+        ),
+    ]
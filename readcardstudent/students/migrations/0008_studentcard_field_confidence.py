@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0007_studentcard_thumbnail_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='field_confidence',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0008_studentcard_field_confidence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='timings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
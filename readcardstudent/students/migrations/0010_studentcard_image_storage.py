@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:20
+
+import students.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0009_studentcard_timings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='studentcard',
+            name='image',
+            field=models.ImageField(storage=students.models.card_image_storage, upload_to='student_cards/'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.1 on 2026-10-17 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0010_studentcard_image_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnrolledStudent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('student_id', models.CharField(max_length=50, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('dob', models.CharField(blank=True, default='', max_length=50)),
+                ('class_name', models.CharField(blank=True, default='', max_length=50)),
+                ('cohort', models.CharField(blank=True, default='', max_length=50)),
+                ('university', models.CharField(blank=True, default='', max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0011_enrolledstudent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='budget_violations',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
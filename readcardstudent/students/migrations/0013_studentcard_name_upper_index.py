@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:20
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0012_studentcard_budget_violations'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='studentcard',
+            name='card_name_idx',
+        ),
+        migrations.AddIndex(
+            model_name='studentcard',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='card_name_upper_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0013_studentcard_name_upper_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentcard',
+            name='batch_id',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,8 +1,35 @@
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import storages
 from django.db import models
+from django.db.models.functions import Upper
+from django.urls import reverse
+
+
+def card_image_storage():
+    """Storage of the original card images, selected by settings.STUDENT_CARD_IMAGE_STORAGE"""
+    return storages[getattr(settings, 'STUDENT_CARD_IMAGE_STORAGE', 'default')]
+
 
 # Create your models here.
 class StudentCard(models.Model):
-    image = models.ImageField(upload_to='student_cards/')
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    VISUALIZATION_KINDS = ('original', 'processed', 'regions', 'combined')
+    
+    image = models.ImageField(upload_to='student_cards/', storage=card_image_storage)
+    # Small JPEG shown in listings instead of the original
+    thumbnail = models.ImageField(upload_to='thumbnails/', null=True, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     university = models.CharField(max_length=255, null=True, blank=True)
     student_card_type = models.CharField(max_length=255, null=True, blank=True)
@@ -11,6 +38,82 @@ class StudentCard(models.Model):
     student_id = models.CharField(max_length=50, null=True, blank=True)
     class_name = models.CharField(max_length=50, null=True, blank=True)
     cohort = models.CharField(max_length=50, null=True, blank=True)
+    # OCR confidence (0-1) of each extracted value, keyed by processor field name
+    field_confidence = models.JSONField(default=dict, blank=True)
+    
+    # Background processing state
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    # Image content hashes for deduplication and result caching
+    image_sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    image_phash = models.CharField(max_length=16, null=True, blank=True, db_index=True)
+    # StudentCardProcessor.version that produced the extracted fields
+    processor_version = models.CharField(max_length=32, null=True, blank=True)
+    # Stage timings and event counts of the run that produced the fields, see students.metrics
+    timings = models.JSONField(default=dict, blank=True)
+    # Resource budgets the card exceeded, e.g. 'pixels' or 'deadline', see students.limits.CardBudget
+    budget_violations = models.JSONField(default=list, blank=True)
+    
+    # Where a bulk ingested card came from (file path or archive member), used to resume imports
+    source = models.CharField(max_length=500, null=True, blank=True, db_index=True)
+    # Bulk upload the card was queued with, see views.bulk_status
+    batch_id = models.UUIDField(null=True, blank=True, db_index=True)
+    
+    class Meta:
+        indexes = [
+            # Keyset pagination of the card list, newest first
+            models.Index(fields=['-uploaded_at', '-id'], name='card_uploaded_idx'),
+            models.Index(fields=['student_id'], name='card_student_id_idx'),
+            # Case-insensitive name prefix search, see views.search_cards
+            models.Index(Upper('name'), name='card_name_upper_idx'),
+            models.Index(fields=['university'], name='card_university_idx'),
+        ]
     
     def __str__(self):
-        return f"StudentCard {self.id} - {self.name or 'Unknown'}"
\ No newline at end of file
+        return f"StudentCard {self.id} - {self.name or 'Unknown'}"
+    
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+    
+    def visualization_urls(self):
+        """URLs of the visualizations, rendered on first request"""
+        if not self.image:
+            return None
+        return {
+            kind: reverse('card_visualization', args=[self.id, kind])
+            for kind in self.VISUALIZATION_KINDS
+        }
+
+class OCRPassStat(models.Model):
+    """How productive each preprocessing variant / OCR config pass has been"""
+    variant = models.CharField(max_length=50)
+    config = models.CharField(max_length=50)
+    attempts = models.PositiveIntegerField(default=0)
+    fields_found = models.PositiveIntegerField(default=0)
+    total_time = models.FloatField(default=0)  # Seconds spent in OCR for this pass
+
+    class Meta:
+        unique_together = ('variant', 'config')
+
+    def __str__(self):
+        return f"{self.variant}/{self.config}: {self.fields_found} fields in {self.attempts} passes"
+
+
+class EnrolledStudent(models.Model):
+    """A student of the roster that scanned cards are verified against, see students.roster"""
+    student_id = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=255)
+    dob = models.CharField(max_length=50, blank=True, default='')  # DD/MM/YYYY, as printed on the card
+    class_name = models.CharField(max_length=50, blank=True, default='')
+    cohort = models.CharField(max_length=50, blank=True, default='')
+    university = models.CharField(max_length=255, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.student_id} - {self.name}"
@@ -0,0 +1,232 @@
+import logging
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Registry of available OCR backends, filled in at the bottom of the module
+ENGINES = {}
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def parse_tesseract_config(config):
+    """Split a pytesseract style config string into its parts
+
+    Returns:
+        Tuple of (lang, oem, psm, variables) where variables is a dict
+        of the ``-c name=value`` options.
+    """
+    lang = 'eng'
+    oem = 3
+    psm = 3
+    variables = {}
+
+    tokens = config.split() if config else []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        value = tokens[i + 1] if i + 1 < len(tokens) else None
+        if token == '-l' and value is not None:
+            lang = value
+            i += 1
+        elif token == '--oem' and value is not None:
+            oem = int(value)
+            i += 1
+        elif token == '--psm' and value is not None:
+            psm = int(value)
+            i += 1
+        elif token == '-c' and value is not None:
+            name, _, var_value = value.partition('=')
+            variables[name] = var_value
+            i += 1
+        i += 1
+
+    return lang, oem, psm, variables
+
+
+class OCREngine:
+    """Base class for OCR backends used by StudentCardProcessor"""
+    name = None
+
+    def image_to_string(self, image, config=''):
+        """Recognize the text in a numpy image using a tesseract config string"""
+        raise NotImplementedError
+
+    def image_to_data(self, image, config=''):
+        """Recognize text lines with their confidence
+
+        Returns:
+            List of (line text, confidence) with confidence between 0 and 100
+        """
+        raise NotImplementedError
+
+    def preload(self, configs):
+        """Load what the given tesseract configs need before the first image arrives"""
+
+
+class PytesseractEngine(OCREngine):
+    """Runs the tesseract binary once per call through pytesseract"""
+    name = 'pytesseract'
+
+    def __init__(self):
+        import pytesseract
+        self._pytesseract = pytesseract
+
+        # Configure pytesseract path if running on Windows
+        tesseract_cmd = getattr(settings, 'STUDENT_CARD_TESSERACT_CMD', None)
+        if tesseract_cmd:
+            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+    def image_to_string(self, image, config=''):
+        return self._pytesseract.image_to_string(image, config=config)
+
+    def image_to_data(self, image, config=''):
+        data = self._pytesseract.image_to_data(
+            image, config=config, output_type=self._pytesseract.Output.DICT
+        )
+
+        # Group the words into lines, averaging the word confidences
+        lines = {}
+        for i, word in enumerate(data['text']):
+            conf = float(data['conf'][i])
+            if not word.strip() or conf < 0:
+                continue
+            key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            words, confs = lines.setdefault(key, ([], []))
+            words.append(word)
+            confs.append(conf)
+
+        return [(' '.join(words), sum(confs) / len(confs)) for words, confs in lines.values()]
+
+
+class TesserocrEngine(OCREngine):
+    """Keeps one Tesseract API per thread and language loaded for the whole process
+
+    The language model is only read the first time a (lang, oem) pair is
+    used, and images are handed over as raw pixel buffers instead of being
+    written to a temporary file for a new tesseract process.
+    """
+    name = 'tesserocr'
+
+    def __init__(self):
+        import tesserocr
+        self._tesserocr = tesserocr
+        self._tessdata_path = getattr(settings, 'STUDENT_CARD_TESSDATA_PATH', None)
+        # tesserocr's API objects are not thread safe, so each thread gets its own
+        self._local = threading.local()
+
+    def _get_api(self, lang, oem):
+        apis = getattr(self._local, 'apis', None)
+        if apis is None:
+            apis = self._local.apis = {}
+
+        api = apis.get((lang, oem))
+        if api is None:
+            kwargs = {'lang': lang, 'oem': oem}
+            if self._tessdata_path:
+                kwargs['path'] = self._tessdata_path
+            api = self._tesserocr.PyTessBaseAPI(**kwargs)
+            apis[(lang, oem)] = api
+        return api
+
+    def preload(self, configs):
+        # Loads the calling thread's APIs, OCR executors call it on each of their threads
+        for lang, oem in {parse_tesseract_config(config)[:2] for config in configs}:
+            self._get_api(lang, oem)
+
+    def _set_image(self, api, image):
+        """Pass a numpy image to tesseract without encoding it to a file"""
+        if image.ndim == 3:
+            # OpenCV images are BGR, tesseract expects RGB
+            image = image[:, :, ::-1]
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+
+        height, width = image.shape[:2]
+        bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+        api.SetImageBytes(image.tobytes(), width, height,
+                          bytes_per_pixel, width * bytes_per_pixel)
+
+    def _recognize(self, image, config, read):
+        """Run tesseract on an image with per-call options and return read(api)"""
+        lang, oem, psm, variables = parse_tesseract_config(config)
+        api = self._get_api(lang, oem)
+
+        # Remember the previous values so per-call options don't leak into later calls
+        previous = {name: api.GetVariableAsString(name) for name in variables}
+        try:
+            api.SetPageSegMode(psm)
+            for name, value in variables.items():
+                api.SetVariable(name, value)
+            self._set_image(api, image)
+            return read(api)
+        finally:
+            for name, value in previous.items():
+                api.SetVariable(name, value or '')
+            api.Clear()
+
+    def image_to_string(self, image, config=''):
+        return self._recognize(image, config, lambda api: api.GetUTF8Text())
+
+    def image_to_data(self, image, config=''):
+        tesserocr = self._tesserocr
+
+        def read_lines(api):
+            api.Recognize()
+            lines = []
+            level = tesserocr.RIL.TEXTLINE
+            for line in tesserocr.iterate_level(api.GetIterator(), level):
+                text = line.GetUTF8Text(level)
+                if text and text.strip():
+                    lines.append((text.strip(), line.Confidence(level)))
+            return lines
+
+        return self._recognize(image, config, read_lines)
+
+
+ENGINES[PytesseractEngine.name] = PytesseractEngine
+ENGINES[TesserocrEngine.name] = TesserocrEngine
+
+
+def limit_tesseract_threads():
+    """Cap tesseract's internal OpenMP threads
+
+    OCR passes are already run in parallel by the OCR executor, letting
+    tesseract start its own threads on top of that oversubscribes the CPU.
+    Must run before the tesseract library is loaded or the binary is started.
+    """
+    threads = getattr(settings, 'STUDENT_CARD_TESSERACT_THREADS', 1)
+    if threads:
+        os.environ.setdefault('OMP_THREAD_LIMIT', str(threads))
+
+
+def create_ocr_engine(name=None):
+    """Create the OCR engine selected in settings, falling back to pytesseract"""
+    limit_tesseract_threads()
+
+    name = name or getattr(settings, 'STUDENT_CARD_OCR_ENGINE', PytesseractEngine.name)
+    engine_class = ENGINES.get(name)
+    if engine_class is None:
+        raise ValueError(f"Unknown OCR engine: {name!r}")
+
+    try:
+        return engine_class()
+    except ImportError:
+        if engine_class is PytesseractEngine:
+            raise
+        logger.warning("OCR engine %r is not installed, falling back to pytesseract", name)
+        return PytesseractEngine()
+
+
+def get_ocr_engine():
+    """Return the OCR engine shared by the whole process"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_ocr_engine()
+    return _engine
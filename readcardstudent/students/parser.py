@@ -0,0 +1,230 @@
+import re
+import unicodedata
+
+FIELDS = ('university', 'student_card', 'name', 'dob', 'student_id', 'class', 'cohort')
+
+
+def _build_fold_table():
+    """Map every precomposed Latin letter to its base letter, keeping case"""
+    table = {ord('đ'): 'd', ord('Đ'): 'D'}
+    for code in list(range(0x00C0, 0x0250)) + list(range(0x1E00, 0x1F00)):
+        char = chr(code)
+        base = unicodedata.normalize('NFD', char)[0]
+        if base != char and base.isascii():
+            table[code] = base
+    return table
+
+
+_FOLD_TABLE = _build_fold_table()
+
+
+def normalize(text):
+    """Compose characters so each accented letter is a single code point"""
+    return unicodedata.normalize('NFC', text)
+
+
+def fold(text):
+    """Remove Vietnamese diacritics from NFC text
+
+    The result has the same length as the input, so match positions in
+    the folded text are valid in the original.
+    """
+    return text.translate(_FOLD_TABLE)
+
+
+class Line:
+    """One line of OCR output and where it came from"""
+    __slots__ = ('text', 'folded', 'source')
+
+    def __init__(self, text, source=None):
+        self.text = text
+        self.folded = fold(text)
+        # Free-form description of the pass, e.g. (variant, config, confidence)
+        self.source = source
+
+    @property
+    def words(self):
+        return self.text.split()
+
+
+def tokenize(text, source=None):
+    """Split OCR text into non-empty normalized lines"""
+    return [Line(line, source) for line in normalize(text).splitlines() if line.strip()]
+
+
+def tokenize_data(lines):
+    """Lines from word-level OCR output, each with its confidence as source
+
+    Args:
+        lines: List of (line text, confidence from 0 to 100)
+
+    Returns:
+        Lines whose source is the confidence scaled to 0-1
+    """
+    return [
+        Line(normalize(text), min(max(confidence / 100.0, 0.0), 1.0))
+        for text, confidence in lines if text.strip()
+    ]
+
+
+class Rule:
+    """A compiled pattern and how to take the field value from its match
+
+    Args:
+        pattern: Regular expression
+        folded: Match against the diacritic-free text instead of the original
+        group: Group holding the value, taken from the original text
+        flags: Regular expression flags
+    """
+    __slots__ = ('regex', 'folded', 'group')
+
+    def __init__(self, pattern, folded=True, group=0, flags=0):
+        self.regex = re.compile(pattern, flags)
+        self.folded = folded
+        self.group = group
+
+    def search(self, line):
+        match = self.regex.search(line.folded if self.folded else line.text)
+        if match is None:
+            return None
+        start, end = match.span(self.group)
+        return line.text[start:end].strip() or None
+
+
+_VI_UPPER = 'A-ZÀÁÂÃÈÉÊÌÍÒÓÔÕÙÚĂĐĨŨƠƯẠẢẤẦẨẪẬẮẰẲẴẶẸẺẼỀỂỄỆỈỊỌỎỐỒỔỖỘỚỜỞỠỢỤỦỨỪỮỰỲỴỶỸ'
+_VI_LOWER = 'a-zàáâãèéêìíòóôõùúăđĩũơưạảấầẩẫậắằẳẵặẹẻẽềểễệỉịọỏốồổỗộớờởỡợụủứừữựỳỵỷỹ'
+
+# Rules per field, most specific first. A field takes the first line matched
+# by its most specific rule that matches anywhere in the text.
+FIELD_RULES = {
+    # Dong A University in various formats
+    'university': [
+        Rule(r'DAI HOC DONG A|DONG A UNIVERSITY', flags=re.IGNORECASE),
+        Rule(r'DONG A', flags=re.IGNORECASE),
+    ],
+    # Student card in various formats
+    'student_card': [
+        Rule(r'THE SINH VIEN|STUDENT CARD', flags=re.IGNORECASE),
+        Rule(r'THE\s+SINH\s+VIEN', flags=re.IGNORECASE),
+    ],
+    # The line after the card type is handled by the parser itself, these
+    # look for Vietnamese names (with or without diacritics) anywhere
+    'name': [
+        Rule(
+            rf'[{_VI_UPPER}][{_VI_LOWER} ]+\s+[{_VI_UPPER}][{_VI_LOWER} ]+',
+            folded=False, flags=re.IGNORECASE,
+        ),
+        Rule(r'[A-Z][a-z]+\s+[A-Z][a-z]+\s+[A-Z][a-z]+', folded=False, flags=re.IGNORECASE),
+    ],
+    'dob': [
+        Rule(r'(?:Ngay sinh|DOB)\s*:\s*(\d{2}/\d{2}/\d{4})', group=1),
+        Rule(r'(\d{2}/\d{2}/\d{4})', group=1),
+    ],
+    # Student ID is 5-6 digits, labelled IDs are matched by this too
+    'student_id': [
+        Rule(r'(?<!\d)(\d{5,6})(?!\d)', group=1),
+    ],
+    'class': [
+        Rule(r'(?:Lop|Class)\s*:\s*([A-Z0-9]+)', group=1),
+    ],
+    'cohort': [
+        Rule(r'(?:Khoa|Course)\s*:\s*(\d{4}\s*-\s*\d{4})', group=1),
+    ],
+}
+
+# The name is printed on the line after "THẺ SINH VIÊN" and beats the name rules
+_CARD_LINE = re.compile(r'THE SINH VIEN', re.IGNORECASE)
+_NAME_AFTER_CARD = -1
+
+
+class ParseResult:
+    """Parsed field values with the line source each value came from"""
+
+    def __init__(self):
+        self._best = {}
+
+    def offer(self, field, priority, value, source):
+        """Keep the value unless the field already has one from a more specific rule"""
+        current = self._best.get(field)
+        if current is None or priority < current[0]:
+            self._best[field] = (priority, value, source)
+
+    def priority(self, field):
+        current = self._best.get(field)
+        return current[0] if current else None
+
+    @property
+    def fields(self):
+        return {field: value for field, (_, value, _) in self._best.items()}
+
+    @property
+    def sources(self):
+        return {field: source for field, (_, _, source) in self._best.items()}
+
+    def __contains__(self, field):
+        return field in self._best
+
+
+class FieldParser:
+    """Fills every field in a single pass over the lines of OCR output
+
+    Has no OCR or Django dependencies, so it can be tested and benchmarked
+    on plain strings.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = FIELD_RULES if rules is None else rules
+        # Priority at which a field can't be improved any more
+        self.best_priority = {
+            field: (_NAME_AFTER_CARD if field == 'name' else 0) for field in self.rules
+        }
+
+    def parse_lines(self, lines, result=None):
+        """Parse tokenized lines, updating and returning a ParseResult"""
+        result = result or ParseResult()
+        after_card = False
+
+        for line in lines:
+            if after_card and 'name' in self.rules:
+                value = line.text.split(':', 1)[0].strip()
+                if value:
+                    result.offer('name', _NAME_AFTER_CARD, value, line.source)
+
+            for field, rules in self.rules.items():
+                current = result.priority(field)
+                if current == self.best_priority[field]:
+                    continue
+                for priority, rule in enumerate(rules):
+                    if current is not None and priority >= current:
+                        break
+                    value = rule.search(line)
+                    if value:
+                        result.offer(field, priority, value, line.source)
+                        break
+
+            after_card = _CARD_LINE.search(line.folded) is not None
+
+        return result
+
+    def parse(self, text, source=None, result=None):
+        """Parse one block of OCR text"""
+        return self.parse_lines(tokenize(text, source), result)
+
+    def parse_many(self, chunks):
+        """Parse several (text, source) OCR results as one stream"""
+        result = ParseResult()
+        for text, source in chunks:
+            self.parse(text, source, result)
+        return result
+
+
+default_parser = FieldParser()
+
+
+def parse_fields(text):
+    """Parse OCR text with the default rules
+
+    Returns:
+        Dictionary with the fields that were found
+    """
+    return default_parser.parse(text).fields
@@ -0,0 +1,97 @@
+import cv2
+
+# Variants that are mathematically identical to another variant. Closing and
+# opening with a 1x1 kernel leave the image unchanged, so 'morph' is 'otsu'.
+ALIASES = {'morph': 'otsu'}
+
+
+def _gray(graph):
+    image = graph.image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def _otsu_threshold(image):
+    _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binary
+
+
+def _adaptive(graph):
+    return cv2.adaptiveThreshold(graph['gray'], 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+
+
+def _otsu(graph):
+    return _otsu_threshold(graph['gray'])
+
+
+def _inverted(graph):
+    # THRESH_BINARY_INV with Otsu picks the same threshold, so this is the inverted Otsu image
+    return cv2.bitwise_not(graph['otsu'])
+
+
+def _equalized(graph):
+    return _otsu_threshold(cv2.equalizeHist(graph['gray']))
+
+
+def _bilateral(graph):
+    return _otsu_threshold(cv2.bilateralFilter(graph['gray'], 9, 75, 75))
+
+
+def _edge(graph):
+    # Dilating with a 1x1 kernel is a no-op, the Canny edges are the mask as they are
+    gray = graph['gray']
+    edges = cv2.Canny(gray, 100, 200)
+    return _otsu_threshold(cv2.bitwise_and(gray, gray, mask=edges))
+
+
+# How to compute each intermediate from the ones it depends on
+NODES = {
+    'gray': _gray,
+    'adaptive': _adaptive,
+    'otsu': _otsu,
+    'otsu_inv': _inverted,
+    'equalized': _equalized,
+    'bilateral': _bilateral,
+    'edge': _edge,
+}
+
+
+class PreprocessingGraph:
+    """Preprocessed versions of one card image, computed on first use
+
+    Shared intermediates such as the grayscale and Otsu images are computed
+    once, variants that are never asked for are never built, and aliased
+    variants share the same array instead of a copy.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._results = {}
+
+    def __getitem__(self, name):
+        name = ALIASES.get(name, name)
+        result = self._results.get(name)
+        if result is None:
+            result = self._results[name] = NODES[name](self)
+        return result
+
+    @property
+    def built(self):
+        """Names of the images computed so far, shared intermediates included"""
+        return tuple(self._results)
+
+    def variants(self, methods):
+        """Yield (method, image) lazily, skipping methods identical to an earlier one"""
+        for method in distinct_methods(methods):
+            yield method, self[method]
+
+
+def distinct_methods(methods):
+    """The methods left once aliases of earlier methods are removed"""
+    seen = set()
+    result = []
+    for method in methods:
+        key = ALIASES.get(method, method)
+        if key not in seen:
+            seen.add(key)
+            result.append(method)
+    return tuple(result)
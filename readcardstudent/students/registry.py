@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+
+_processor = None
+_processor_lock = threading.Lock()
+_preload_disabled = False
+
+# Management commands that process cards, every other command skips preloading
+SERVING_COMMANDS = ('runserver', 'run_card_workers', 'ingest_cards')
+
+# Programs that run Django management commands
+MANAGEMENT_PROGRAMS = ('manage.py', 'django-admin', 'django-admin.py')
+
+# WSGI/ASGI servers, started as a program or with python -m
+SERVER_PROGRAMS = ('gunicorn', 'uvicorn', 'daphne', 'hypercorn', 'uwsgi')
+
+# Environment variable that makes any other process preload, set to 1
+PRELOAD_ENV = 'STUDENT_CARD_PRELOAD_PROCESS'
+
+
+def get_processor():
+    """Return the StudentCardProcessor shared by every request and job of this process
+
+    OpenCV and the OCR engine are imported on first use, so processes that
+    never handle a card don't load them.
+    """
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                from .utils import StudentCardProcessor
+                _processor = StudentCardProcessor()
+    return _processor
+
+
+def disable_preload():
+    """Never preload in this process, e.g. in OCR worker processes that set Django up"""
+    global _preload_disabled
+    _preload_disabled = True
+
+
+def serving_process(argv=None):
+    """Whether this process serves cards and should preload the processor
+
+    Only the card processing management commands, the WSGI/ASGI servers of
+    SERVER_PROGRAMS and processes started with PRELOAD_ENV=1 do. Tests,
+    other commands, scripts and OCR worker processes don't.
+    """
+    if _preload_disabled:
+        return False
+    if os.environ.get(PRELOAD_ENV) == '1':
+        return True
+    argv = sys.argv if argv is None else argv
+    if not argv:
+        return False
+    program = os.path.basename(argv[0])
+    if program == '__main__.py':
+        # python -m <package>
+        program = os.path.basename(os.path.dirname(argv[0]))
+    if program in MANAGEMENT_PROGRAMS:
+        if len(argv) < 2:
+            return False
+        if argv[1] == 'runserver':
+            # The autoreloader's parent process only watches files
+            return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in argv
+        return argv[1] in SERVING_COMMANDS
+    return program in SERVER_PROGRAMS
+
+
+def preload(warm_up=False):
+    """Build the shared processor and load the OCR language data up front
+
+    Args:
+        warm_up: Also run every pipeline stage once on a synthetic card
+
+    Returns:
+        The shared StudentCardProcessor
+    """
+    processor = get_processor()
+    # OCR runs on the executor's threads or processes, each needs its own engine state
+    processor.executor.preload(processor.engine, processor.ocr_configs.values())
+    if warm_up:
+        processor.warm_up()
+    return processor
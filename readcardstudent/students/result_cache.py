@@ -0,0 +1,129 @@
+import hashlib
+import threading
+
+import cv2
+from django.conf import settings
+
+from . import metrics
+from .models import StudentCard
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def image_digest(data):
+    """SHA-256 of the raw image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(uploaded_file):
+    """SHA-256 of an uploaded file, read in chunks and rewound afterwards"""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def perceptual_hash(image):
+    """64 bit difference hash (dHash) of an image as 16 hex characters
+
+    Re-encoded or slightly resized copies of the same photo get the same hash.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+
+def find_stored_image(digest):
+    """Name of an already stored file with the same content, to avoid storing a copy"""
+    return (
+        StudentCard.objects.filter(image_sha256=digest)
+        .exclude(image='')
+        .values_list('image', flat=True)
+        .first()
+    )
+
+
+class ResultCache:
+    """Looks up OCR results of cards already processed from the same image
+
+    Results are only reused when they were produced by the current
+    processor version, so changing the pipeline or its configuration
+    invalidates every cached entry.
+    """
+
+    def __init__(self, enabled=None, use_phash=None):
+        self.enabled = getattr(settings, 'STUDENT_CARD_RESULT_CACHE', True) if enabled is None else enabled
+        self.use_phash = getattr(settings, 'STUDENT_CARD_PHASH_DEDUP', False) if use_phash is None else use_phash
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def phash(self, image):
+        """Perceptual hash of a decoded image, None without near-duplicate lookups"""
+        return perceptual_hash(image) if self.enabled and self.use_phash else None
+
+    def lookup(self, processor_version, digest, phash=None, exclude_id=None, confirm=None):
+        """Find a processed card with the same image
+
+        Args:
+            confirm: Called with a card found only by perceptual hash, which
+                is reused only if this returns True. Cards of the same
+                template with similar photos can share a hash, so without
+                it near-duplicates are never reused.
+
+        Only lookups that ran are counted as a hit or a miss, a disabled
+        cache counts nothing.
+
+        Returns:
+            The matching StudentCard, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        cards = StudentCard.objects.filter(
+            status=StudentCard.STATUS_DONE,
+            processor_version=processor_version,
+        )
+        if exclude_id is not None:
+            cards = cards.exclude(id=exclude_id)
+
+        card = cards.filter(image_sha256=digest).order_by('-id').first() if digest else None
+        if card is None and phash and self.use_phash and confirm is not None:
+            # Near-duplicate: a re-encoded or resized copy of the same photo, or another card
+            candidate = cards.filter(image_phash=phash).order_by('-id').first()
+            if candidate is not None and confirm(candidate):
+                card = candidate
+
+        with self._lock:
+            if card is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.count('cache_misses' if card is None else 'cache_hits')
+        return card
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else None,
+            }
+
+
+def get_result_cache():
+    """Return the result cache of this process"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache()
+    return _cache
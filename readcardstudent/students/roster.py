@@ -0,0 +1,238 @@
+import difflib
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+from .layouts import strip_diacritics
+from .models import EnrolledStudent
+
+_roster = None
+_roster_lock = threading.Lock()
+
+# Card fields read in verification mode, each from its own layout zone
+VERIFY_FIELDS = ('student_id', 'name', 'dob')
+
+
+def normalize_name(name):
+    """Uppercase ASCII name with single spaces, for fuzzy comparison"""
+    return ' '.join(strip_diacritics(name or '').split())
+
+
+def normalize_dob(dob):
+    """Digits of a date of birth, so 01/02/2003 and 01-02-2003 compare equal"""
+    return re.sub(r'\D', '', dob or '')
+
+
+def name_similarity(name, other):
+    """Similarity of two normalized names from 0 to 1"""
+    if not name or not other:
+        return 0.0
+    return difflib.SequenceMatcher(None, name, other).ratio()
+
+
+class RosterEntry:
+    """One enrolled student, with the normalized values cards are compared with"""
+    __slots__ = ('student_id', 'name', 'dob', 'class_name', 'cohort', 'university', 'normalized_name', 'normalized_dob')
+
+    def __init__(self, student_id, name, dob='', class_name='', cohort='', university=''):
+        self.student_id = student_id
+        self.name = name
+        self.dob = dob
+        self.class_name = class_name
+        self.cohort = cohort
+        self.university = university
+        self.normalized_name = normalize_name(name)
+        self.normalized_dob = normalize_dob(dob)
+
+    def as_dict(self):
+        return {
+            'student_id': self.student_id,
+            'name': self.name,
+            'dob': self.dob or None,
+            'class': self.class_name or None,
+            'cohort': self.cohort or None,
+            'university': self.university or None,
+        }
+
+
+class RosterMatch:
+    """An enrolled student confirmed by the fields read from a card"""
+
+    def __init__(self, entry, exact_id, name_score, dob_match):
+        self.entry = entry
+        # False when the ID read from the card was one digit off
+        self.exact_id = exact_id
+        self.name_score = name_score
+        # None when the card or the roster has no date of birth
+        self.dob_match = dob_match
+
+    def as_dict(self):
+        return {
+            **self.entry.as_dict(),
+            'exact_id': self.exact_id,
+            'name_score': round(self.name_score, 3),
+            'dob_match': self.dob_match,
+        }
+
+
+class RosterIndex:
+    """In-memory index of the enrolled students by student ID
+
+    Each ID is also indexed under its one-digit wildcards ('12?45'), so an ID
+    with one misread digit still finds its student without scanning the
+    roster. Names and dates of birth are normalized once, when the index is built.
+    """
+
+    def __init__(self, entries, name_threshold=None):
+        self.name_threshold = (
+            getattr(settings, 'STUDENT_CARD_ROSTER_NAME_THRESHOLD', 0.8) if name_threshold is None else name_threshold
+        )
+        self.entries = {entry.student_id: entry for entry in entries}
+        self._near = {}
+        for student_id in self.entries:
+            for key in self._wildcards(student_id):
+                self._near.setdefault(key, []).append(student_id)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def from_db(cls):
+        rows = EnrolledStudent.objects.values_list('student_id', 'name', 'dob', 'class_name', 'cohort', 'university')
+        return cls(RosterEntry(*row) for row in rows.iterator())
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _wildcards(student_id):
+        return [f"{student_id[:i]}?{student_id[i + 1:]}" for i in range(len(student_id))]
+
+    def candidates(self, student_id):
+        """Entries with the given ID first, then the ones whose ID differs in one digit
+
+        Returns:
+            List of (entry, exact) tuples
+        """
+        if not student_id:
+            return []
+        found = []
+        exact = self.entries.get(student_id)
+        if exact is not None:
+            found.append((exact, True))
+        seen = {student_id}
+        for key in self._wildcards(student_id):
+            for other in self._near.get(key, ()):
+                if other not in seen:
+                    seen.add(other)
+                    found.append((self.entries[other], False))
+        return found
+
+    def match(self, student_id, name=None, dob=None):
+        """Find the enrolled student a card belongs to
+
+        A candidate is confirmed when the name is similar enough and the date
+        of birth doesn't contradict it. When the ID was one digit off, the date
+        of birth must match as well.
+
+        Returns:
+            The best RosterMatch, or None if no candidate is confirmed
+        """
+        name = normalize_name(name)
+        dob = normalize_dob(dob)
+        best = None
+        for entry, exact in self.candidates(student_id):
+            dob_match = (dob == entry.normalized_dob) if dob and entry.normalized_dob else None
+            if dob_match is False or (not exact and not dob_match):
+                continue
+            score = name_similarity(name, entry.normalized_name)
+            if score < self.name_threshold:
+                continue
+            if best is None or (exact, score) > (best.exact_id, best.name_score):
+                best = RosterMatch(entry, exact, score, dob_match)
+        return best
+
+
+class RosterVerifier:
+    """Identifies the enrolled student of a card from its ID, name and DOB zones only
+
+    Needs a processor with card layouts. The three zones are read in one
+    wave of small OCR calls, instead of the full-card passes of
+    extract_card_info, and checked against the roster.
+    """
+
+    def __init__(self, processor, roster=None):
+        self.processor = processor
+        self.roster = roster
+
+    def layout_for(self, image):
+        """The card's layout, without a header OCR call when only one layout is loaded"""
+        extractor = self.processor.layouts
+        if extractor is None:
+            return None
+        layout = extractor.layouts[0] if len(extractor.layouts) == 1 else extractor.match(
+            image, self.processor.engine, self.processor.executor)
+        if layout is None or 'student_id' not in {zone.name for zone in layout.fields}:
+            return None
+        return layout
+
+    def read_fields(self, image, fields=VERIFY_FIELDS):
+        """Read the verification fields of a normalized card
+
+        Args:
+            fields: Names of the fields to read
+
+        Returns:
+            Dictionary of field name to (value, confidence), empty when the
+            card has no known layout
+        """
+        with metrics.stage('layout'):
+            layout = self.layout_for(image)
+            if layout is None:
+                return {}
+            processor = self.processor
+            return processor.layouts.extract(image, layout, processor.engine, processor.executor, fields)
+
+    def verify(self, image):
+        """Match a normalized card against the roster
+
+        Returns:
+            Tuple of (RosterMatch or None, fields read as (value, confidence))
+        """
+        roster = self.roster if self.roster is not None else get_roster()
+        fields = self.read_fields(image)
+        if 'student_id' not in fields:
+            return None, fields
+        values = {field: value for field, (value, _) in fields.items()}
+        with metrics.stage('roster'):
+            match = roster.match(values['student_id'], values.get('name'), values.get('dob'))
+        return match, fields
+
+
+def get_roster():
+    """Roster index of this process
+
+    Rebuilt from the database when an EnrolledStudent is saved or deleted in
+    this process, and at the latest settings.STUDENT_CARD_ROSTER_REFRESH
+    seconds after it was built, to pick up changes made by other processes.
+    """
+    global _roster
+    roster = _roster
+    refresh = getattr(settings, 'STUDENT_CARD_ROSTER_REFRESH', 300)
+    if roster is None or time.monotonic() - roster.built_at > refresh:
+        with _roster_lock:
+            # Rebuild unless another thread already did, also when invalidated meanwhile
+            if _roster is None or _roster is roster:
+                _roster = RosterIndex.from_db()
+            roster = _roster
+    return roster
+
+
+@receiver([post_save, post_delete], sender=EnrolledStudent)
+def invalidate_roster(**kwargs):
+    """Drop the roster index, the next verification rebuilds it"""
+    global _roster
+    _roster = None
@@ -0,0 +1,446 @@
+import io
+import logging
+import math
+import os
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+
+from . import metrics
+from .geometry import limit_size
+from .limits import budget_violation, card_budget, result_is_partial
+from .models import StudentCard, card_image_storage
+from .registry import get_processor
+from .result_cache import file_digest, find_stored_image, get_result_cache, image_digest
+from .roster import RosterVerifier, get_roster
+from .storage import derivative_format, encode_image, encode_original
+
+logger = logging.getLogger(__name__)
+
+_persist_pool = None
+_persist_pool_lock = threading.Lock()
+
+# StudentCard fields copied from a cached result
+CACHED_RESULT_FIELDS = (
+    'university', 'student_card_type', 'name', 'dob', 'student_id', 'class_name', 'cohort',
+    'field_confidence', 'processor_version',
+)
+
+# Decoding at a fraction of the full size, largest reduction first
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+class CardProcessingError(Exception):
+    """Raised when a student card image cannot be processed"""
+
+
+def card_fields_from_info(info):
+    """Map the processor's field names to StudentCard model fields"""
+    return {
+        'university': info.get('university'),
+        'student_card_type': info.get('student_card'),
+        'name': info.get('name'),
+        'dob': info.get('dob'),
+        'student_id': info.get('student_id'),
+        'class_name': info.get('class'),
+        'cohort': info.get('cohort'),
+        'field_confidence': info.get('confidence') or {},
+    }
+
+
+def save_thumbnail(image):
+    """Store a small JPEG of a decoded card image for listings
+
+    Returns:
+        Storage name of the thumbnail
+    """
+    size = getattr(settings, 'STUDENT_CARD_THUMBNAIL_SIZE', 120)
+    quality = getattr(settings, 'STUDENT_CARD_THUMBNAIL_QUALITY', 80)
+    encoded = encode_image(limit_size(image, size), derivative_format(), quality)
+    if encoded is None:
+        return None
+    data, extension = encoded
+    return default_storage.save(f"thumbnails/{uuid.uuid4().hex}{extension}", ContentFile(data))
+
+
+def thumbnail_for(image, cached=None):
+    """Thumbnail of a cached card showing the same image, or a new one"""
+    if cached is not None and cached.thumbnail:
+        return cached.thumbnail.name
+    return save_thumbnail(image)
+
+
+def same_student_id(processor, image):
+    """Confirmation of a cache hit found by perceptual hash, see ResultCache.lookup
+
+    The hit is reused only when the student ID zone of this image reads
+    the cached card's student ID, which needs a card layout.
+    """
+    def confirm(card):
+        if not card.student_id:
+            return False
+        read = RosterVerifier(processor).read_fields(processor.prepare_image(image), ('student_id',))
+        confirmed = read.get('student_id', (None, 0))[0] == card.student_id
+        metrics.count('phash_confirmed' if confirmed else 'phash_rejected')
+        return confirmed
+    return confirm
+
+
+def read_upload(uploaded_file):
+    """Bytes of an uploaded file, read once
+
+    Uploads held in memory are returned from their buffer without reading
+    them through the file interface, larger ones are read from Django's
+    temporary file.
+    """
+    buffer = getattr(uploaded_file, 'file', None)
+    if isinstance(buffer, io.BytesIO):
+        return buffer.getvalue()
+    uploaded_file.seek(0)
+    data = uploaded_file.read()
+    uploaded_file.seek(0)
+    return data
+
+
+def image_size(data):
+    """(width, height) read from the image header without decoding the pixels, None if unknown"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except OSError:
+        return None
+
+
+def decode_image(data):
+    """Decode image bytes into a BGR array without copying them, None if they are not an image
+
+    Images over settings.STUDENT_CARD_MAX_PIXELS are decoded at 1/2, 1/4 or
+    1/8 scale where the format supports it, so a huge photo never takes its
+    full size in memory, and are then downscaled to fit. This is recorded as
+    a 'pixels' budget violation. Images Pillow considers decompression
+    bombs are not decoded at all.
+    """
+    max_pixels = getattr(settings, 'STUDENT_CARD_MAX_PIXELS', None)
+    flags = cv2.IMREAD_COLOR
+    try:
+        size = image_size(data) if max_pixels else None
+    except Image.DecompressionBombError:
+        budget_violation('pixels')
+        return None
+    if size is not None and size[0] * size[1] > max_pixels:
+        budget_violation('pixels')
+        ratio = size[0] * size[1] / max_pixels
+        for factor, reduced in REDUCED_DECODE_FLAGS:
+            if factor * factor <= ratio:
+                flags = reduced
+                break
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is not None and max_pixels:
+        height, width = image.shape[:2]
+        if height * width > max_pixels:
+            image = limit_size(image, int(max(height, width) * math.sqrt(max_pixels / (height * width))))
+    return image
+
+
+def _get_persist_pool():
+    global _persist_pool
+    if _persist_pool is None:
+        with _persist_pool_lock:
+            if _persist_pool is None:
+                _persist_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='persist')
+    return _persist_pool
+
+
+def _saved(name):
+    future = Future()
+    future.set_result(name)
+    return future
+
+
+def persist_original(uploaded_file, data, image=None):
+    """Start storing an uploaded card image in the card image storage
+
+    Uploads spooled to a temporary file are moved into place synchronously,
+    which FileSystemStorage does without copying. In-memory uploads are
+    written in the background when settings.STUDENT_CARD_ASYNC_IMAGE_SAVE is
+    on, so the write overlaps OCR.
+
+    Args:
+        image: The decoded upload, re-encoded first when
+            settings.STUDENT_CARD_ORIGINAL_FORMAT is set, see encode_original
+
+    Returns:
+        Future giving the storage name of the image. The file only exists
+        once it is done, so wait for it before saving or showing anything
+        that refers to the image.
+    """
+    content, extension = encode_original(data, os.path.splitext(uploaded_file.name)[1].lower(), image)
+    name = f"student_cards/{uuid.uuid4().hex}{extension}"
+    storage = card_image_storage()
+    if content is data and hasattr(uploaded_file, 'temporary_file_path'):
+        return _saved(storage.save(name, uploaded_file))
+    if not getattr(settings, 'STUDENT_CARD_ASYNC_IMAGE_SAVE', True):
+        return _saved(storage.save(name, ContentFile(content)))
+    return _get_persist_pool().submit(storage.save, name, ContentFile(content))
+
+
+def discard_original(saving):
+    """Delete an original stored by persist_original for a card that won't be saved"""
+    try:
+        card_image_storage().delete(saving.result())
+    except Exception:
+        logger.exception("Could not delete the stored image of a failed upload")
+
+
+def create_card_from_upload(image_file, **fields):
+    """Save a StudentCard for an uploaded image
+
+    When the same image content is already stored, the new card points to
+    that file instead of storing another copy.
+    """
+    digest = file_digest(image_file)
+    stored_image = find_stored_image(digest)
+    if stored_image is None and getattr(settings, 'STUDENT_CARD_ORIGINAL_FORMAT', None):
+        data = read_upload(image_file)
+        content, extension = encode_original(data, os.path.splitext(image_file.name)[1].lower(), decode_image(data))
+        if content is not data:
+            image_file = ContentFile(content, name=f"{uuid.uuid4().hex}{extension}")
+    student_card = StudentCard(image=stored_image or image_file, image_sha256=digest, **fields)
+    student_card.save()
+    return student_card
+
+
+def process_upload(image_file, processor=None, result_cache=None):
+    """Create and process a StudentCard from an upload in a single pass over its bytes
+
+    The upload is decoded from memory and the pipeline works on the decoded
+    array, so the image is never read back from storage. The original is
+    stored as persist_original describes while OCR runs, or not at all when
+    the same image is already stored. The card is saved once with its
+    results, after the original is in storage, so its image URL and
+    visualizations work as soon as it is returned.
+
+    Returns:
+        The saved StudentCard
+    """
+    processor = processor or get_processor()
+    result_cache = result_cache or get_result_cache()
+    
+    data = read_upload(image_file)
+    with card_budget() as budget, metrics.card_trace() as trace, metrics.stage('total'):
+        with metrics.stage('decode'):
+            image = decode_image(data)
+        if image is None:
+            raise CardProcessingError(f"Could not read uploaded image {image_file.name}")
+        
+        student_card = StudentCard(image_sha256=image_digest(data))
+        stored_image = find_stored_image(student_card.image_sha256)
+        saving = None if stored_image else persist_original(image_file, data, image)
+        try:
+            fields = extract_card_fields(student_card, processor, result_cache, image)
+        except BaseException:
+            if saving is not None:
+                discard_original(saving)
+            raise
+    fields['budget_violations'] = budget.violations
+    if trace is not None:
+        fields['timings'] = trace.as_dict()
+    
+    for name, value in fields.items():
+        setattr(student_card, name, value)
+    student_card.image.name = stored_image or saving.result()
+    student_card.status = StudentCard.STATUS_DONE
+    student_card.attempts = 1
+    student_card.finished_at = timezone.now()
+    student_card.save()
+    return student_card
+
+
+def recognize_upload(image_file, processor=None, result_cache=None):
+    """Extract the fields of an uploaded image without storing anything
+
+    Args:
+        result_cache: Cache to reuse the result of a stored card with the same
+            image bytes from, None skips the lookup
+
+    Returns:
+        Tuple of (card info dict with 'confidence' and 'budget_violations',
+        whether it came from the cache)
+    """
+    processor = processor or get_processor()
+    
+    data = read_upload(image_file)
+    info = cached = None
+    with card_budget() as budget, metrics.card_trace(), metrics.stage('total'):
+        with metrics.stage('decode'):
+            image = decode_image(data)
+        if image is None:
+            raise CardProcessingError(f"Could not read uploaded image {image_file.name}")
+        
+        if result_cache is not None:
+            cached = result_cache.lookup(processor.version, image_digest(data))
+            if cached is not None:
+                info = card_info(cached)
+        
+        if info is None:
+            info, _ = processor.extract_card_info(processor.prepare_image(image))
+    info['budget_violations'] = budget.violations
+    return info, cached is not None
+
+
+def verify_upload(image_file, processor=None, roster=None):
+    """Identify the enrolled student of an uploaded card without storing anything
+
+    Only the ID, name and date of birth zones are read and matched against
+    the roster. When that doesn't confirm a student, e.g. for cards without
+    a known layout, the full pipeline runs and its fields are matched instead.
+
+    Returns:
+        Dictionary with 'matched', 'method' ('roster' or 'full'), the
+        matched 'student' or None, the 'fields' read with their 'confidence',
+        and the 'budget_violations' of the card
+    """
+    processor = processor or get_processor()
+    roster = get_roster() if roster is None else roster
+    
+    data = read_upload(image_file)
+    with card_budget() as budget, metrics.card_trace(), metrics.stage('total'):
+        with metrics.stage('decode'):
+            image = decode_image(data)
+        if image is None:
+            raise CardProcessingError(f"Could not read uploaded image {image_file.name}")
+        
+        card = processor.prepare_image(image)
+        match, read = RosterVerifier(processor, roster).verify(card)
+        if match is not None:
+            metrics.count('roster_hits')
+            method = 'roster'
+            fields = {field: value for field, (value, _) in read.items()}
+            confidence = {field: round(conf, 3) for field, (_, conf) in read.items()}
+        else:
+            metrics.count('roster_misses')
+            method = 'full'
+            fields, _ = processor.extract_card_info(card)
+            confidence = fields.pop('confidence')
+            match = roster.match(fields.get('student_id'), fields.get('name'), fields.get('dob'))
+    
+    return {
+        'matched': match is not None,
+        'method': method,
+        'student': match.as_dict() if match is not None else None,
+        'fields': fields,
+        'confidence': confidence,
+        'budget_violations': budget.violations,
+    }
+
+
+def run_card_pipeline(student_card, processor=None, result_cache=None, deadline=None):
+    """Run OCR for a saved StudentCard
+
+    Results of a card already processed from the same image by the same
+    processor version are reused without running OCR. The card itself is
+    not saved, callers decide how the results are written.
+
+    Args:
+        deadline: Seconds the card may take, see students.limits.card_budget
+
+    Returns:
+        Tuple of (model field values, visualization URLs)
+    """
+    processor = processor or get_processor()
+    result_cache = result_cache or get_result_cache()
+    
+    with card_budget(deadline) as budget, metrics.card_trace() as trace, metrics.stage('total'):
+        fields = extract_card_fields(student_card, processor, result_cache)
+    fields['budget_violations'] = budget.violations
+    if trace is not None:
+        fields['timings'] = trace.as_dict()
+    return fields, student_card.visualization_urls()
+
+
+def extract_card_fields(student_card, processor, result_cache, image=None):
+    """Model field values for a StudentCard, from the result cache or OCR
+
+    Args:
+        image: The decoded card image, read from storage when not given.
+            The card's image_sha256 must be set when an image is given.
+    """
+    data = None
+    if image is None:
+        with metrics.stage('decode'):
+            with student_card.image.open('rb') as image_file:
+                data = image_file.read()
+            image = decode_image(data)
+        if image is None:
+            raise CardProcessingError(f"Could not read image for card {student_card.id}")
+    
+    digest = student_card.image_sha256 or image_digest(data)
+    phash = result_cache.phash(image)
+    
+    cached = result_cache.lookup(
+        processor.version, digest, phash, exclude_id=student_card.id, confirm=same_student_id(processor, image),
+    )
+    if cached is not None:
+        fields = {name: getattr(cached, name) for name in CACHED_RESULT_FIELDS}
+        fields.update(image_sha256=digest, image_phash=phash, thumbnail=thumbnail_for(image, cached))
+        return fields
+    
+    # Visualizations are rendered later, only if a page asks for them
+    info, _ = processor.extract_card_info(processor.prepare_image(image))
+
+    fields = card_fields_from_info(info)
+    fields.update(
+        # A result cut short by the card's budget is not reused for the same image
+        processor_version=None if result_is_partial() else processor.version,
+        image_sha256=digest,
+        image_phash=phash,
+        thumbnail=thumbnail_for(image),
+    )
+    return fields
+
+
+def card_info(student_card):
+    """Extracted fields of a StudentCard under the processor's field names, with their confidence"""
+    return {
+        'university': student_card.university,
+        'student_card': student_card.student_card_type,
+        'name': student_card.name,
+        'dob': student_card.dob,
+        'student_id': student_card.student_id,
+        'class': student_card.class_name,
+        'cohort': student_card.cohort,
+        'confidence': student_card.field_confidence,
+    }
+
+
+def card_to_dict(student_card):
+    """JSON friendly representation of a StudentCard and its job state"""
+    info = card_info(student_card)
+    confidence = info.pop('confidence')
+    return {
+        'id': student_card.id,
+        'job_id': str(student_card.job_id),
+        'status': student_card.status,
+        'attempts': student_card.attempts,
+        'error': student_card.error or None,
+        'uploaded_at': student_card.uploaded_at.isoformat() if student_card.uploaded_at else None,
+        'started_at': student_card.started_at.isoformat() if student_card.started_at else None,
+        'finished_at': student_card.finished_at.isoformat() if student_card.finished_at else None,
+        'fields': info,
+        'confidence': confidence,
+        'timings': student_card.timings,
+        'budget_violations': student_card.budget_violations,
+    }
@@ -0,0 +1,272 @@
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import StudentCard, card_image_storage
+
+# Formats images are written in: file extension and name of the OpenCV quality flag.
+# OpenCV is imported on first use, the app loads this module at startup for its signal handler.
+FORMATS = {
+    'jpeg': ('.jpg', 'IMWRITE_JPEG_QUALITY'),
+    'webp': ('.webp', 'IMWRITE_WEBP_QUALITY'),
+}
+
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+}
+
+# Cached visualizations are named card_<id>_<kind>.<ext>, see VisualizationCache
+VISUALIZATION_NAME = re.compile(r'^card_(\d+)_[a-z]+\.\w+$')
+
+
+def content_type(name):
+    return CONTENT_TYPES.get(os.path.splitext(name)[1].lower(), 'application/octet-stream')
+
+
+def derivative_format():
+    """Format of thumbnails and visualizations, settings.STUDENT_CARD_DERIVATIVE_FORMAT"""
+    return getattr(settings, 'STUDENT_CARD_DERIVATIVE_FORMAT', 'webp')
+
+
+def encode_image(image, fmt, quality):
+    """Encode a BGR image
+
+    Returns:
+        Tuple of (bytes, extension), or None if OpenCV can't encode it
+    """
+    import cv2
+
+    extension, quality_flag = FORMATS[fmt]
+    ok, encoded = cv2.imencode(extension, image, [getattr(cv2, quality_flag), quality])
+    if not ok:
+        return None
+    return encoded.tobytes(), extension
+
+
+def encode_original(data, extension, image):
+    """Apply the policy for stored originals to an uploaded image
+
+    With settings.STUDENT_CARD_ORIGINAL_FORMAT set, the decoded image is
+    downscaled to STUDENT_CARD_ORIGINAL_MAX_SIDE and re-encoded, and the
+    result is kept if it is smaller than the upload.
+
+    Returns:
+        Tuple of (bytes, extension), the upload itself when it is kept as is
+    """
+    fmt = getattr(settings, 'STUDENT_CARD_ORIGINAL_FORMAT', None)
+    if not fmt or image is None:
+        return data, extension
+    from .geometry import limit_size
+
+    max_side = getattr(settings, 'STUDENT_CARD_ORIGINAL_MAX_SIDE', None)
+    if max_side:
+        image = limit_size(image, max_side)
+    encoded = encode_image(image, fmt, getattr(settings, 'STUDENT_CARD_ORIGINAL_QUALITY', 90))
+    if encoded is None or len(encoded[0]) >= len(data):
+        return data, extension
+    return encoded
+
+
+def delete_unreferenced(storage, field, name):
+    """Delete a stored file unless another card still points to it
+
+    Cards with the same image share the original and the thumbnail, see
+    find_stored_image and thumbnail_for.
+    """
+    if name and not StudentCard.objects.filter(**{field: name}).exists():
+        storage.delete(name)
+
+
+@receiver(post_delete, sender=StudentCard)
+def release_card_files(sender, instance, **kwargs):
+    """Delete the files of a deleted card once the deletion is committed"""
+    image, thumbnail, card_id = instance.image.name, instance.thumbnail.name, instance.id
+
+    def release():
+        # Imported here, the visualization module imports this one
+        from .visualization import get_visualization_cache
+        delete_unreferenced(card_image_storage(), 'image', image)
+        delete_unreferenced(default_storage, 'thumbnail', thumbnail)
+        get_visualization_cache().remove(card_id)
+
+    transaction.on_commit(release)
+
+
+class StoredFile:
+    __slots__ = ('name', 'size', 'modified')
+
+    def __init__(self, name, size, modified):
+        self.name = name
+        self.size = size
+        self.modified = modified
+
+
+def list_files(storage, directory):
+    """Every file below a storage directory, with its size and modification time"""
+    try:
+        directories, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for filename in files:
+        name = f"{directory}/{filename}"
+        yield StoredFile(name, storage.size(name), storage.get_modified_time(name).timestamp())
+    for subdirectory in directories:
+        yield from list_files(storage, f"{directory}/{subdirectory}")
+
+
+class StorageManager:
+    """Reports and reclaims the space used by card images and their derivatives
+
+    Areas:
+        originals: Uploaded card images, shared by cards with the same image
+        thumbnails: Listing thumbnails, shared the same way
+        visualizations: Rendered on request by VisualizationCache
+
+    Files younger than ``grace`` seconds are never treated as orphans, so
+    uploads still being processed or written in the background are safe.
+    """
+
+    def __init__(self, grace=None, visualizations=None):
+        self.grace = getattr(settings, 'STUDENT_CARD_ORPHAN_GRACE', 3600) if grace is None else grace
+        if visualizations is None:
+            # Imported here, the visualization module imports this one
+            from .visualization import get_visualization_cache
+            visualizations = get_visualization_cache()
+        self.visualizations = visualizations
+
+    def _stored_areas(self):
+        return {
+            'originals': (card_image_storage(), 'student_cards', 'image'),
+            'thumbnails': (default_storage, 'thumbnails', 'thumbnail'),
+        }
+
+    def _visualization_files(self):
+        try:
+            entries = [entry for entry in os.scandir(self.visualizations.directory) if entry.is_file()]
+        except FileNotFoundError:
+            return []
+        return [StoredFile(entry.path, entry.stat().st_size, entry.stat().st_mtime) for entry in entries]
+
+    def orphans(self):
+        """Files no card refers to, by area
+
+        Returns:
+            Dictionary of area to (storage or None for local files, list of StoredFile)
+        """
+        cutoff = time.time() - self.grace
+        found = {}
+        for area, (storage, directory, field) in self._stored_areas().items():
+            referenced = set(StudentCard.objects.exclude(**{field: ''}).values_list(field, flat=True))
+            found[area] = (storage, [
+                stored for stored in list_files(storage, directory)
+                if stored.name not in referenced and stored.modified < cutoff
+            ])
+
+        # Visualizations of deleted cards, and files of the old per-upload naming
+        card_ids = set(StudentCard.objects.values_list('id', flat=True))
+        orphaned = []
+        for stored in self._visualization_files():
+            match = VISUALIZATION_NAME.match(os.path.basename(stored.name))
+            if stored.modified < cutoff and (match is None or int(match.group(1)) not in card_ids):
+                orphaned.append(stored)
+        found['visualizations'] = (None, orphaned)
+        return found
+
+    def report(self):
+        """Files and bytes per area, and how much of it is orphaned"""
+        usage = {
+            area: list(list_files(storage, directory))
+            for area, (storage, directory, _) in self._stored_areas().items()
+        }
+        usage['visualizations'] = self._visualization_files()
+
+        report = {}
+        for area, (_, orphans) in self.orphans().items():
+            files = usage[area]
+            report[area] = {
+                'files': len(files),
+                'bytes': sum(stored.size for stored in files),
+                'orphans': len(orphans),
+                'orphan_bytes': sum(stored.size for stored in orphans),
+            }
+        return report
+
+    def collect_orphans(self, dry_run=False):
+        """Delete the files no card refers to
+
+        Returns:
+            Tuple of (files deleted, bytes freed)
+        """
+        deleted = freed = 0
+        for storage, orphans in self.orphans().values():
+            for stored in orphans:
+                if not dry_run:
+                    try:
+                        if storage is None:
+                            os.remove(stored.name)
+                        else:
+                            storage.delete(stored.name)
+                    except FileNotFoundError:
+                        continue
+                deleted += 1
+                freed += stored.size
+        return deleted, freed
+
+    def evict_visualizations(self):
+        """Apply the size and age limits of the visualization cache
+
+        Returns:
+            Tuple of (files deleted, bytes freed)
+        """
+        return self.visualizations.evict()
+
+    def reencode_originals(self, dry_run=False):
+        """Apply the original image policy to originals stored before it was set
+
+        Originals already in the target format are left alone, so running
+        this again doesn't lose quality.
+
+        Returns:
+            Tuple of (files re-encoded, bytes freed)
+        """
+        from .services import decode_image
+
+        fmt = getattr(settings, 'STUDENT_CARD_ORIGINAL_FORMAT', None)
+        if not fmt:
+            return 0, 0
+        target_extension = FORMATS[fmt][0]
+        storage = card_image_storage()
+
+        names = StudentCard.objects.exclude(image='').values_list('image', flat=True).distinct()
+        converted = freed = 0
+        for name in names.iterator():
+            extension = os.path.splitext(name)[1].lower()
+            if extension == target_extension:
+                continue
+            try:
+                with storage.open(name, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            image = decode_image(data)
+            encoded, new_extension = encode_original(data, extension, image)
+            if encoded is data:
+                continue
+            converted += 1
+            freed += len(data) - len(encoded)
+            if dry_run:
+                continue
+            new_name = storage.save(f"{os.path.splitext(name)[0]}{new_extension}", ContentFile(encoded))
+            StudentCard.objects.filter(image=name).update(image=new_name)
+            storage.delete(name)
+        return converted, freed
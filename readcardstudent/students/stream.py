@@ -0,0 +1,151 @@
+import itertools
+
+import cv2
+from django.conf import settings
+
+from . import metrics
+from .geometry import find_card_quad, limit_size
+from .limits import card_budget, check_cancelled
+from .registry import get_processor
+
+
+def open_video(source):
+    """Open a video file, a stream URL (e.g. MJPEG over HTTP) or a camera index given as digits"""
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        capture.release()
+        raise ValueError(f"Could not open video source {source}")
+    return capture
+
+
+def iter_video_frames(source, max_frames=None):
+    """Yield the decoded frames of a video source until it ends"""
+    capture = open_video(source)
+    try:
+        count = 0
+        while max_frames is None or count < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+            count += 1
+    finally:
+        capture.release()
+
+
+class FrameScore:
+    """How worth reading a frame is, from a downscaled copy of it"""
+    __slots__ = ('index', 'sharpness', 'card')
+
+    def __init__(self, index, sharpness, card):
+        self.index = index
+        # Variance of the Laplacian, low for blurred or motion-smeared frames
+        self.sharpness = sharpness
+        # Whether a card outline was found
+        self.card = card
+
+
+def score_frame(frame, index=0, side=320):
+    """Score a frame for sharpness and card presence in a few milliseconds"""
+    small = limit_size(frame, side)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    return FrameScore(index, sharpness, find_card_quad(small, work_side=side) is not None)
+
+
+class StreamReader:
+    """Reads a card from a sequence of camera frames, OCRing one frame per window
+
+    Every frame gets a cheap score, and only the sharpest frame of each
+    window of ``window`` frames that shows a card goes through the pipeline.
+    Field votes carry over from window to window, so fields read confidently
+    from one frame are not read again and uncertain ones add up across frames.
+    Once every field is settled no more OCR runs. When no card is seen for
+    ``reset_after`` windows, the card is taken to be gone and the votes are dropped.
+    """
+
+    def __init__(self, processor=None, window=None, min_sharpness=None, score_side=None, reset_after=None):
+        self.processor = processor or get_processor()
+        self.window = window or getattr(settings, 'STUDENT_CARD_STREAM_WINDOW', 15)
+        self.min_sharpness = (
+            getattr(settings, 'STUDENT_CARD_STREAM_MIN_SHARPNESS', 50.0) if min_sharpness is None else min_sharpness
+        )
+        self.score_side = score_side or getattr(settings, 'STUDENT_CARD_STREAM_SCORE_SIZE', 320)
+        self.reset_after = reset_after or getattr(settings, 'STUDENT_CARD_STREAM_RESET_AFTER', 2)
+        self.votes = {}
+        self._missed_windows = 0
+
+    def reset(self):
+        """Forget the current card"""
+        self.votes = {}
+        self._missed_windows = 0
+
+    @property
+    def settled(self):
+        return self.processor.fields_settled(self.votes)
+
+    def best_frame(self, frames):
+        """Pick the sharpest frame showing a card, keeping only that frame in memory
+
+        Args:
+            frames: Iterable of (index, frame)
+
+        Returns:
+            Tuple of (FrameScore, frame), or None if no frame is usable
+        """
+        best = None
+        with metrics.stage('frame_score'):
+            for index, frame in frames:
+                score = score_frame(frame, index, self.score_side)
+                metrics.count('frames_scored')
+                if not score.card or score.sharpness < self.min_sharpness:
+                    continue
+                if best is None or score.sharpness > best[0].sharpness:
+                    best = (score, frame)
+        return best
+
+    def read_window(self, frames):
+        """Read the best frame of one window, voting into the carried votes
+
+        Returns:
+            Result of the window, see run()
+        """
+        best = self.best_frame(frames)
+        if best is None:
+            self._missed_windows += 1
+            if self._missed_windows >= self.reset_after:
+                self.reset()
+        else:
+            self._missed_windows = 0
+            if not self.settled:
+                check_cancelled()
+                metrics.count('frames_read')
+                with card_budget():
+                    card = self.processor.prepare_image(best[1])
+                    self.processor.extract_card_info(card, votes=self.votes)
+
+        info = self.processor.resolve_votes(self.votes)
+        confidence = info.pop('confidence')
+        return {
+            'frame': best[0].index if best else None,
+            'sharpness': round(best[0].sharpness, 1) if best else None,
+            'fields': info,
+            'confidence': confidence,
+            'settled': self.settled,
+        }
+
+    def run(self, frames):
+        """Read cards from an iterable of frames, e.g. iter_video_frames()
+
+        Yields:
+            One dict per window with the index and sharpness of the frame that
+            was read (None when no frame was usable), the fields known so far
+            with their 'confidence', and whether every field is 'settled'
+        """
+        frames = enumerate(frames)
+        while True:
+            window = itertools.islice(frames, self.window)
+            first = next(window, None)
+            if first is None:
+                return
+            yield self.read_window(itertools.chain([first], window))
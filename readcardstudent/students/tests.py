@@ -1,3 +1,1467 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.core.files.storage import default_storage
+from django.db.models import QuerySet
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import metrics, roster
+from .benchmark import BenchmarkRunner
+from .cascade import OCRCascade
+from .executors import SerialOCRExecutor, ThreadOCRExecutor
+from .geometry import CARD_SIZE, find_card_quad, normalize_card, order_corners, skew_angle
+from .ingest import READ_ERRORS, BulkIngestor, SourceTooLarge, iter_directory_sources, iter_upload_sources
+from .jobs import CardJobWorkerPool, claim_next_job
+from .layouts import LAYOUT_DIR, CardLayout, LayoutExtractor, crop_relative
+from .limits import CapacityExceeded, ProcessingCancelled, ProcessingLimiter, card_budget, check_cancelled
+from .metrics import CallbackGauge, Counter, Histogram, MetricsRegistry
+from .models import OCRPassStat, StudentCard, card_image_storage
+from .ocr_engines import OCREngine, PytesseractEngine, create_ocr_engine, limit_tesseract_threads, parse_tesseract_config
+from .parser import FieldParser, fold, parse_fields, tokenize
+from .preprocessing import PreprocessingGraph
+from .registry import PRELOAD_ENV, serving_process
+from .result_cache import ResultCache
+from .roster import RosterEntry, RosterIndex, get_roster, invalidate_roster
+from .services import create_card_from_upload, process_upload
+from .stream import StreamReader, score_frame
+from .utils import StudentCardProcessor
+from .views import parse_card_cursor
+from .visualization import VisualizationCache
+
+CARD_TEXT = (
+    "ĐẠI HỌC ĐÔNG Á\n"
+    "THẺ SINH VIÊN\n"
+    "Nguyễn Văn An\n"
+    "Ngày sinh: 01/02/2003\n"
+    "Lớp: 20CT1\n"
+    "Khóa: 2020 - 2024\n"
+    "123456\n"
+)
+
+
+class FakeOCREngine(OCREngine):
+    """Returns the same text for every image and counts the calls"""
+    name = 'fake'
+
+    def __init__(self, text=CARD_TEXT, confidence=95, delay=0):
+        self.lines = [(line, confidence) for line in text.splitlines() if line.strip()]
+        # Seconds every call takes
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+
+    def image_to_string(self, image, config=''):
+        self._count()
+        return '\n'.join(line for line, _ in self.lines)
+
+    def image_to_data(self, image, config=''):
+        self._count()
+        return list(self.lines)
+
+
+def fake_processor(engine=None, **kwargs):
+    """A StudentCardProcessor reading cards with FakeOCREngine, serially and without learning
+
+    Layouts are off: the fake engine returns the whole card for every zone.
+    """
+    processor = StudentCardProcessor(
+        engine=engine or FakeOCREngine(**kwargs),
+        cascade=OCRCascade(learning=False),
+        executor=SerialOCRExecutor(),
+    )
+    processor.layouts = None
+    return processor
+
+
+def card_image(seed=0, width=400, height=250):
+    """PNG bytes of a noise image, different for every seed"""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode('.png', pixels)[1].tobytes()
+
+
+def zip_upload(name, members):
+    """SimpleUploadedFile of a ZIP archive of (name, bytes) members"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for member, data in members:
+            archive.writestr(member, data)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class MediaTestMixin:
+    """Stores every file of the test under a temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root, STUDENT_CARD_ASYNC_IMAGE_SAVE=False)
+        media.enable()
+        self.addCleanup(media.disable)
+
+
+class FieldParserTests(SimpleTestCase):
+    def test_card_with_diacritics(self):
+        self.assertEqual(parse_fields(CARD_TEXT), {
+            'university': 'ĐẠI HỌC ĐÔNG Á',
+            'student_card': 'THẺ SINH VIÊN',
+            'name': 'Nguyễn Văn An',
+            'dob': '01/02/2003',
+            'class': '20CT1',
+            'cohort': '2020 - 2024',
+            'student_id': '123456',
+        })
+
+    def test_card_without_diacritics(self):
+        fields = parse_fields("DAI HOC DONG A\nTHE SINH VIEN\nNguyen Van An\nNgay sinh: 01/02/2003\nLop: 20CT1\n123456")
+        self.assertEqual(fields['university'], 'DAI HOC DONG A')
+        self.assertEqual(fields['name'], 'Nguyen Van An')
+        self.assertEqual(fields['class'], '20CT1')
+
+    def test_name_follows_header_in_any_case(self):
+        for header in ('THE SINH VIEN', 'The Sinh Vien', 'the sinh vien', 'Thẻ Sinh Viên', 'thẻ sinh viên'):
+            with self.subTest(header=header):
+                fields = parse_fields(f"dai hoc dong a\n{header}\nTran Thi Mai\n123456")
+                self.assertEqual(fields['name'], 'Tran Thi Mai')
+                self.assertEqual(fields['student_card'], header)
+
+    def test_name_after_header_stops_at_label(self):
+        self.assertEqual(parse_fields("THE SINH VIEN\nLe Van Binh: SV\n")['name'], 'Le Van Binh')
+
+    def test_missing_header_falls_back_to_name_rules(self):
+        fields = parse_fields("Nguyen Van An\nDOB: 01/02/2003\n12345")
+        self.assertEqual(fields, {'name': 'Nguyen Van An', 'dob': '01/02/2003', 'student_id': '12345'})
+        self.assertNotIn('student_card', fields)
+
+    def test_labelled_dob_beats_other_dates(self):
+        self.assertEqual(parse_fields("Cap ngay 05/06/2021\nNgay sinh: 01/02/2003")['dob'], '01/02/2003')
+
+    def test_student_id_is_five_or_six_digits(self):
+        self.assertNotIn('student_id', parse_fields("1234\n1234567"))
+        self.assertEqual(parse_fields("ID: 98765")['student_id'], '98765')
+
+    def test_fold_keeps_positions(self):
+        text = 'Nguyễn Văn Đức'
+        self.assertEqual(fold(text), 'Nguyen Van Duc')
+        self.assertEqual(len(fold(text)), len(text))
+
+    def test_parse_many_keeps_source_of_each_field(self):
+        result = FieldParser().parse_many([("123456", 'ids'), ("THE SINH VIEN\nTran Thi Mai", 'names')])
+        self.assertEqual(result.fields['student_id'], '123456')
+        self.assertEqual(result.sources, {'student_card': 'names', 'name': 'names', 'student_id': 'ids'})
+
+    def test_tokenize_drops_blank_lines(self):
+        self.assertEqual([line.text for line in tokenize("a\n\n  \nb")], ['a', 'b'])
+
+
+class BulkIngestorTests(MediaTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.engine = FakeOCREngine()
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(data)
+
+    def ingest(self, sources):
+        return BulkIngestor(processor=fake_processor(self.engine), workers=2).ingest(sources)
+
+    def test_same_bytes_are_processed_and_stored_once(self):
+        self.write('a.png', card_image(1))
+        self.write('b.png', card_image(1))
+        self.write('c.png', card_image(2))
+        stats = self.ingest(iter_directory_sources(self.directory))
+
+        self.assertEqual((stats.processed, stats.failed), (3, 0))
+        cards = {os.path.basename(card.source): card for card in StudentCard.objects.all()}
+        self.assertEqual(cards['a.png'].image.name, cards['b.png'].image.name)
+        self.assertEqual(cards['a.png'].thumbnail.name, cards['b.png'].thumbnail.name)
+        self.assertNotEqual(cards['a.png'].image.name, cards['c.png'].image.name)
+        self.assertEqual(cards['b.png'].student_id, '123456')
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'student_cards'))), 2)
+
+    def test_duplicates_reuse_a_card_already_written(self):
+        for name in ('a.png', 'b.png', 'c.png'):
+            self.write(name, card_image(1))
+        ingestor = BulkIngestor(processor=fake_processor(self.engine), workers=1, batch_size=1)
+        stats = ingestor.ingest(iter_directory_sources(self.directory))
+
+        self.assertEqual((stats.processed, self.engine.calls), (3, 1))
+        cards = StudentCard.objects.order_by('source')
+        self.assertEqual(len({(card.image.name, card.thumbnail.name, card.student_id) for card in cards}), 1)
+
+    def test_storage_errors_fail_the_card_not_the_run(self):
+        self.write('a.png', card_image(1))
+        self.write('b.png', b'not an image')
+        with mock.patch('students.ingest.thumbnail_for', side_effect=OSError("disk full")), \
+                self.assertLogs('students.ingest', 'ERROR'):
+            stats = self.ingest(iter_directory_sources(self.directory))
+
+        self.assertEqual((stats.processed, stats.failed), (0, 2))
+        errors = sorted(StudentCard.objects.values_list('error', flat=True))
+        self.assertEqual(errors, ["Could not decode image", "Processing failed: disk full"])
+
+    def test_uploads_are_keyed_by_content(self):
+        first = SimpleUploadedFile('card.png', card_image(1))
+        second = SimpleUploadedFile('card.png', card_image(2))
+        self.assertEqual(first.size, second.size)
+        keys = [source.key for source in iter_upload_sources([first, second])]
+        self.assertNotEqual(keys[0], keys[1])
+
+        self.ingest(iter_upload_sources([SimpleUploadedFile('card.png', card_image(1))]))
+        stats = self.ingest(iter_upload_sources([
+            SimpleUploadedFile('card.png', card_image(1)),
+            SimpleUploadedFile('card.png', card_image(2)),
+        ]))
+        self.assertEqual((stats.processed, stats.skipped), (1, 1))
+        self.assertEqual(StudentCard.objects.count(), 2)
+
+
+class CardJobTests(MediaTestMixin, TestCase):
+    def queue_card(self, seed=1):
+        return create_card_from_upload(SimpleUploadedFile('card.png', card_image(seed)))
+
+    def test_job_stops_at_its_deadline_in_the_worker_thread(self):
+        # Nothing is ever read, so without a deadline every pass would run
+        engine = FakeOCREngine(text='', delay=0.05)
+        pool = CardJobWorkerPool(workers=1, timeout=0.2, processor=fake_processor(engine))
+        card = self.queue_card()
+
+        started = time.monotonic()
+        self.assertEqual(pool.run_pending(), 1)
+        self.assertLess(time.monotonic() - started, 2)
+
+        card.refresh_from_db()
+        self.assertEqual(card.status, StudentCard.STATUS_DONE)
+        self.assertIn('deadline', card.budget_violations)
+        self.assertIsNone(card.processor_version)
+        calls = engine.calls
+        time.sleep(0.1)
+        # No thread is left running OCR for the card
+        self.assertEqual(engine.calls, calls)
+
+    def test_stopping_the_pool_requeues_the_running_job(self):
+        engine = FakeOCREngine()
+        pool = CardJobWorkerPool(workers=1, processor=fake_processor(engine))
+        card = self.queue_card()
+        pool.stop(wait=False)
+
+        pool.run_job(claim_next_job())
+        card.refresh_from_db()
+        self.assertEqual(card.status, StudentCard.STATUS_PENDING)
+        self.assertEqual(engine.calls, 0)
+
+    def test_job_reads_the_card(self):
+        pool = CardJobWorkerPool(workers=1, processor=fake_processor())
+        card = self.queue_card()
+        pool.run_pending()
+        card.refresh_from_db()
+        self.assertEqual((card.status, card.student_id, card.name), (StudentCard.STATUS_DONE, '123456', 'Nguyễn Văn An'))
+
+
+@override_settings(STUDENT_CARD_JOB_START_IN_PROCESS=False)
+class BulkUploadViewTests(MediaTestMixin, TestCase):
+    def upload(self, *seeds, query=''):
+        files = [SimpleUploadedFile(f'card{i}.png', card_image(seed)) for i, seed in enumerate(seeds)]
+        return self.client.post(f"{reverse('bulk_upload')}?{query}", {'card_images': files})
+
+    def test_files_are_queued_not_processed(self):
+        with mock.patch('students.views.enqueue_card') as enqueue:
+            response = self.upload(1, 1, 2)
+        enqueue.assert_called_once_with()
+
+        cards = list(StudentCard.objects.all())
+        self.assertEqual({card.status for card in cards}, {StudentCard.STATUS_PENDING})
+        self.assertEqual(len(cards), 2)
+        self.assertEqual(len({card.batch_id for card in cards}), 1)
+        self.assertRedirects(response, reverse('bulk_status', kwargs={'batch_id': cards[0].batch_id}))
+
+        status = self.client.get(reverse('bulk_status_json', kwargs={'batch_id': cards[0].batch_id})).json()
+        self.assertEqual((status['pending'], status['total'], status['finished']), (2, 2, False))
+
+    def test_queued_cards_are_processed_by_the_workers(self):
+        response = self.upload(1, 2, query='format=json')
+        self.assertEqual(response.status_code, 202)
+        batch = response.json()
+        self.assertEqual((batch['queued'], batch['skipped']), (2, 0))
+
+        CardJobWorkerPool(workers=1, processor=fake_processor()).run_pending()
+        status = self.client.get(batch['status_url']).json()
+        self.assertEqual((status['done'], status['finished']), (2, True))
+        self.assertEqual(self.client.get(reverse('bulk_status', kwargs={'batch_id': batch['batch_id']})).status_code, 200)
+
+        again = self.upload(1, query='format=json').json()
+        self.assertEqual((again['queued'], again['skipped']), (0, 1))
+
+
+    def test_progress_reports_the_batch_throughput(self):
+        batch = self.upload(1, 2, 3, query='format=json').json()
+        self.assertIsNone(self.client.get(batch['status_url']).json()['cards_per_second'])
+
+        started = timezone.now()
+        cards = list(StudentCard.objects.order_by('id'))
+        for card, seconds in zip(cards, (1, 2)):
+            card.status = StudentCard.STATUS_DONE
+            card.started_at = started
+            card.finished_at = started + timedelta(seconds=seconds)
+            card.save()
+        cards[2].status = StudentCard.STATUS_FAILED
+        cards[2].started_at = started + timedelta(seconds=1)
+        cards[2].finished_at = started + timedelta(seconds=4)
+        cards[2].save()
+
+        status = self.client.get(batch['status_url']).json()
+        self.assertEqual((status['seconds'], status['cards_per_second']), (4, 0.75))
+        response = self.client.get(reverse('bulk_status', kwargs={'batch_id': batch['batch_id']}))
+        self.assertContains(response, "0.75 cards/sec")
+
+    def test_unreadable_archives_fail_without_stopping_the_upload(self):
+        files = [
+            SimpleUploadedFile('broken.zip', b'not an archive'),
+            SimpleUploadedFile('card.png', card_image(1)),
+        ]
+        response = self.client.post(f"{reverse('bulk_upload')}?format=json", {'card_images': files})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.json()['queued'], response.json()['failed']), (1, 1))
+        failed = StudentCard.objects.get(status=StudentCard.STATUS_FAILED)
+        self.assertIn("not a zip file", failed.error)
+
+        # A batch where nothing could be read still shows its failures
+        response = self.client.post(reverse('bulk_upload'), {'card_images': [SimpleUploadedFile('other.zip', b'junk')]})
+        batch_id = StudentCard.objects.latest('id').batch_id
+        self.assertRedirects(response, reverse('bulk_status', kwargs={'batch_id': batch_id}))
+
+
+class UploadSourcesTests(SimpleTestCase):
+    def read_all(self, *uploads):
+        sources = []
+        for source in iter_upload_sources(uploads):
+            try:
+                sources.append((source.name, source.read()))
+            except READ_ERRORS as exc:
+                sources.append((source.name, exc))
+        return sources
+
+    def test_archive_members_are_extracted_once(self):
+        upload = zip_upload('cards.zip', [('a.png', card_image(1)), ('notes.txt', b'x'), ('dir/b.png', card_image(2))])
+        with mock.patch.object(zipfile.ZipFile, 'read', autospec=True, side_effect=zipfile.ZipFile.read) as read:
+            sources = self.read_all(upload)
+        self.assertEqual(sources, [('a.png', card_image(1)), ('b.png', card_image(2))])
+        self.assertEqual(read.call_count, 2)
+
+    @override_settings(STUDENT_CARD_INGEST_MAX_IMAGE_BYTES=1000)
+    def test_oversized_images_are_never_extracted(self):
+        upload = zip_upload('cards.zip', [('big.png', b'\0' * 5000), ('small.png', b'png')])
+        with mock.patch.object(zipfile.ZipFile, 'read', autospec=True, side_effect=zipfile.ZipFile.read) as read:
+            (big, error), small = self.read_all(upload)
+        self.assertIsInstance(error, SourceTooLarge)
+        self.assertEqual(small, ('small.png', b'png'))
+        self.assertEqual(read.call_count, 1)
+        (_, error), = self.read_all(SimpleUploadedFile('big.png', b'\0' * 5000))
+        self.assertIsInstance(error, SourceTooLarge)
+
+    @override_settings(STUDENT_CARD_INGEST_MAX_ARCHIVE_IMAGES=2)
+    def test_archives_with_too_many_images_are_rejected_whole(self):
+        upload = zip_upload('cards.zip', [(f'{i}.png', b'png') for i in range(3)])
+        (name, error), = self.read_all(upload)
+        self.assertEqual(name, 'cards.zip')
+        self.assertIsInstance(error, SourceTooLarge)
+
+
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        self.card = StudentCard.objects.create(
+            image='student_cards/a.png', status=StudentCard.STATUS_DONE, processor_version='v1',
+            image_sha256='a' * 64, image_phash='0f' * 8, student_id='123456',
+        )
+
+    def test_exact_digest_hits(self):
+        cache = ResultCache(enabled=True, use_phash=False)
+        self.assertEqual(cache.lookup('v1', 'a' * 64), self.card)
+        self.assertIsNone(cache.lookup('v2', 'a' * 64))
+
+    def test_phash_hit_needs_confirmation(self):
+        cache = ResultCache(enabled=True, use_phash=True)
+        self.assertIsNone(cache.lookup('v1', 'b' * 64, '0f' * 8))
+        self.assertIsNone(cache.lookup('v1', 'b' * 64, '0f' * 8, confirm=lambda card: False))
+        checked = []
+        found = cache.lookup('v1', 'b' * 64, '0f' * 8, confirm=lambda card: checked.append(card) or True)
+        self.assertEqual((found, checked), (self.card, [self.card]))
+
+    def test_phash_is_only_computed_when_used(self):
+        image = np.zeros((20, 20, 3), np.uint8)
+        with mock.patch('students.result_cache.perceptual_hash') as phash:
+            self.assertIsNone(ResultCache(enabled=True, use_phash=False).phash(image))
+            phash.assert_not_called()
+            ResultCache(enabled=True, use_phash=True).phash(image)
+            phash.assert_called_once()
+
+
+class VisualizationCacheTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.card = create_card_from_upload(SimpleUploadedFile('card.png', card_image(1)))
+        self.cache = VisualizationCache(directory=os.path.join(self.media_root, 'visualizations'))
+        self.processor = fake_processor()
+
+    def test_renders_every_kind_without_leaving_temporary_files(self):
+        path = self.cache.get(self.card, 'combined', self.processor)
+        self.assertEqual(path, self.cache.path(self.card.id, 'combined'))
+        self.assertEqual(
+            sorted(os.listdir(self.cache.directory)),
+            sorted(os.path.basename(self.cache.path(self.card.id, kind)) for kind in StudentCard.VISUALIZATION_KINDS),
+        )
+
+    def test_failed_encoding_is_not_served(self):
+        with mock.patch('students.visualization.encode_image', return_value=None):
+            self.assertIsNone(self.cache.get(self.card, 'regions', self.processor))
+        self.assertFalse(os.path.exists(self.cache.path(self.card.id, 'regions')))
+
+    @override_settings(STUDENT_CARD_MAX_PIXELS=20000)
+    def test_original_is_decoded_within_the_pixel_budget(self):
+        with mock.patch.object(self.processor, 'prepare_image', wraps=self.processor.prepare_image) as prepare:
+            self.assertIsNotNone(self.cache.get(self.card, 'original', self.processor))
+        height, width = prepare.call_args[0][0].shape[:2]
+        self.assertLessEqual(height * width, 20000)
+
+    def test_view_refuses_to_render_when_the_limiter_is_full(self):
+        url = self.card.visualization_urls()['regions']
+        with mock.patch('students.views.get_processor', return_value=self.processor), \
+                mock.patch('students.visualization._cache', self.cache), \
+                mock.patch('students.visualization.get_limiter', return_value=ProcessingLimiter(workers=1, max_memory=1)):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(os.path.exists(self.cache.path(self.card.id, 'regions')))
+
+    def test_view_serves_the_configured_format(self):
+        url = self.card.visualization_urls()['original']
+        self.assertFalse(url.endswith('.jpg'))
+        with mock.patch('students.views.get_processor', return_value=self.processor), \
+                mock.patch('students.visualization._cache', self.cache):
+            response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            response.close()
+            with mock.patch('students.visualization.encode_image', return_value=None):
+                self.cache.remove(self.card.id)
+                self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(reverse('card_visualization', args=[self.card.id, 'bogus'])).status_code, 404)
+
+
+class ProcessUploadTests(MediaTestMixin, TestCase):
+    @override_settings(STUDENT_CARD_ASYNC_IMAGE_SAVE=True)
+    def test_original_is_stored_before_the_card_is_returned(self):
+        from django.core.files.storage import FileSystemStorage
+        save = FileSystemStorage.save
+
+        def slow_save(storage, *args, **kwargs):
+            time.sleep(0.2)
+            return save(storage, *args, **kwargs)
+
+        with mock.patch.object(FileSystemStorage, 'save', slow_save):
+            card = process_upload(SimpleUploadedFile('card.png', card_image(1)), fake_processor())
+        self.assertTrue(card.image.storage.exists(card.image.name))
+        self.assertEqual(card.student_id, '123456')
+
+    def test_disabled_cache_counts_no_lookup(self):
+        card = process_upload(
+            SimpleUploadedFile('card.png', card_image(1)), fake_processor(), ResultCache(enabled=False),
+        )
+        self.assertNotIn('cache_misses', card.timings)
+        self.assertNotIn('cache_hits', card.timings)
+
+        card = process_upload(
+            SimpleUploadedFile('card.png', card_image(2)), fake_processor(), ResultCache(enabled=True),
+        )
+        self.assertEqual(card.timings['cache_misses'], 1)
+
+    @override_settings(STUDENT_CARD_ASYNC_IMAGE_SAVE=True)
+    def test_failed_upload_leaves_no_file(self):
+        processor = fake_processor()
+        with mock.patch.object(processor, 'extract_card_info', side_effect=RuntimeError("OCR crashed")):
+            with self.assertRaises(RuntimeError):
+                process_upload(SimpleUploadedFile('card.png', card_image(1)), processor)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'student_cards')), [])
+        self.assertFalse(StudentCard.objects.exists())
+
+
+class CardSearchTests(TestCase):
+    def setUp(self):
+        for student_id, name in [('123456', 'Nguyen Van An'), ('123999', 'Tran Thi Mai'), ('223456', 'nguyen thi binh')]:
+            StudentCard.objects.create(image='student_cards/a.png', student_id=student_id, name=name)
+
+    def search(self, query):
+        from .views import search_cards
+        return sorted(search_cards(StudentCard.objects.all(), query).values_list('student_id', flat=True))
+
+    def test_student_id_prefix(self):
+        self.assertEqual(self.search('123'), ['123456', '123999'])
+        self.assertEqual(self.search('1234'), ['123456'])
+        self.assertEqual(self.search('23'), [])
+
+    def test_name_prefix_ignores_case(self):
+        self.assertEqual(self.search('nguyen'), ['123456', '223456'])
+        self.assertEqual(self.search('TRAN T'), ['123999'])
+        self.assertEqual(self.search('Van'), [])
+
+    def test_card_list_filters(self):
+        response = self.client.get(reverse('card_list'), {'q': 'tran'})
+        self.assertEqual([card.student_id for card in response.context['cards']], ['123999'])
+
+
+class ServingProcessTests(SimpleTestCase):
+    def serving(self, *argv, **environ):
+        with mock.patch.dict(os.environ, environ, clear=True):
+            return serving_process(list(argv))
+
+    def test_servers_and_card_commands_preload(self):
+        self.assertTrue(self.serving('/usr/bin/gunicorn', 'readcardstudent.wsgi'))
+        self.assertTrue(self.serving('/venv/lib/python3.11/site-packages/uvicorn/__main__.py', 'readcardstudent.asgi:application'))
+        self.assertTrue(self.serving('manage.py', 'run_card_workers'))
+        self.assertTrue(self.serving('manage.py', 'runserver', RUN_MAIN='true'))
+
+    def test_other_processes_do_not(self):
+        self.assertFalse(self.serving('manage.py', 'runserver'))
+        self.assertFalse(self.serving('manage.py', 'migrate'))
+        self.assertFalse(self.serving('/usr/bin/django-admin', 'shell'))
+        self.assertFalse(self.serving('/venv/bin/pytest', '-q'))
+        self.assertFalse(self.serving('scripts/export_cards.py'))
+        self.assertFalse(self.serving('celery', '-A', 'readcardstudent', 'worker'))
+
+    def test_environment_opts_in(self):
+        self.assertTrue(self.serving('scripts/serve.py', **{PRELOAD_ENV: '1'}))
+
+    def test_ocr_worker_processes_never_preload(self):
+        with mock.patch('students.registry._preload_disabled', True):
+            self.assertFalse(self.serving('/usr/bin/gunicorn', **{PRELOAD_ENV: '1'}))
+
+
+class PreloadingEngine(FakeOCREngine):
+    """Records the threads the language data was loaded in"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.preloaded = set()
+
+    def preload(self, configs):
+        with self._lock:
+            self.preloaded.add(threading.current_thread().name)
+
+
+class ExecutorPreloadTests(SimpleTestCase):
+    def test_every_ocr_thread_loads_the_engine_before_the_first_card(self):
+        engine = PreloadingEngine()
+        executor = ThreadOCRExecutor(3)
+        self.addCleanup(executor.shutdown)
+
+        executor.preload(engine, ['--psm 6 -l vie'])
+        self.assertEqual(len(engine.preloaded), 3)
+        self.assertTrue(all(name.startswith('ocr') for name in engine.preloaded))
+        self.assertNotIn(threading.current_thread().name, engine.preloaded)
+
+        def thread_name(engine, image, config, data):
+            return threading.current_thread().name
+
+        with mock.patch('students.executors.timed_ocr', thread_name):
+            used = set(executor.map_ocr(engine, range(12), ['--psm 6 -l vie'] * 12))
+        self.assertLessEqual(used, engine.preloaded)
+
+    def test_serial_ocr_loads_the_engine_in_the_limiter_threads(self):
+        engine = PreloadingEngine()
+        limiter = ProcessingLimiter(workers=2)
+        with mock.patch('students.limits.get_limiter', return_value=limiter):
+            SerialOCRExecutor().preload(engine, ['--psm 6 -l vie'])
+        self.assertEqual(len(engine.preloaded), 2)
+        self.assertTrue(all(name.startswith('card') for name in engine.preloaded))
+
+
+class ExtractCardInfoTests(SimpleTestCase):
+    def test_processed_image_is_built_only_on_request(self):
+        processor = fake_processor()
+        image = cv2.imdecode(np.frombuffer(card_image(1), np.uint8), cv2.IMREAD_COLOR)
+        votes = {}
+        processor.extract_card_info(image, votes=votes)
+
+        # Fields settled by an earlier image of the card need no OCR pass and no variant
+        graph = processor.preprocess(image)
+        info, processed = processor.extract_card_info(image, graph=graph, votes=votes)
+        self.assertEqual(info['student_id'], '123456')
+        self.assertIsNone(processed)
+        self.assertEqual(list(graph.built), [])
+
+        info, processed = processor.extract_card_info(image, graph=graph, votes=votes, processed=True)
+        self.assertEqual(set(graph.built) & set(processor.PREPROCESSING_METHODS), {processor.PREPROCESSING_METHODS[0]})
+        self.assertEqual(processed.shape, image.shape[:2])
+
+
+class OCRWaveTests(SimpleTestCase):
+    def passes(self, count):
+        image = np.zeros((20, 20), dtype=np.uint8)
+        return [(f'pass{i}', image, '--psm 6 -l vie') for i in range(count)]
+
+    @override_settings(STUDENT_CARD_OCR_WAVE_SIZE=2)
+    def test_waves_are_capped_below_the_pool_size(self):
+        engine = FakeOCREngine()
+        executor = ThreadOCRExecutor(8)
+        self.addCleanup(executor.shutdown)
+        processor = fake_processor(engine)
+        processor.executor = executor
+
+        outcomes, settled = processor.run_ocr_passes(self.passes(6), {})
+        self.assertTrue(settled)
+        self.assertEqual([key for key, _, _ in outcomes], ['pass0'])
+        # Only the first wave ran, the other four passes were skipped
+        self.assertEqual(engine.calls, 2)
+
+    @override_settings(STUDENT_CARD_OCR_WAVE_SIZE=4)
+    def test_waves_never_exceed_the_workers(self):
+        engine = FakeOCREngine()
+        processor = fake_processor(engine)
+
+        processor.run_ocr_passes(self.passes(6), {})
+        self.assertEqual(engine.calls, 1)
+
+
+    @override_settings(STUDENT_CARD_OCR_WAVE_SIZE=3)
+    def test_thread_executor_votes_like_a_serial_run(self):
+        # Each config reads another name, the first pass is the slowest to finish
+        readings = {
+            '--psm 6': ("THE SINH VIEN\nNguyen Van An\n123456", 60, 0.06),
+            '--psm 11': ("THE SINH VIEN\nNguyen Van Anh\n123456", 60, 0.03),
+            '--psm 7': ("THE SINH VIEN\nNguyen Van An\n123458", 50, 0),
+        }
+
+        class ConfigEngine(FakeOCREngine):
+            def image_to_data(self, image, config=''):
+                text, confidence, delay = readings[config]
+                time.sleep(delay)
+                return [(line, confidence) for line in text.splitlines()]
+
+        passes = [(config, np.zeros((20, 20), dtype=np.uint8), config) for config in readings] * 2
+        executor = ThreadOCRExecutor(3)
+        self.addCleanup(executor.shutdown)
+        results = []
+        for ocr_executor in (SerialOCRExecutor(), executor):
+            processor = fake_processor(ConfigEngine())
+            processor.executor = ocr_executor
+            votes = {}
+            outcomes, settled = processor.run_ocr_passes(passes, votes)
+            results.append((
+                [key for key, _, _ in outcomes], settled,
+                {field: list(values.items()) for field, values in votes.items()},
+                processor.resolve_votes(votes),
+            ))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][3]['name'], 'Nguyen Van An')
+
+
+class MemoryAdmissionTests(SimpleTestCase):
+    def test_process_memory_refuses_new_requests(self):
+        limiter = ProcessingLimiter(workers=1, max_queued=0, max_memory=1)
+        with self.assertRaises(CapacityExceeded):
+            async_to_sync(limiter.run)(lambda: None)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_process_memory_is_not_a_card_violation(self):
+        with override_settings(STUDENT_CARD_MAX_MEMORY=1), card_budget(deadline=60) as budget:
+            self.assertFalse(budget.exhausted())
+        self.assertEqual(budget.violations, [])
+
+
+class BenchmarkRunnerTests(SimpleTestCase):
+    def test_only_the_variants_extraction_asks_for_are_built(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'card.png')
+        with open(path, 'wb') as f:
+            f.write(card_image(1))
+
+        runner = BenchmarkRunner(processor=fake_processor(), visualize=False)
+        report = runner.run([(path, {'student_id': '123456'})])
+
+        record = report['records'][0]
+        # The first pass settles every field, no other variant is built and no regions are detected
+        self.assertEqual((record['ocr_calls'], record['variants']), (1, 1))
+        self.assertFalse(record['regions'])
+        self.assertNotIn('regions', record['timings'])
+        self.assertEqual(report['accuracy']['student_id']['correct'], 1)
+        self.assertEqual(report['variants_per_card'], 1)
+
+
+class CardListTests(TestCase):
+    def test_cursor_is_decoded(self):
+        uploaded_at, card_id = parse_card_cursor('2024-05-01T10:20:30.123456+00:00_42')
+        self.assertEqual((uploaded_at.isoformat(), card_id), ('2024-05-01T10:20:30.123456+00:00', 42))
+
+    def test_invalid_cursors_give_the_first_page(self):
+        for value in (None, '', 'garbage', '42', '2024-05-01T10:20:30_', '2024-05-01T10:20:30_x1', '2024-13-45T10:20:30_1'):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_card_cursor(value))
+        self.assertEqual(self.client.get(reverse('card_list'), {'after': '2024-13-45T10:20:30_1'}).status_code, 200)
+
+    @override_settings(STUDENT_CARD_LIST_PAGE_SIZE=2)
+    def test_pages_follow_the_cursor_without_gaps(self):
+        cards = [StudentCard.objects.create(name=f"Card {i}", status=StudentCard.STATUS_DONE) for i in range(5)]
+        # Same upload time for all, so the id breaks the ties
+        StudentCard.objects.update(uploaded_at=cards[0].uploaded_at)
+
+        seen, after = [], None
+        while True:
+            response = self.client.get(reverse('card_list'), {'after': after} if after else {})
+            seen += [card.id for card in response.context['cards']]
+            after = response.context['next_cursor']
+            if after is None:
+                break
+        self.assertEqual(seen, [card.id for card in reversed(cards)])
+
+
+class ProcessingLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.limiter = ProcessingLimiter(workers=1, max_queued=1, retry_after=3, max_memory=0)
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def block(self):
+        self.started.set()
+        self.release.wait(5)
+        return 'first'
+
+    async def wait_started(self):
+        while not self.started.is_set():
+            await asyncio.sleep(0.01)
+
+    def test_full_pool_and_queue_are_rejected_and_a_cancelled_queued_card_frees_its_place(self):
+        ran = []
+
+        async def scenario():
+            first = asyncio.ensure_future(self.limiter.run(self.block))
+            await self.wait_started()
+            queued = asyncio.ensure_future(self.limiter.run(ran.append, 'queued'))
+            await asyncio.sleep(0)
+            self.assertEqual(self.limiter.in_flight, 2)
+
+            with self.assertRaises(CapacityExceeded) as raised:
+                await self.limiter.run(ran.append, 'rejected')
+            self.assertEqual(raised.exception.retry_after, 3)
+
+            queued.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await queued
+            self.assertEqual(self.limiter.in_flight, 1)
+
+            self.release.set()
+            self.assertEqual(await first, 'first')
+            self.assertEqual(self.limiter.in_flight, 0)
+            await self.limiter.run(ran.append, 'later')
+
+        async_to_sync(scenario)()
+        self.assertEqual(ran, ['later'])
+
+    def test_cancelling_a_running_card_stops_it_at_the_next_check(self):
+        stopped = threading.Event()
+
+        def work():
+            self.started.set()
+            try:
+                while True:
+                    check_cancelled()
+                    time.sleep(0.01)
+            except ProcessingCancelled:
+                stopped.set()
+                raise
+
+        async def scenario():
+            running = asyncio.ensure_future(self.limiter.run(work))
+            await self.wait_started()
+            running.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await running
+
+        async_to_sync(scenario)()
+        self.assertTrue(stopped.wait(2))
+        deadline = time.monotonic() + 2
+        while self.limiter.in_flight and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+
+class RosterIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = RosterIndex([
+            RosterEntry('123456', 'Nguyễn Văn An', '01/02/2003'),
+            RosterEntry('123457', 'Trần Thị Bình', '03/04/2002'),
+            RosterEntry('654321', 'Lê Minh Châu'),
+        ], name_threshold=0.8)
+
+    def test_exact_id_comes_before_ids_one_digit_off(self):
+        candidates = [(entry.student_id, exact) for entry, exact in self.index.candidates('123456')]
+        self.assertEqual(candidates, [('123456', True), ('123457', False)])
+        self.assertEqual([entry.student_id for entry, _ in self.index.candidates('123450')], ['123456', '123457'])
+        self.assertEqual(self.index.candidates('993456'), [])
+        self.assertEqual(self.index.candidates(''), [])
+
+    def test_exact_id_is_confirmed_by_the_name(self):
+        match = self.index.match('123456', 'NGUYEN VAN AN', '01-02-2003')
+        self.assertEqual((match.entry.student_id, match.exact_id, match.dob_match), ('123456', True, True))
+        self.assertIsNone(self.index.match('123456', 'Phạm Quốc Việt'))
+        # A contradicting date of birth rules the student out
+        self.assertIsNone(self.index.match('123456', 'Nguyễn Văn An', '02/02/2003'))
+        # No date of birth on either side doesn't
+        self.assertIsNone(self.index.match('654321', 'Lê Minh Châu', '01/01/2001').dob_match)
+
+    def test_misread_digit_needs_the_date_of_birth(self):
+        match = self.index.match('123459', 'Trần Thị Bình', '03/04/2002')
+        self.assertEqual((match.entry.student_id, match.exact_id), ('123457', False))
+        self.assertIsNone(self.index.match('123459', 'Trần Thị Bình'))
+        self.assertIsNone(self.index.match('654320', 'Lê Minh Châu', '01/01/2001'))
+
+
+class GetRosterTests(TestCase):
+    def test_invalidation_between_the_check_and_the_lock_rebuilds(self):
+        stale = RosterIndex([])
+        stale.built_at -= 3600
+
+        class InvalidatingLock:
+            """Lock taken just after another thread invalidated the roster"""
+            def __enter__(self):
+                invalidate_roster()
+
+            def __exit__(self, *exc_info):
+                pass
+
+        with mock.patch.object(roster, '_roster', stale), mock.patch.object(roster, '_roster_lock', InvalidatingLock()):
+            index = get_roster()
+            self.assertIsInstance(index, RosterIndex)
+            self.assertIsNot(index, stale)
+            self.assertIs(roster._roster, index)
+
+
+class OCRCascadeTests(TestCase):
+    CONFIGS = {'default': '--psm 3', 'block': '--psm 6'}
+
+    def cascade(self, **kwargs):
+        cascade = OCRCascade(**{'learning': True, 'min_samples': 5, 'refresh_interval': 0, **kwargs})
+        # Write what is left while the test database exists, not at exit
+        self.addCleanup(cascade.flush)
+        return cascade
+
+    def test_learned_passes_run_by_fields_per_second_before_unknown_ones(self):
+        OCRPassStat.objects.create(variant='adaptive', config='default', attempts=10, fields_found=10, total_time=10)
+        OCRPassStat.objects.create(variant='otsu', config='block', attempts=10, fields_found=40, total_time=10)
+        # Too few samples to be ranked
+        OCRPassStat.objects.create(variant='otsu', config='default', attempts=2, fields_found=100, total_time=1)
+
+        self.assertEqual(self.cascade().plan(('adaptive', 'otsu'), self.CONFIGS), [
+            ('otsu', 'block'), ('adaptive', 'default'), ('adaptive', 'block'), ('otsu', 'default'),
+        ])
+
+    def test_least_sampled_pass_runs_first_every_explore_every_cards(self):
+        OCRPassStat.objects.create(variant='adaptive', config='default', attempts=50, fields_found=50, total_time=10)
+        OCRPassStat.objects.create(variant='adaptive', config='block', attempts=30, fields_found=10, total_time=10)
+        OCRPassStat.objects.create(variant='otsu', config='default', attempts=20, fields_found=1, total_time=10)
+        OCRPassStat.objects.create(variant='otsu', config='block', attempts=40, fields_found=5, total_time=10)
+        cascade = self.cascade(explore_every=3, flush_interval=3600)
+
+        plans = [cascade.plan(('adaptive', 'otsu'), self.CONFIGS)[0] for _ in range(3)]
+        self.assertEqual(plans, [('adaptive', 'default'), ('adaptive', 'default'), ('otsu', 'default')])
+
+        # Samples recorded but not written yet count as well
+        for _ in range(20):
+            cascade.record([('otsu', 'default', 1, 0.1)])
+        plans = [cascade.plan(('adaptive', 'otsu'), self.CONFIGS)[0] for _ in range(3)]
+        self.assertEqual(plans, [('adaptive', 'default'), ('adaptive', 'default'), ('adaptive', 'block')])
+
+    def test_without_learning_the_default_order_is_kept(self):
+        OCRPassStat.objects.create(variant='otsu', config='block', attempts=10, fields_found=40, total_time=10)
+        self.assertEqual(self.cascade(learning=False).plan(('adaptive', 'otsu'), self.CONFIGS), [
+            ('adaptive', 'default'), ('adaptive', 'block'), ('otsu', 'default'), ('otsu', 'block'),
+        ])
+
+    def test_recorded_outcomes_are_summed_on_flush(self):
+        cascade = self.cascade(flush_interval=3600)
+        cascade.record([('otsu', 'block', 3, 0.5)])
+        cascade.record([('otsu', 'block', 2, 0.25), ('adaptive', 'default', 0, 1.0)])
+        self.assertFalse(OCRPassStat.objects.exists())
+
+        cascade.flush()
+        stat = OCRPassStat.objects.get(variant='otsu', config='block')
+        self.assertEqual((stat.attempts, stat.fields_found, stat.total_time), (2, 5, 0.75))
+        self.assertEqual(OCRPassStat.objects.count(), 2)
+
+    def test_outcomes_are_added_to_a_row_another_process_created_meanwhile(self):
+        cascade = self.cascade(flush_interval=3600)
+        cascade.record([('otsu', 'block', 3, 0.5)])
+        update = QuerySet.update
+        calls = []
+
+        def racing_update(queryset, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                # The other process inserts the row after this update found none
+                OCRPassStat.objects.create(variant='otsu', config='block', attempts=10, fields_found=4, total_time=2)
+                return 0
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=racing_update):
+            cascade.flush()
+        stat = OCRPassStat.objects.get(variant='otsu', config='block')
+        self.assertEqual((stat.attempts, stat.fields_found, stat.total_time), (11, 7, 2.5))
+
+
+class CardFileReleaseTests(MediaTestMixin, TestCase):
+    def test_shared_files_are_deleted_with_the_last_card(self):
+        storage = card_image_storage()
+        image = storage.save('student_cards/card.png', SimpleUploadedFile('card.png', card_image(1)))
+        thumbnail = default_storage.save('thumbnails/card.jpg', SimpleUploadedFile('card.jpg', b'thumbnail'))
+        first, second = (StudentCard.objects.create(image=image, thumbnail=thumbnail) for _ in range(2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.exists(image))
+        self.assertTrue(default_storage.exists(thumbnail))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(storage.exists(image))
+        self.assertFalse(default_storage.exists(thumbnail))
+
+    def test_files_are_kept_when_the_deletion_is_rolled_back(self):
+        image = card_image_storage().save('student_cards/card.png', SimpleUploadedFile('card.png', card_image(1)))
+        card = StudentCard.objects.create(image=image)
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            card.delete()
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(card_image_storage().exists(image))
+
+
+class OCREngineTests(SimpleTestCase):
+    def test_missing_tesserocr_falls_back_to_pytesseract(self):
+        with mock.patch.dict('sys.modules', {'tesserocr': None, 'pytesseract': mock.MagicMock()}):
+            with self.assertLogs('students.ocr_engines', 'WARNING'):
+                engine = create_ocr_engine('tesserocr')
+        self.assertIsInstance(engine, PytesseractEngine)
+
+    def test_missing_pytesseract_is_an_error(self):
+        with mock.patch.dict('sys.modules', {'pytesseract': None}):
+            with self.assertRaises(ImportError):
+                create_ocr_engine('pytesseract')
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            create_ocr_engine('ocrmypdf')
+
+    @override_settings(STUDENT_CARD_TESSERACT_THREADS=1)
+    def test_tesseract_threads_are_capped_unless_set(self):
+        with mock.patch.dict(os.environ, clear=True):
+            limit_tesseract_threads()
+            self.assertEqual(os.environ['OMP_THREAD_LIMIT'], '1')
+        with mock.patch.dict(os.environ, {'OMP_THREAD_LIMIT': '4'}):
+            limit_tesseract_threads()
+            self.assertEqual(os.environ['OMP_THREAD_LIMIT'], '4')
+
+    @override_settings(STUDENT_CARD_TESSERACT_THREADS=None)
+    def test_tesseract_threads_can_be_left_alone(self):
+        with mock.patch.dict(os.environ, clear=True):
+            limit_tesseract_threads()
+            self.assertNotIn('OMP_THREAD_LIMIT', os.environ)
+
+    def test_config_is_parsed_for_the_api(self):
+        self.assertEqual(
+            parse_tesseract_config('--oem 1 --psm 7 -l vie -c tessedit_char_whitelist=0123456789'),
+            ('vie', 1, 7, {'tessedit_char_whitelist': '0123456789'}),
+        )
+
+
+def rotated_card(angle, card_size=(500, 315), canvas=(900, 700)):
+    """A white card with a dark marker in its top left corner, rotated on a dark background
+
+    Returns:
+        Tuple of (BGR image, the card's corners as top-left, top-right, bottom-right, bottom-left)
+    """
+    width, height = card_size
+    card = np.full((height, width, 3), 245, np.uint8)
+    card[20:70, 20:90] = 30
+    for y in range(120, 300, 40):
+        card[y:y + 12, 140:460] = 40
+
+    image = np.full((canvas[1], canvas[0], 3), 25, np.uint8)
+    center = (canvas[0] / 2, canvas[1] / 2)
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    matrix[:, 2] += (center[0] - width / 2, center[1] - height / 2)
+    mask = cv2.warpAffine(np.full((height, width), 255, np.uint8), matrix, canvas)
+    image[mask > 0] = cv2.warpAffine(card, matrix, canvas)[mask > 0]
+    corners = np.array([[0, 0, 1], [width, 0, 1], [width, height, 1], [0, height, 1]], np.float32) @ matrix.T
+    return image, corners
+
+
+class CardGeometryTests(SimpleTestCase):
+    def test_order_corners(self):
+        corners = order_corners([[90, 10], [10, 60], [10, 10], [90, 60]])
+        self.assertEqual(corners.tolist(), [[10, 10], [90, 10], [90, 60], [10, 60]])
+
+    def test_rotated_card_outline_is_found(self):
+        image, corners = rotated_card(12)
+        found = find_card_quad(image)
+        self.assertIsNotNone(found)
+        self.assertLess(np.abs(found - corners).max(), 8)
+
+    def test_rotated_card_is_warped_upright(self):
+        image, _ = rotated_card(-9)
+        card = normalize_card(image)
+        self.assertEqual(card.shape[:2], (CARD_SIZE[1], CARD_SIZE[0]))
+        # The marker is back in the top left corner, the background is cropped away
+        scale_x, scale_y = CARD_SIZE[0] / 500, CARD_SIZE[1] / 315
+        marker = card[int(25 * scale_y):int(65 * scale_y), int(25 * scale_x):int(85 * scale_x)]
+        self.assertLess(marker.mean(), 60)
+        self.assertGreater(card[:, -int(30 * scale_x):].mean(), 200)
+
+    def test_portrait_photo_becomes_landscape(self):
+        image, _ = rotated_card(90)
+        self.assertEqual(normalize_card(image).shape[:2], (CARD_SIZE[1], CARD_SIZE[0]))
+
+    def test_card_without_outline_is_deskewed(self):
+        lines = np.full((400, 600, 3), 255, np.uint8)
+        for y in range(60, 340, 40):
+            lines[y:y + 10, 80:520] = 0
+        matrix = cv2.getRotationMatrix2D((300, 200), 6, 1.0)
+        skewed = cv2.warpAffine(lines, matrix, (600, 400), borderValue=(255, 255, 255))
+        self.assertAlmostEqual(abs(skew_angle(skewed)), 6, delta=1)
+
+        straight = normalize_card(skewed)
+        self.assertLess(abs(skew_angle(straight)), 1)
+        self.assertEqual(straight.shape, skewed.shape)
+
+
+# Gray level each layout zone is filled with, so the fake engine can tell the crops apart
+ZONE_LEVEL_OF = {name: 20 + 25 * i for i, name in enumerate(StudentCardProcessor.FIELDS)}
+ZONE_LEVELS = {level: name for name, level in ZONE_LEVEL_OF.items()}
+
+
+class ZoneEngine(FakeOCREngine):
+    """Reads the text of the layout zone a crop was taken from, found by the crop's gray level"""
+
+    def __init__(self, texts, confidence=90):
+        super().__init__()
+        self.texts = texts
+        self.confidence = confidence
+        self.configs = []
+
+    def image_to_string(self, image, config=''):
+        self._count()
+        self.configs.append(config)
+        return "DAI HOC DONG A\nTHE SINH VIEN"
+
+    def image_to_data(self, image, config=''):
+        self._count()
+        self.configs.append(config)
+        level = int(image[image.shape[0] // 2, image.shape[1] // 2].flat[0])
+        text = self.texts.get(ZONE_LEVELS.get(level), '')
+        return [(text, self.confidence)] if text else []
+
+
+def zone_card(layout):
+    """Gray card with every field zone of the layout filled with its own gray level"""
+    width, height = CARD_SIZE
+    image = np.full((height, width), 255, np.uint8)
+    for zone in layout.fields:
+        crop_relative(image, zone.rect)[:] = ZONE_LEVEL_OF[zone.name]
+    return image
+
+
+class CardLayoutTests(SimpleTestCase):
+    texts = {
+        'university': "ĐẠI HỌC ĐÔNG Á",
+        'student_card': "THẺ SINH VIÊN",
+        'name': "Nguyễn Văn An",
+        'dob': "Ngày 01/02/2003",
+        'class': "20CT1",
+        'cohort': "2020 - 2024",
+        'student_id': "MSSV 123456",
+    }
+
+    def setUp(self):
+        self.layout = CardLayout.from_file(os.path.join(LAYOUT_DIR, 'dong_a_university.json'))
+        self.extractor = LayoutExtractor([self.layout])
+        self.image = zone_card(self.layout)
+
+    def test_layout_is_matched_by_its_header_keywords(self):
+        engine = ZoneEngine(self.texts)
+        self.assertIs(self.extractor.match(self.image, engine, SerialOCRExecutor()), self.layout)
+        self.assertEqual(engine.configs, ['--oem 3 --psm 6 -l vie'])
+        self.assertEqual(self.layout.match_score("Truong Cao Dang"), 0)
+
+    def test_each_zone_is_read_with_its_own_config(self):
+        engine = ZoneEngine(self.texts)
+        found = self.extractor.extract(self.image, self.layout, engine, SerialOCRExecutor())
+
+        self.assertEqual(engine.calls, len(self.layout.fields))
+        self.assertIn('--oem 3 --psm 7 -l vie -c tessedit_char_whitelist=0123456789', engine.configs)
+        # Zone patterns keep the field value only
+        self.assertEqual(found['dob'], ('01/02/2003', 0.9))
+        self.assertEqual(found['student_id'], ('123456', 0.9))
+        self.assertEqual(found['name'], ('Nguyễn Văn An', 0.9))
+
+    def test_invalid_zone_text_and_other_fields_are_dropped(self):
+        engine = ZoneEngine({**self.texts, 'dob': "01 02"})
+        found = self.extractor.extract(self.image, self.layout, engine, SerialOCRExecutor(), ['dob', 'student_id'])
+        self.assertEqual(engine.calls, 2)
+        self.assertEqual(set(found), {'student_id'})
+
+    def test_settled_zones_need_no_full_card_pass(self):
+        engine = ZoneEngine(self.texts, confidence=95)
+        processor = fake_processor(engine)
+        processor.layouts = self.extractor
+
+        info, _ = processor.extract_card_info(cv2.cvtColor(self.image, cv2.COLOR_GRAY2BGR))
+        self.assertEqual(info['student_id'], '123456')
+        self.assertEqual(info['class'], '20CT1')
+        # One header call and one call per zone
+        self.assertEqual(engine.calls, 1 + len(self.layout.fields))
+
+
+class TextRegionTests(SimpleTestCase):
+    def setUp(self):
+        self.processor = fake_processor()
+        self.image = np.full((400, 1000, 3), 255, np.uint8)
+        for i, line in enumerate(("DAI HOC DONG A", "THE SINH VIEN", "Nguyen Van An", "123456")):
+            cv2.putText(self.image, line, (500 + 30 * i, 60 + 60 * i), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+
+    def test_overlap_is_relative_to_the_smaller_box(self):
+        overlap = StudentCardProcessor._overlap_ratio
+        self.assertEqual(overlap((0, 0, 10, 10), (20, 0, 10, 10)), 0.0)
+        self.assertEqual(overlap((0, 0, 10, 10), (10, 0, 10, 10)), 0.0)
+        self.assertEqual(overlap((0, 0, 100, 40), (10, 10, 20, 10)), 1.0)
+        self.assertEqual(overlap((0, 0, 10, 10), (5, 0, 10, 20)), 0.5)
+
+    def test_lines_are_found_in_reading_order(self):
+        regions = self.processor.detect_text_regions(self.image)
+        self.assertEqual(len(regions), 4)
+        self.assertEqual(regions, sorted(regions, key=lambda box: (box[1], box[0])))
+        for x, y, w, h in regions:
+            self.assertGreater(w, h)
+
+    def test_boxes_inside_a_kept_box_are_merged(self):
+        # An L shaped rule whose box holds a word that doesn't touch it
+        self.image[300:303, 40:400] = 0
+        self.image[300:345, 40:43] = 0
+        cv2.putText(self.image, "20CT1", (90, 335), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+        regions = self.processor.detect_text_regions(self.image)
+        self.assertEqual(len(regions), 5)
+        self.assertIn((41, 300, 360, 45), regions)
+
+        self.processor.region_overlap = 1.0
+        self.assertEqual(len(self.processor.detect_text_regions(self.image)), 6)
+
+    def test_region_count_is_capped(self):
+        self.processor.max_regions = 2
+        self.assertEqual(len(self.processor.detect_text_regions(self.image)), 2)
+
+    def test_stitched_image_holds_every_region(self):
+        regions = [(0, 0, 50, 20), (950, 380, 50, 20), (500, 40, 120, 30)]
+        stitched = self.processor.stitch_regions(self.image, regions, padding=5)
+        self.assertEqual(stitched.shape, (20 + 20 + 30 + 5 * 4, 120 + 2 * 5))
+
+        gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        top = 5
+        for x, y, w, h in regions:
+            np.testing.assert_array_equal(stitched[top:top + h, 5:5 + w], gray[y:y + h, x:x + w])
+            # Padding around each region stays white
+            self.assertTrue((stitched[top:top + h, 5 + w:] == 255).all())
+            top += h + 5
+
+
+class ConfidenceVotingTests(SimpleTestCase):
+    def setUp(self):
+        self.processor = fake_processor()
+
+    def test_readings_of_one_value_combine_as_independent(self):
+        votes = {}
+        self.processor.add_vote(votes, 'name', 'Nguyen Van An', 0.6)
+        self.processor.add_vote(votes, 'name', 'Nguyen Van An', 0.6)
+        self.assertAlmostEqual(votes['name']['Nguyen Van An'], 1 - 0.4 * 0.4)
+        self.processor.add_vote(votes, 'name', 'Nguyen Van An', 0.5)
+        self.assertAlmostEqual(votes['name']['Nguyen Van An'], 1 - 0.4 * 0.4 * 0.5)
+
+    def test_other_values_keep_their_own_votes(self):
+        votes = {}
+        self.processor.add_vote(votes, 'student_id', '123456', 0.7)
+        self.processor.add_vote(votes, 'student_id', '123458', 0.5)
+        self.processor.add_vote(votes, 'student_id', '123458', 0.5)
+        self.assertEqual(votes['student_id'], {'123456': 0.7, '123458': 0.75})
+        # Two weaker readings agreeing beat one stronger reading
+        info = self.processor.resolve_votes(votes)
+        self.assertEqual(info['student_id'], '123458')
+        self.assertEqual(info['confidence'], {'student_id': 0.75})
+        self.assertIsNone(info['name'])
+
+    def test_ties_go_to_the_value_seen_first(self):
+        votes = {'class': {'20CT1': 0.6, '20CTI': 0.6}}
+        self.assertEqual(self.processor.resolve_votes(votes)['class'], '20CT1')
+
+    def test_line_confidence_weights_the_vote(self):
+        votes = {}
+        lines = [("THẺ SINH VIÊN", 80), ("Nguyễn Văn An", 70), ("Ngày sinh: 01/02/2003", 60), ("123456", 90)]
+        found = self.processor.collect_votes(lines, votes)
+        self.assertEqual(found, 4)
+        self.assertAlmostEqual(votes['name']['Nguyễn Văn An'], 0.7)
+        self.assertAlmostEqual(votes['dob']['01/02/2003'], 0.6)
+        self.assertAlmostEqual(votes['student_id']['123456'], 0.9)
+
+        self.processor.collect_votes([("Ngày sinh: 01/02/2003", 60)], votes)
+        self.assertAlmostEqual(votes['dob']['01/02/2003'], 0.84)
+
+    def test_field_settles_at_the_minimum_confidence(self):
+        self.processor.min_confidence = 0.85
+        votes = {}
+        self.processor.add_vote(votes, 'dob', '01/02/2003', 0.6)
+        self.processor.add_vote(votes, 'dob', '01/02/2003', 0.6)
+        self.assertFalse(self.processor.field_settled(votes, 'dob'))
+        self.processor.add_vote(votes, 'dob', '01/02/2003', 0.1)
+        self.assertTrue(self.processor.field_settled(votes, 'dob'))
+        self.assertFalse(self.processor.fields_settled(votes))
+
+
+class MetricsFormatTests(SimpleTestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry()
+        histogram = registry.register(Histogram('card_seconds', "Card time", ['stage'], buckets=(0.1, 1)))
+        histogram.observe(0.05, stage='ocr')
+        histogram.observe(0.5, stage='ocr')
+        histogram.observe(5, stage='ocr')
+        self.assertEqual(registry.render(), (
+            '# HELP card_seconds Card time\n'
+            '# TYPE card_seconds histogram\n'
+            'card_seconds_bucket{stage="ocr",le="0.1"} 1\n'
+            'card_seconds_bucket{stage="ocr",le="1"} 2\n'
+            'card_seconds_bucket{stage="ocr",le="+Inf"} 3\n'
+            'card_seconds_sum{stage="ocr"} 5.55\n'
+            'card_seconds_count{stage="ocr"} 3\n'
+        ))
+
+    def test_counter_labels_are_escaped(self):
+        registry = MetricsRegistry()
+        counter = registry.register(Counter('events_total', "Events", ['event']))
+        counter.inc(event='say "hi"\\\n')
+        counter.inc(2)
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'events_total{event="say \\"hi\\"\\\\\\n"} 1',
+            'events_total{event=""} 2',
+        ])
+
+    def test_unlabelled_gauge(self):
+        registry = MetricsRegistry()
+        registry.register(CallbackGauge('workers', "Workers", [], lambda: {(): 4}))
+        self.assertEqual(registry.render().splitlines()[-1], 'workers 4')
+
+
+class MetricsViewTests(TestCase):
+    def test_pipeline_metrics_are_scraped(self):
+        StudentCard.objects.create(image='student_cards/a.png', status=StudentCard.STATUS_PENDING)
+        with metrics.stage('decode'):
+            pass
+        metrics.count('ocr_calls', 3)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE student_card_stage_seconds histogram', lines)
+        self.assertIn('# TYPE student_card_events_total counter', lines)
+        self.assertIn('student_card_queue_depth{status="pending"} 1', lines)
+        self.assertIn('student_card_queue_depth{status="processing"} 0', lines)
+        self.assertTrue(any(line.startswith('student_card_stage_seconds_count{stage="decode"} ') for line in lines))
+        self.assertTrue(any(line.startswith('student_card_events_total{event="ocr_calls"} ') for line in lines))
+        # Every sample is a metric name, optional labels and a number
+        for line in lines:
+            if not line.startswith('#'):
+                float(line.rsplit(' ', 1)[1])
+
+    def test_disabled_metrics_are_not_found(self):
+        with mock.patch.object(metrics, '_enabled', False):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+
+def eager_variants(image):
+    """The preprocessed images as apply_preprocessing_methods built them before the graph, all at once"""
+    gray = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2GRAY)
+    adaptive = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    _, otsu = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    _, equalized = cv2.threshold(cv2.equalizeHist(gray), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    _, bilateral = cv2.threshold(cv2.bilateralFilter(gray, 9, 75, 75), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    kernel = np.ones((1, 1), np.uint8)
+    morph = cv2.morphologyEx(cv2.morphologyEx(otsu, cv2.MORPH_CLOSE, kernel), cv2.MORPH_OPEN, kernel)
+    edges = cv2.dilate(cv2.Canny(gray, 100, 200), kernel, iterations=1)
+    _, edge = cv2.threshold(cv2.bitwise_and(gray, gray, mask=edges), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    _, inverted = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return {
+        'adaptive': adaptive, 'otsu': otsu, 'equalized': equalized, 'bilateral': bilateral,
+        'morph': morph, 'edge': edge, 'otsu_inv': inverted,
+    }
+
+
+class PreprocessingGraphTests(SimpleTestCase):
+    def images(self):
+        yield 'noise', cv2.imdecode(np.frombuffer(card_image(3), np.uint8), cv2.IMREAD_COLOR)
+        yield 'card', normalize_card(rotated_card(7)[0])
+
+    def test_variants_equal_the_eager_ones(self):
+        for label, image in self.images():
+            graph = PreprocessingGraph(image)
+            for name, expected in eager_variants(image).items():
+                with self.subTest(image=label, variant=name):
+                    np.testing.assert_array_equal(graph[name], expected)
+
+    def test_only_the_asked_variant_and_its_inputs_are_built(self):
+        graph = PreprocessingGraph(rotated_card(7)[0])
+        graph['equalized']
+        self.assertEqual(graph.built, ('gray', 'equalized'))
+        graph['otsu_inv']
+        self.assertEqual(graph.built, ('gray', 'equalized', 'otsu', 'otsu_inv'))
+
+    def test_aliases_share_one_image(self):
+        graph = PreprocessingGraph(rotated_card(7)[0])
+        self.assertIs(graph['morph'], graph['otsu'])
+        self.assertEqual(
+            [method for method, _ in graph.variants(StudentCardProcessor.PREPROCESSING_METHODS)],
+            ['adaptive', 'otsu', 'equalized', 'bilateral', 'edge'],
+        )
+
+
+@override_settings(STUDENT_CARD_API_TOKENS=[])
+class RecognizeApiTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('students.services.get_processor', return_value=fake_processor())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_batch(self, *files, **extra):
+        return self.client.post(reverse('api_recognize_batch') + '?fields_only=1', {'images': list(files)}, **extra)
+
+    def test_unreadable_archive_fails_its_entry_only(self):
+        response = self.post_batch(
+            SimpleUploadedFile('card.png', card_image(1)), SimpleUploadedFile('broken.zip', b'not a zip'),
+        )
+        self.assertEqual(response.status_code, 200)
+        first, second = response.json()['results']
+        self.assertEqual(first['fields']['student_id'], '123456')
+        self.assertEqual(second['name'], 'broken.zip')
+        self.assertIn('Could not read image', second['error'])
+
+    def test_fields_only_card(self):
+        response = self.client.post(
+            reverse('api_recognize') + '?fields_only=1', {'image': SimpleUploadedFile('card.png', card_image(1))},
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['fields']['name'], 'Nguyễn Văn An')
+        self.assertNotIn('cached', result)
+        self.assertFalse(StudentCard.objects.exists())
+
+    @override_settings(STUDENT_CARD_API_TOKENS=['s3cret'])
+    def test_token_is_required_when_configured(self):
+        image = card_image(1)
+        url = reverse('api_recognize') + '?fields_only=1'
+        for header in (None, 'Bearer wrong', 's3cret', 'Basic s3cret'):
+            with self.subTest(header=header):
+                extra = {'HTTP_AUTHORIZATION': header} if header else {}
+                response = self.client.post(url, {'image': SimpleUploadedFile('card.png', image)}, **extra)
+                self.assertEqual(response.status_code, 401)
+        for header in ('Bearer s3cret', 'Token s3cret'):
+            with self.subTest(header=header):
+                response = self.client.post(
+                    url, {'image': SimpleUploadedFile('card.png', image)}, HTTP_AUTHORIZATION=header,
+                )
+                self.assertEqual(response.status_code, 200)
+
+    @override_settings(STUDENT_CARD_API_MAX_BATCH=2)
+    def test_too_many_images_are_refused(self):
+        archive = zip_upload('cards.zip', [(f'{i}.png', card_image(i)) for i in range(3)])
+        response = self.post_batch(archive)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json(), {'error': "At most 2 images per batch"})
+
+        archive = zip_upload('cards.zip', [(f'{i}.png', card_image(i)) for i in range(2)])
+        self.assertEqual(len(self.post_batch(archive).json()['results']), 2)
+
+    def test_busy_server_answers_429(self):
+        limiter = ProcessingLimiter(workers=1, max_queued=0, max_memory=1)
+        with mock.patch('students.api.get_limiter', return_value=limiter):
+            for response in (
+                self.client.post(reverse('api_recognize'), {'image': SimpleUploadedFile('card.png', card_image(1))}),
+                self.post_batch(SimpleUploadedFile('card.png', card_image(1))),
+            ):
+                self.assertEqual(response.status_code, 429)
+                self.assertEqual(response['Retry-After'], str(limiter.retry_after))
+                self.assertIn('error', response.json())
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_only_post_is_allowed(self):
+        self.assertEqual(self.client.get(reverse('api_recognize')).status_code, 405)
+        self.assertEqual(self.client.post(reverse('api_recognize')).status_code, 400)
+
+
+class StreamReaderTests(SimpleTestCase):
+    def setUp(self):
+        self.card, _ = rotated_card(5)
+        self.empty = np.full_like(self.card, 25)
+        self.engine = FakeOCREngine()
+        self.reader = StreamReader(fake_processor(self.engine), window=4, min_sharpness=50, reset_after=2)
+
+    def blurred(self, size):
+        return cv2.GaussianBlur(self.card, (size, size), 0)
+
+    def test_sharper_frames_score_higher(self):
+        scores = [score_frame(frame) for frame in (self.card, self.blurred(5), self.blurred(21))]
+        self.assertTrue(all(score.card for score in scores))
+        self.assertEqual(scores, sorted(scores, key=lambda score: -score.sharpness))
+        self.assertFalse(score_frame(self.empty).card)
+
+    def test_sharpest_frame_with_a_card_is_picked(self):
+        frames = [self.blurred(9), self.empty, self.card, self.blurred(5)]
+        score, frame = self.reader.best_frame(enumerate(frames))
+        self.assertEqual(score.index, 2)
+        self.assertIs(frame, self.card)
+
+    def test_blurred_and_empty_frames_are_skipped(self):
+        self.reader.min_sharpness = 100
+        self.assertIsNone(self.reader.best_frame(enumerate([self.empty, self.blurred(21)])))
+
+    def test_one_frame_per_window_is_read_until_settled(self):
+        frames = [self.blurred(9), self.card, self.empty, self.blurred(5)] * 3
+        results = list(self.reader.run(frames))
+        self.assertEqual([result['frame'] for result in results], [1, 5, 9])
+        self.assertTrue(all(result['settled'] for result in results))
+        self.assertEqual(results[-1]['fields']['student_id'], '123456')
+        # The card settled on the first frame read, later windows run no OCR
+        self.assertEqual(self.engine.calls, 1)
+
+    def test_votes_are_dropped_once_the_card_is_gone(self):
+        results = list(self.reader.run([self.card] * 4 + [self.empty] * 8 + [self.card] * 4))
+        self.assertEqual([result['frame'] for result in results], [0, None, None, 12])
+        self.assertEqual(results[1]['fields']['student_id'], '123456')
+        self.assertIsNone(results[2]['fields']['student_id'])
+        self.assertEqual(self.engine.calls, 2)
@@ -1,9 +1,20 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.home, name='home'),
     path('upload/', views.upload_card, name='upload_card'),
+    path('upload/bulk/', views.bulk_upload, name='bulk_upload'),
+    path('upload/bulk/<uuid:batch_id>/', views.bulk_status, name='bulk_status'),
+    path('upload/bulk/<uuid:batch_id>/status/', views.bulk_status_json, name='bulk_status_json'),
     path('cards/', views.card_list, name='card_list'),
     path('cards/<int:card_id>/', views.card_detail, name='card_detail'),
+    path('cards/<int:card_id>/visualizations/<str:kind>/', views.card_visualization, name='card_visualization'),
+    path('jobs/<uuid:job_id>/', views.job_status, name='job_status'),
+    path('jobs/<uuid:job_id>/status/', views.job_status_json, name='job_status_json'),
+    path('cache/stats/', views.cache_stats, name='cache_stats'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('api/cards/', api.api_recognize, name='api_recognize'),
+    path('api/cards/batch/', api.api_recognize_batch, name='api_recognize_batch'),
+    path('api/cards/verify/', api.api_verify, name='api_verify'),
 ]
\ No newline at end of file
@@ -1,246 +1,426 @@
 import cv2
 import numpy as np
-import pytesseract
-import re
+import hashlib
+import itertools
 import os
 from django.conf import settings
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')  # Use Agg backend to avoid GUI dependency
+
+from . import metrics
+from .cascade import OCRCascade
+from .executors import get_ocr_executor
+from .geometry import CARD_SIZE, normalize_card
+from .layouts import LayoutExtractor
+from .limits import budget_exhausted, budget_violation, check_cancelled
+from .parser import FIELDS, default_parser, tokenize_data
+from .preprocessing import PreprocessingGraph, distinct_methods
+from .ocr_engines import get_ocr_engine
 
 class StudentCardProcessor:
-    def __init__(self):
+    # Bump when a pipeline change alters extraction results, so cached results are not reused
+    VERSION = 4
+    
+    # Fields extracted from the card, in the order they are shown
+    FIELDS = FIELDS
+    
+    # Preprocessing methods in the order apply_preprocessing_methods yields them
+    PREPROCESSING_METHODS = ('adaptive', 'otsu', 'equalized', 'bilateral', 'morph', 'edge')
+    
+    # Methods worth an OCR pass, without the ones identical to another method
+    OCR_METHODS = distinct_methods(PREPROCESSING_METHODS)
+    
+    # Variants whose layout zones are read again for fields still below the confidence threshold
+    LAYOUT_RETRY_METHODS = ('otsu', 'equalized')
+    
+    def __init__(self, engine=None, cascade=None, executor=None):
         """Initialize the processor with multiple OCR configurations"""
-        # Configure pytesseract path if running on Windows
-        # Uncomment and modify this if needed
-        # pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+        # OCR backend selected by settings.STUDENT_CARD_OCR_ENGINE
+        self.engine = engine or get_ocr_engine()
+        
+        # Runs independent OCR passes in parallel, see settings.STUDENT_CARD_OCR_EXECUTOR
+        self.executor = executor or get_ocr_executor()
+        # Full-card passes started together, the early exit can only skip the later waves
+        self.wave_size = getattr(settings, 'STUDENT_CARD_OCR_WAVE_SIZE', 2)
+        
+        # Order of the OCR passes, learned from which passes yield fields
+        self.cascade = cascade or OCRCascade()
+        
+        # Single pass field parser with patterns compiled at import
+        self.parser = default_parser
+        
+        # Combined confidence (0-1) a field value needs before the field is settled
+        self.min_confidence = getattr(settings, 'STUDENT_CARD_MIN_FIELD_CONFIDENCE', 0.85)
+        
+        # Upper bound on the text lines OCR'd per card, and the overlap above which boxes are merged
+        self.max_regions = getattr(settings, 'STUDENT_CARD_MAX_REGIONS', 40)
+        # Contours examined when detecting regions, noise images can produce many thousands
+        self.max_contours = getattr(settings, 'STUDENT_CARD_MAX_CONTOURS', 2000)
+        self.region_overlap = getattr(settings, 'STUDENT_CARD_REGION_OVERLAP', 0.5)
+        
+        # Crop, deskew and resize photos to a fixed card size before any other stage
+        self.normalize = getattr(settings, 'STUDENT_CARD_NORMALIZE', True)
+        self.card_size = tuple(getattr(settings, 'STUDENT_CARD_CANONICAL_SIZE', CARD_SIZE))
+        
+        # Targeted per-field OCR for known card layouts, needs normalized cards
+        self.layouts = LayoutExtractor() if self.normalize and getattr(settings, 'STUDENT_CARD_USE_LAYOUTS', True) else None
         
         # Configure pytesseract for Vietnamese language with various PSM modes
         self.config_default = r'--oem 3 --psm 6 -l vie'  # Default - Assume a single uniform block of text
         self.config_sparse = r'--oem 3 --psm 11 -l vie'  # Sparse text - Find as much text as possible without assuming structure
         self.config_single_line = r'--oem 3 --psm 7 -l vie'  # Single line - Treat the image as a single text line
+        
+        self.ocr_configs = {
+            'default': self.config_default,
+            'sparse': self.config_sparse,
+            'single_line': self.config_single_line,
+        }
     
-    def apply_preprocessing_methods(self, image):
-        """Apply multiple preprocessing techniques and return results
+    @property
+    def version(self):
+        """Identifies the pipeline and configuration that produced a result"""
+        key = '|'.join([
+            str(self.VERSION),
+            self.engine.name,
+            *self.ocr_configs.values(),
+            str(self.min_confidence),
+            f"{self.normalize}:{self.card_size}",
+            self.layouts.key if self.layouts else '',
+            f"{self.max_regions}:{self.region_overlap}",
+        ])
+        return hashlib.sha1(key.encode()).hexdigest()[:12]
+    
+    def prepare_image(self, image):
+        """Localize the card and normalize it to the canonical size
         
         Returns:
-            List of preprocessed images with different techniques
+            The normalized card, or the image unchanged when normalization is disabled
         """
-        # Make a copy of the original image
-        img = image.copy()
-        
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Method 1: Adaptive thresholding
-        adaptive_thresh = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
-        )
-        
-        # Method 2: Otsu's thresholding
-        _, otsu_thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Method 3: Histogram equalization
-        equalized = cv2.equalizeHist(gray)
-        _, equalized_thresh = cv2.threshold(equalized, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Method 4: Bilateral filtering to reduce noise while preserving edges
-        bilateral = cv2.bilateralFilter(gray, 9, 75, 75)
-        _, bilateral_thresh = cv2.threshold(bilateral, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Method 5: Morphological operations
-        kernel = np.ones((1, 1), np.uint8)
-        morph = cv2.morphologyEx(otsu_thresh, cv2.MORPH_CLOSE, kernel)
-        morph = cv2.morphologyEx(morph, cv2.MORPH_OPEN, kernel)
-        
-        # Method 6: Edge enhancement
-        edges = cv2.Canny(gray, 100, 200)
-        dilated_edges = cv2.dilate(edges, kernel, iterations=1)
-        edge_enhanced = cv2.bitwise_and(gray, gray, mask=dilated_edges)
-        _, edge_thresh = cv2.threshold(edge_enhanced, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Return the processed images
-        return [
-            adaptive_thresh,
-            otsu_thresh,
-            equalized_thresh,
-            bilateral_thresh,
-            morph,
-            edge_thresh
-        ]
+        if not self.normalize:
+            return image
+        with metrics.stage('normalize'):
+            return normalize_card(image, self.card_size)
+    
+    def preprocess(self, image):
+        """Lazily computed preprocessed versions of an image, sharing their intermediates"""
+        return PreprocessingGraph(image)
     
-    def detect_text_regions(self, image):
-        """Detect potential text regions in the image"""
-        # Convert to grayscale if not already
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
+    def apply_preprocessing_methods(self, image, graph=None):
+        """Apply multiple preprocessing techniques and return results
         
-        # Apply threshold to get binary image
-        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        Images are built one at a time as they are consumed, and methods that
+        give the same image as an earlier one (morph is otsu) are skipped.
         
-        # Find contours
-        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        Yields:
+            Preprocessed images in PREPROCESSING_METHODS order
+        """
+        graph = graph or self.preprocess(image)
+        for _, processed in graph.variants(self.PREPROCESSING_METHODS):
+            yield processed
+    
+    def detect_text_regions(self, image, graph=None):
+        """Detect text lines in the image
         
-        # Filter contours based on area and aspect ratio
-        text_regions = []
+        Characters are merged into lines with a wide closing kernel, overlapping
+        boxes are suppressed and at most max_regions lines are kept, so the cost
+        of region OCR is bounded even on noisy photos.
+        
+        Args:
+            graph: PreprocessingGraph of the image, to reuse its grayscale and Otsu images
+        
+        Returns:
+            List of (x, y, w, h) boxes in reading order
+        """
+        graph = graph or self.preprocess(image)
+        img_height, img_width = image.shape[:2]
+        
+        # Inverted Otsu threshold, shared with the otsu preprocessing variant
+        binary = graph['otsu_inv']
+        
+        # Merge neighbouring characters into text lines
+        kernel_width = max(img_width // 50, 3)
+        line_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_width, 3))
+        lines = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, line_kernel)
+        
+        # Find contours
+        contours, _ = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) > self.max_contours:
+            # Only the largest contours can become regions, skip filtering the rest
+            budget_violation('regions')
+            contours = sorted(contours, key=cv2.contourArea, reverse=True)[:self.max_contours]
+        
+        # Filter contours based on size, shape and ink density
+        candidates = []
         for contour in contours:
             x, y, w, h = cv2.boundingRect(contour)
             area = w * h
-            aspect_ratio = w / float(h)
             
             # Filter out very small or very large regions
-            if area > 200 and area < gray.shape[0] * gray.shape[1] * 0.5:
-                # Filter based on aspect ratio (typical text regions aren't too wide or too tall)
-                if 0.1 < aspect_ratio < 10:
-                    text_regions.append((x, y, w, h))
+            if area <= 200 or area >= img_height * img_width * 0.5:
+                continue
+            # Text lines are wider than tall and not taller than a quarter of the card
+            if w < h or h < 8 or h > img_height * 0.25:
+                continue
+            # Mostly empty boxes are noise, solid boxes are photos or bars
+            density = cv2.countNonZero(binary[y:y+h, x:x+w]) / float(area)
+            if not 0.05 < density < 0.9:
+                continue
+            candidates.append((area, (x, y, w, h)))
+        
+        # Keep the largest boxes first, dropping the ones mostly inside a kept box
+        text_regions = []
+        for _, box in sorted(candidates, reverse=True):
+            if any(self._overlap_ratio(box, kept) > self.region_overlap for kept in text_regions):
+                continue
+            text_regions.append(box)
+            if len(text_regions) >= self.max_regions:
+                break
         
+        # Reading order: top to bottom, then left to right
+        text_regions.sort(key=lambda box: (box[1], box[0]))
+        metrics.count('regions', len(text_regions))
         return text_regions
     
+    @staticmethod
+    def _overlap_ratio(box, other):
+        """Intersection area divided by the area of the smaller box"""
+        x, y, w, h = box
+        ox, oy, ow, oh = other
+        inter_w = min(x + w, ox + ow) - max(x, ox)
+        inter_h = min(y + h, oy + oh) - max(y, oy)
+        if inter_w <= 0 or inter_h <= 0:
+            return 0.0
+        return inter_w * inter_h / float(min(w * h, ow * oh))
+    
+    def stitch_regions(self, image, regions, padding=10):
+        """Stack the text regions into one white image for a single OCR call"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+        width = max(w for _, _, w, _ in regions) + 2 * padding
+        height = sum(h for _, _, _, h in regions) + padding * (len(regions) + 1)
+        
+        stitched = np.full((height, width), 255, dtype=np.uint8)
+        top = padding
+        for x, y, w, h in regions:
+            stitched[top:top+h, padding:padding+w] = gray[y:y+h, x:x+w]
+            top += h + padding
+        return stitched
+    
     def apply_ocr_with_multiple_configs(self, image):
         """Apply OCR with multiple configurations and combine results"""
         # Apply OCR with different configurations
-        text_default = pytesseract.image_to_string(image, config=self.config_default)
-        text_sparse = pytesseract.image_to_string(image, config=self.config_sparse)
-        text_single_line = pytesseract.image_to_string(image, config=self.config_single_line)
+        with metrics.stage('ocr'):
+            (text_default, _), (text_sparse, _), (text_single_line, _) = self.executor.map_ocr(
+                self.engine,
+                [image] * 3,
+                [self.config_default, self.config_sparse, self.config_single_line],
+            )
+        metrics.count('ocr_calls', 3)
         
         # Combine all texts for comprehensive analysis
         combined_text = text_default + "\n" + text_sparse + "\n" + text_single_line
         
         return combined_text
     
-    def extract_card_info(self, image):
-        """Extract student information from ID card using multiple techniques"""
-        # Get preprocessed images
-        processed_images = self.apply_preprocessing_methods(image)
-        
-        # Apply OCR on each preprocessed image and combine results
-        all_text = ""
-        for processed in processed_images:
-            text = self.apply_ocr_with_multiple_configs(processed)
-            all_text += text + "\n"
-        
-        # Detect text regions for targeted OCR
-        text_regions = self.detect_text_regions(image)
-        
-        # Extract text from specific regions
-        for x, y, w, h in text_regions:
-            roi = image[y:y+h, x:x+w]
-            # Check if ROI is valid
-            if roi.size > 0:
-                roi_text = pytesseract.image_to_string(roi, config=self.config_default)
-                all_text += roi_text + "\n"
-        
-        # Initialize dictionary for student information
-        student_info = {
-            'university': None,
-            'student_card': None,
-            'name': None,
-            'dob': None,
-            'student_id': None,
-            'class': None,
-            'cohort': None
-        }
+    @staticmethod
+    def add_vote(votes, field, value, confidence):
+        """Add a vote for a field value, weighted by the OCR confidence of the line it came from
         
-        # Extract university name - looking for Dong A University in various formats
-        univ_patterns = [
-            r'(ĐẠI HỌC ĐÔNG Á|DONG A UNIVERSITY|ĐAI HOC ĐÔNG Á|DAI HOC DONG A)',
-            r'ĐÔNG Á', 
-            r'DONG A'
-        ]
-        
-        for pattern in univ_patterns:
-            univ_match = re.search(pattern, all_text, re.IGNORECASE)
-            if univ_match:
-                student_info['university'] = univ_match.group(0)
-                break
+        Votes for the same value combine as independent readings: the value
+        is wrong only if every reading of it is wrong, so two passes at 0.6
+        give 0.84.
+        """
+        field_votes = votes.setdefault(field, {})
+        field_votes[value] = 1 - (1 - field_votes.get(value, 0.0)) * (1 - confidence)
+    
+    def collect_votes(self, lines, votes):
+        """Parse one word-level OCR result and vote for every field value found
         
-        # Extract card type - looking for student card in various formats
-        card_patterns = [
-            r'(THẺ SINH VIÊN|STUDENT CARD|THE SINH VIEN)', 
-            r'THẺ\s+SINH\s+VIÊN',
-            r'THE\s+SINH\s+VIEN'
-        ]
-        
-        for pattern in card_patterns:
-            card_match = re.search(pattern, all_text, re.IGNORECASE)
-            if card_match:
-                student_info['student_card'] = card_match.group(0)
-                break
+        Args:
+            lines: List of (line text, confidence) from engine.image_to_data
+            votes: Field votes, updated in place
         
-        # Extract student name using multiple patterns
-        name_patterns = [
-            # After "THE SINH VIEN"
-            r'(?:THẺ SINH VIÊN|THE SINH VIEN)[^\n]*\n+([^\n:]+)',
-            # Vietnamese names (capital first letters with diacritics)
-            r'([A-ZÀÁÂÃÈÉÊÌÍÒÓÔÕÙÚĂĐĨŨƠƯĂẠẢẤẦẨẪẬẮẰẲẴẶẸẺẼỀỀỂỄỆỈỊỌỎỐỒỔỖỘỚỜỞỠỢỤỦỨỪỮỰỲỴỶỸ][a-zàáâãèéêìíòóôõùúăđĩũơưăạảấầẩẫậắằẳẵặẹẻẽềềểễệỉịọỏốồổỗộớờởỡợụủứừữựỳỵỷỹ\s]+\s+[A-ZÀÁÂÃÈÉÊÌÍÒÓÔÕÙÚĂĐĨŨƠƯĂẠẢẤẦẨẪẬẮẰẲẴẶẸẺẼỀỀỂỄỆỈỊỌỎỐỒỔỖỘỚỜỞỠỢỤỦỨỪỮỰỲỴỶỸ][a-zàáâãèéêìíòóôõùúăđĩũơưăạảấầẩẫậắằẳẵặẹẻẽềềểễệỉịọỏốồổỗộớờởỡợụủứừữựỳỵỷỹ\s]+)',
-            # Vietnamese names without diacritics
-            r'([A-Z][a-z]+\s+[A-Z][a-z]+\s+[A-Z][a-z]+)'
-        ]
-        
-        for pattern in name_patterns:
-            name_match = re.search(pattern, all_text, re.IGNORECASE)
-            if name_match:
-                student_info['name'] = name_match.group(1).strip()
-                break
+        Returns:
+            Number of fields found in the result
+        """
+        with metrics.stage('parse'):
+            result = self.parser.parse_lines(tokenize_data(lines))
+        confidences = result.sources
+        for field, value in result.fields.items():
+            self.add_vote(votes, field, value, confidences[field])
+        return len(confidences)
+    
+    def field_settled(self, votes, field):
+        """Check whether a field has a value with enough combined confidence"""
+        return bool(votes.get(field)) and max(votes[field].values()) >= self.min_confidence
+    
+    def fields_settled(self, votes):
+        """Check whether every field is settled"""
+        return all(self.field_settled(votes, field) for field in self.FIELDS)
+    
+    def resolve_votes(self, votes):
+        """Pick the most confident value for every field, earliest seen on ties
         
-        # Extract date of birth with multiple patterns
-        dob_patterns = [
-            r'Ngày sinh\s*:\s*(\d{2}/\d{2}/\d{4})',
-            r'Ngay sinh\s*:\s*(\d{2}/\d{2}/\d{4})',
-            r'DOB\s*:\s*(\d{2}/\d{2}/\d{4})',
-            r'(\d{2}/\d{2}/\d{4})'
-        ]
-        
-        for pattern in dob_patterns:
-            dob_match = re.search(pattern, all_text)
-            if dob_match:
-                student_info['dob'] = dob_match.group(1)
-                break
+        Returns:
+            Dictionary of field values, with the confidence of each value
+            found under the 'confidence' key
+        """
+        student_info = dict.fromkeys(self.FIELDS)
+        confidence = {}
+        for field, field_votes in votes.items():
+            value = max(field_votes, key=field_votes.get)
+            student_info[field] = value
+            confidence[field] = round(field_votes[value], 3)
+        student_info['confidence'] = confidence
+        return student_info
+    
+    def run_ocr_passes(self, passes, votes):
+        """Run OCR passes on the executor in waves, stopping once every field is settled
         
-        # Extract student ID (typically 5-6 digits)
-        id_patterns = [
-            r'(?<!\d)(\d{5,6})(?!\d)',
-            r'ID\s*:\s*(\d{5,6})',
-            r'Student ID\s*:\s*(\d{5,6})'
-        ]
-        
-        for pattern in id_patterns:
-            id_match = re.search(pattern, all_text)
-            if id_match:
-                student_info['student_id'] = id_match.group(1)
-                break
+        A wave holds at most self.wave_size passes, fewer when the executor
+        has fewer workers, so passes left after the fields settle are not run.
+
+        Args:
+            passes: Iterable of (key, image, config) tuples in the order to try them,
+                only consumed one wave at a time so images can be built lazily
+            votes: Field votes, updated in place
         
-        # Extract class code with multiple patterns
-        class_patterns = [
-            r'Lớp\s*:\s*([A-Z0-9]+)',
-            r'Lop\s*:\s*([A-Z0-9]+)',
-            r'Class\s*:\s*([A-Z0-9]+)'
-        ]
-        
-        for pattern in class_patterns:
-            class_match = re.search(pattern, all_text)
-            if class_match:
-                student_info['class'] = class_match.group(1)
+        Returns:
+            Tuple of (list of (key, fields_found, seconds) for the passes used, settled flag)
+        """
+        outcomes = []
+        passes = iter(passes)
+        wave_size = max(1, min(self.wave_size, self.executor.workers))
+        while True:
+            wave = list(itertools.islice(passes, wave_size))
+            if not wave:
                 break
-        
-        # Extract cohort years with multiple patterns
-        cohort_patterns = [
-            r'Khóa\s*:\s*(\d{4}\s*-\s*\d{4})',
-            r'Khoa\s*:\s*(\d{4}\s*-\s*\d{4})',
-            r'Course\s*:\s*(\d{4}\s*-\s*\d{4})'
-        ]
-        
-        for pattern in cohort_patterns:
-            cohort_match = re.search(pattern, all_text)
-            if cohort_match:
-                student_info['cohort'] = cohort_match.group(1).strip()
+            check_cancelled()
+            if budget_exhausted():
+                # Out of time, the fields read so far are the result
                 break
+            with metrics.stage('ocr'):
+                results = self.executor.map_ocr(
+                    self.engine,
+                    [image for _, image, _ in wave],
+                    [config for _, _, config in wave],
+                    data=True,
+                )
+            metrics.count('ocr_calls', len(wave))
+            # Results are consumed in pass order, so the outcome matches a serial run
+            for (key, _, _), (lines, seconds) in zip(wave, results):
+                outcomes.append((key, self.collect_votes(lines, votes), seconds))
+                if self.fields_settled(votes):
+                    return outcomes, True
+        return outcomes, False
+    
+    def vote_layout(self, image, layout, votes, fields=None):
+        """Read the layout's field zones and vote for the values found"""
+        for field, (value, confidence) in self.layouts.extract(
+                image, layout, self.engine, self.executor, fields).items():
+            self.add_vote(votes, field, value, confidence)
+    
+    def extract_card_info(self, image, text_regions=None, graph=None, votes=None, processed=False):
+        """Extract student information from ID card using multiple techniques
+
+        Cards matching a known layout are read with one targeted OCR call per
+        field first, and zones read with low confidence are retried on other
+        preprocessed images. Full-card passes then run in the order chosen by
+        the cascade, only while some field is below the confidence threshold,
+        so clean scans only pay for a few OCR calls. When the card's budget
+        (see students.limits.CardBudget) runs out, no more passes start and the
+        fields read so far are returned.
+        
+        Args:
+            votes: Field votes carried over from earlier images of the same
+                card, updated in place. Fields they settle are not read again.
+            processed: Also return the first processed image, for visualization.
+                Building it can cost a preprocessing step no OCR pass needed.
+        
+        Returns:
+            Tuple of (field values with their 'confidence', processed image or None)
+        """
+        # Preprocessed images are built lazily, only for the passes that run
+        graph = graph or self.preprocess(image)
+        
+        votes = {} if votes is None else votes
+        outcomes = []
+        
+        # Known layout: one targeted OCR call per field, then retries for the uncertain ones
+        check_cancelled()
+        if self.layouts is not None and not self.fields_settled(votes):
+            with metrics.stage('layout'):
+                layout = self.layouts.match(image, self.engine, self.executor)
+                if layout is not None:
+                    # None reads the card itself, the retry variants only what is still uncertain
+                    for variant in (None, *self.LAYOUT_RETRY_METHODS):
+                        uncertain = [zone.name for zone in layout.fields if not self.field_settled(votes, zone.name)]
+                        if not uncertain or budget_exhausted():
+                            break
+                        if variant is None:
+                            variant_image = image
+                        else:
+                            with metrics.stage('preprocess'):
+                                variant_image = graph[variant]
+                        self.vote_layout(variant_image, layout, votes, uncertain)
+        
+        # Apply OCR pass by pass, parsing fields as results come in
+        settled = self.fields_settled(votes)
+        if not settled:
+            passes = (
+                ((variant, config_name), graph[variant], self.ocr_configs[config_name])
+                for variant, config_name in self.cascade.plan(self.OCR_METHODS, self.ocr_configs)
+            )
+            outcomes, settled = self.run_ocr_passes(passes, votes)
+        
+        if not settled and not budget_exhausted():
+            # Detect text regions for targeted OCR of the fields still missing
+            if text_regions is None:
+                with metrics.stage('regions'):
+                    text_regions = self.detect_text_regions(image, graph)
+            
+            # Read all regions with one OCR call on a stitched image, one line per region
+            if text_regions:
+                stitched = self.stitch_regions(image, text_regions)
+                self.run_ocr_passes([(None, stitched, self.config_default)], votes)
+        
+        self.cascade.record([
+            (variant, config_name, fields_found, seconds)
+            for (variant, config_name), fields_found, seconds in outcomes
+        ])
+        
+        if not processed:
+            return self.resolve_votes(votes), None
+        # Return the extracted information and the first processed image for visualization
+        with metrics.stage('preprocess'):
+            processed = graph[self.PREPROCESSING_METHODS[0]]
+        return self.resolve_votes(votes), processed
+    
+    def parse_fields(self, text):
+        """Apply the field patterns to OCR text
+        
+        Returns:
+            Dictionary with the fields that were found
+        """
+        return self.parser.parse(text).fields
+    
+    def warm_up(self):
+        """Run every stage once on a synthetic card, without recording any statistics
         
-        # Return the extracted information and the best processed image
-        return student_info, processed_images[0]  # Return first processed image for visualization
+        The OCR calls go through the executor, so its threads or processes
+        load their language data before the first real card.
+        """
+        width, height = self.card_size
+        card = np.full((height, width, 3), 255, dtype=np.uint8)
+        for i, line in enumerate(("DAI HOC DONG A", "THE SINH VIEN", "Nguyen Van An", "Lop: ST21A")):
+            cv2.putText(card, line, (width // 3, height // 6 * (i + 1)), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+        
+        image = self.prepare_image(card)
+        graph = self.preprocess(image)
+        self.detect_text_regions(image, graph)
+        list(self.apply_preprocessing_methods(image, graph))
+        
+        configs = list(self.ocr_configs.values()) * self.executor.workers
+        results = self.executor.map_ocr(self.engine, [graph['otsu']] * len(configs), configs, data=True)
+        for lines, _ in results:
+            self.collect_votes(lines, {})
     
     def visualize_text_regions(self, image, regions):
         """Visualize detected text regions on the image"""
@@ -257,50 +437,24 @@ class StudentCardProcessor:
     
     def save_visualization(self, original, processed, visualization, base_filename):
         """Save visualization images to Django's media folder"""
+        # Imported here so workers that never render visualizations don't pay for it
+        from .visualization import render_visualizations
+        
         # Create directory if it doesn't exist
         vis_dir = os.path.join(settings.MEDIA_ROOT, 'visualizations')
         os.makedirs(vis_dir, exist_ok=True)
         
-        # Generate unique filenames
-        original_path = os.path.join(vis_dir, f"{base_filename}_original.jpg")
-        processed_path = os.path.join(vis_dir, f"{base_filename}_processed.jpg")
-        regions_path = os.path.join(vis_dir, f"{base_filename}_regions.jpg")
-        combined_path = os.path.join(vis_dir, f"{base_filename}_combined.jpg")
-        
-        # Save individual images
-        cv2.imwrite(original_path, original)
-        cv2.imwrite(processed_path, processed)
-        cv2.imwrite(regions_path, visualization)
-        
-        # Create combined visualization using matplotlib
-        plt.figure(figsize=(15, 5))
-        
-        plt.subplot(1, 3, 1)
-        plt.title("Original Image")
-        plt.imshow(cv2.cvtColor(original, cv2.COLOR_BGR2RGB))
-        plt.axis('off')
-        
-        plt.subplot(1, 3, 2)
-        plt.title("Processed Image")
-        plt.imshow(processed, cmap='gray')
-        plt.axis('off')
-        
-        plt.subplot(1, 3, 3)
-        plt.title("Detected Text Regions")
-        plt.imshow(cv2.cvtColor(visualization, cv2.COLOR_BGR2RGB))
-        plt.axis('off')
-        
-        plt.tight_layout()
-        plt.savefig(combined_path)
-        plt.close()
+        # Save the individual images and the combined view
+        paths = {}
+        with metrics.stage('visualization'):
+            images = render_visualizations(original, processed, visualization)
+            for kind, image in images.items():
+                filename = f"{base_filename}_{kind}.jpg"
+                cv2.imwrite(os.path.join(vis_dir, filename), image)
+                paths[kind] = os.path.join('visualizations', filename)
         
         # Return paths relative to MEDIA_URL for template rendering
-        return {
-            'original': os.path.join('visualizations', f"{base_filename}_original.jpg"),
-            'processed': os.path.join('visualizations', f"{base_filename}_processed.jpg"),
-            'regions': os.path.join('visualizations', f"{base_filename}_regions.jpg"),
-            'combined': os.path.join('visualizations', f"{base_filename}_combined.jpg")
-        }
+        return paths
     
     def process_student_card(self, image_path):
         """Main function to process student ID card"""
@@ -311,14 +465,23 @@ class StudentCardProcessor:
         if image is None:
             return None, None, None, None
         
-        # Get a copy of the original image
-        original = image.copy()
+        return self.process_image(image)
+    
+    def process_image(self, image):
+        """Process an already decoded student ID card image"""
+        # Work on the card cropped to a small fixed size from here on
+        image = self.prepare_image(image)
         
-        # Extract information using enhanced techniques
-        info, processed = self.extract_card_info(image)
+        # Nothing below modifies the image, so it is kept as the original without a copy
+        original = image
+        graph = self.preprocess(image)
         
-        # Detect text regions for visualization
-        text_regions = self.detect_text_regions(original)
+        # Detect text regions once, for extraction and visualization
+        with metrics.stage('regions'):
+            text_regions = self.detect_text_regions(original, graph)
+        
+        # Extract information using enhanced techniques
+        info, processed = self.extract_card_info(image, text_regions, graph, processed=True)
         
         # Create visualization with detected text regions
         visualization = self.visualize_text_regions(original, text_regions)
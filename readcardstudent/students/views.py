@@ -1,75 +1,287 @@
-from django.shortcuts import render, redirect
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect, get_object_or_404
 from django.views import View
 from django.contrib import messages
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.urls import reverse
+from django.db.models import Count, Max, Min, Q, Value
+from django.db.models.functions import Concat, Upper
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import os
-import uuid
 
+from . import metrics
+from .ingest import iter_upload_sources, queue_sources
+from .jobs import background_processing_enabled, enqueue_card
+from .limits import PARTIAL_BUDGETS, CapacityExceeded, get_limiter
 from .models import StudentCard
-from .utils import StudentCardProcessor
+from .registry import get_processor
+from .result_cache import get_result_cache
+from .services import CardProcessingError, card_to_dict, create_card_from_upload, process_upload
+from .storage import content_type
 
 def home(request):
     """Home page view"""
     return render(request, 'students/home.html')
 
-def upload_card(request):
-    """View for handling card uploads"""
+async def upload_card(request):
+    """View for handling card uploads
+    
+    OCR runs on the bounded processing pool, so the event loop keeps serving
+    other clients meanwhile. When the pool and its queue are full the upload
+    is refused with 429 instead of waiting.
+    """
     if request.method == 'POST' and request.FILES.get('card_image'):
         # Get the uploaded image
         image_file = request.FILES['card_image']
         
-        # Save the model with image
-        student_card = StudentCard(image=image_file)
-        student_card.save()
+        # In background mode the worker pool picks the card up and the user polls its status
+        if background_processing_enabled():
+            # Save the model with image, reusing the stored file if the same image was uploaded before
+            student_card = await sync_to_async(create_card_from_upload)(image_file)
+            await sync_to_async(enqueue_card)()
+            return redirect('job_status', job_id=student_card.job_id)
         
-        # Get the file path of the saved image
-        image_path = student_card.image.path
-        
-        # Process the student card image
-        processor = StudentCardProcessor()
-        info, original, processed, visualization = processor.process_student_card(image_path)
-        
-        if info:
-            # Update the model with extracted information
-            student_card.university = info.get('university')
-            student_card.student_card_type = info.get('student_card')
-            student_card.name = info.get('name')
-            student_card.dob = info.get('dob')
-            student_card.student_id = info.get('student_id')
-            student_card.class_name = info.get('class')
-            student_card.cohort = info.get('cohort')
-            student_card.save()
-            
-            # Generate unique filename for visualizations
-            base_filename = f"card_{student_card.id}_{uuid.uuid4().hex[:8]}"
-            vis_paths = processor.save_visualization(original, processed, visualization, base_filename)
+        # Process the image from memory, the card is only saved once it has its results
+        try:
+            student_card = await get_limiter().run(process_upload, image_file)
+        except CapacityExceeded as exc:
+            messages.error(request, "The server is busy processing other cards. Please try again in a moment.")
+            response = await sync_to_async(render)(request, 'students/upload.html', status=429)
+            response['Retry-After'] = str(exc.retry_after)
+            return response
+        except CardProcessingError:
+            # If processing failed, show error
+            messages.error(request, "Failed to process the student card. Please try again with a clearer image.")
+        else:
+            metrics.card_finished(StudentCard.STATUS_DONE)
+            if any(budget in PARTIAL_BUDGETS for budget in student_card.budget_violations):
+                messages.warning(
+                    request, "Reading the card took too long, some fields may be missing."
+                )
             
             # Prepare context for template
             context = {
                 'student_card': student_card,
-                'visualizations': vis_paths,
+                'visualizations': student_card.visualization_urls(),
                 'success': True
             }
             
-            return render(request, 'students/result.html', context)
-        else:
-            # If processing failed, show error
-            messages.error(request, "Failed to process the student card. Please try again with a clearer image.")
-            student_card.delete()  # Delete the failed record
+            return await sync_to_async(render)(request, 'students/result.html', context)
             
-    return render(request, 'students/upload.html')
+    return await sync_to_async(render)(request, 'students/upload.html')
+
+def bulk_upload(request):
+    """View for uploading many card images (or ZIP archives of them) at once
+    
+    The images are only stored and queued here, the background workers
+    process them and the user follows the batch on its status page.
+    """
+    if request.method == 'POST' and request.FILES.getlist('card_images'):
+        batch_id, queued, skipped, failed = queue_sources(iter_upload_sources(request.FILES.getlist('card_images')))
+        if queued:
+            enqueue_card()
+        if request.GET.get('format') == 'json':
+            return JsonResponse({
+                'batch_id': str(batch_id),
+                'queued': queued,
+                'skipped': skipped,
+                'failed': failed,
+                'status_url': reverse('bulk_status_json', kwargs={'batch_id': batch_id}),
+            }, status=202)
+        if not queued and not failed:
+            if skipped:
+                messages.info(request, f"All {skipped} images were already ingested.")
+            else:
+                messages.error(request, "No card images were found in the uploaded files.")
+            return redirect('bulk_upload')
+        if skipped:
+            messages.info(request, f"{skipped} images were already ingested and skipped.")
+        if failed:
+            messages.error(
+                request, f"{failed} files could not be read, e.g. damaged or oversized archives, and were not queued."
+            )
+        return redirect('bulk_status', batch_id=batch_id)
+    
+    return render(request, 'students/bulk_upload.html')
+
+def batch_progress(batch_id):
+    """Number of cards of a bulk upload in each status and its throughput, None for an unknown batch
+    
+    Throughput is the cards finished per second since the first card was
+    started, until the last one finished or until now while it is running.
+    """
+    cards = StudentCard.objects.filter(batch_id=batch_id).order_by()
+    counts = dict(cards.values_list('status').annotate(count=Count('id')))
+    if not counts:
+        return None
+    progress = {status: counts.get(status, 0) for status, _ in StudentCard.STATUS_CHOICES}
+    progress['total'] = sum(counts.values())
+    progress['finished'] = progress[StudentCard.STATUS_PENDING] + progress[StudentCard.STATUS_PROCESSING] == 0
+    
+    times = cards.aggregate(started=Min('started_at'), finished=Max('finished_at'))
+    end = times['finished'] if progress['finished'] else timezone.now()
+    seconds = (end - times['started']).total_seconds() if times['started'] and end else 0
+    progress['seconds'] = round(seconds, 2)
+    progress['cards_per_second'] = (
+        round((progress[StudentCard.STATUS_DONE] + progress[StudentCard.STATUS_FAILED]) / seconds, 2)
+        if seconds > 0 else None
+    )
+    return progress
+
+def bulk_status(request, batch_id):
+    """View showing the progress of a bulk upload"""
+    progress = batch_progress(batch_id)
+    if progress is None:
+        raise Http404("Unknown bulk upload")
+    context = {
+        'batch_id': batch_id,
+        'progress': progress,
+        'status_url': reverse('bulk_status_json', kwargs={'batch_id': batch_id}),
+        'refresh_seconds': getattr(settings, 'STUDENT_CARD_JOB_POLL_INTERVAL', 2),
+    }
+    return render(request, 'students/bulk_status.html', context)
+
+def bulk_status_json(request, batch_id):
+    """JSON progress of a bulk upload"""
+    progress = batch_progress(batch_id)
+    if progress is None:
+        raise Http404("Unknown bulk upload")
+    progress['batch_id'] = str(batch_id)
+    return JsonResponse(progress)
+
+def job_status(request, job_id):
+    """View showing the progress of a background card job, then its result"""
+    student_card = get_object_or_404(StudentCard, job_id=job_id)
+    
+    if student_card.status == StudentCard.STATUS_DONE:
+        context = {
+            'student_card': student_card,
+            'visualizations': student_card.visualization_urls(),
+            'success': True
+        }
+        return render(request, 'students/result.html', context)
+    
+    context = {
+        'student_card': student_card,
+        'status_url': reverse('job_status_json', kwargs={'job_id': job_id}),
+        'refresh_seconds': getattr(settings, 'STUDENT_CARD_JOB_POLL_INTERVAL', 2),
+    }
+    return render(request, 'students/job_status.html', context)
+
+def job_status_json(request, job_id):
+    """JSON status and result of a background card job"""
+    student_card = get_object_or_404(StudentCard, job_id=job_id)
+    data = card_to_dict(student_card)
+    data['result_url'] = reverse('job_status', kwargs={'job_id': job_id})
+    return JsonResponse(data)
+
+def cache_stats(request):
+    """Hit/miss counters of the OCR result cache in this process"""
+    return JsonResponse(get_result_cache().stats())
+
+def metrics_view(request):
+    """Pipeline metrics of this process in the Prometheus text format"""
+    if not metrics.is_enabled():
+        raise Http404("Metrics are disabled")
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def card_visualization(request, card_id, kind):
+    """Serve a visualization of a card, rendering and caching it on first request"""
+    if kind not in StudentCard.VISUALIZATION_KINDS:
+        raise Http404("Unknown visualization")
+    card = get_object_or_404(StudentCard, id=card_id)
+    if not card.image:
+        raise Http404("Card has no image")
+    
+    # Imported here so processes that never render visualizations don't load it
+    from .visualization import get_visualization_cache
+    try:
+        path = get_visualization_cache().get(card, kind, get_processor())
+    except CapacityExceeded as exc:
+        response = HttpResponse("The server is busy processing other cards, retry later.", status=429)
+        response['Retry-After'] = str(exc.retry_after)
+        return response
+    if path is None:
+        raise Http404("Visualization could not be rendered")
+    try:
+        image_file = open(path, 'rb')
+    except FileNotFoundError:
+        # Evicted since it was rendered
+        raise Http404("Visualization could not be rendered")
+    return FileResponse(image_file, content_type=content_type(path))
+
+def search_cards(cards, query):
+    """Cards whose student ID starts with the query, or whose name does ignoring case
+
+    Prefixes are matched as ranges (prefix <= value < prefix + U+FFFF) on
+    student_id and on UPPER(name), which the card_student_id_idx and
+    card_name_upper_idx indexes can answer. LIKE, which startswith and
+    istartswith compile to, can't use them. The database uppercases the
+    query too, so it folds case exactly as it did for the index.
+    """
+    upper_query = Upper(Value(query))
+    return cards.annotate(name_upper=Upper('name')).filter(
+        Q(student_id__gte=query, student_id__lt=query + '\uffff')
+        | Q(name_upper__gte=upper_query, name_upper__lt=Concat(upper_query, Value('\uffff')))
+    )
 
 def card_list(request):
-    """View for displaying all processed cards"""
-    cards = StudentCard.objects.all().order_by('-uploaded_at')
-    return render(request, 'students/card_list.html', {'cards': cards})
+    """View for displaying processed cards, newest first, one page at a time
+    
+    Pages are selected with a cursor on (uploaded_at, id) instead of an offset,
+    so every page is an index range scan however deep the user goes.
+    """
+    page_size = getattr(settings, 'STUDENT_CARD_LIST_PAGE_SIZE', 50)
+    cards = StudentCard.objects.only(
+        'id', 'image', 'thumbnail', 'name', 'student_id', 'university', 'status', 'uploaded_at'
+    ).order_by('-uploaded_at', '-id')
+    
+    query = request.GET.get('q', '').strip()
+    if query:
+        cards = search_cards(cards, query)
+    
+    cursor = parse_card_cursor(request.GET.get('after'))
+    if cursor:
+        uploaded_at, card_id = cursor
+        cards = cards.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=card_id))
+    
+    page = list(cards[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = f"{page[-1].uploaded_at.isoformat()}_{page[-1].id}"
+    
+    return render(request, 'students/card_list.html', {
+        'cards': page,
+        'query': query,
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None,
+    })
+
+def parse_card_cursor(value):
+    """Parse a card list cursor of the form '<uploaded_at ISO>_<id>'"""
+    if not value:
+        return None
+    timestamp, _, card_id = value.rpartition('_')
+    try:
+        uploaded_at = parse_datetime(timestamp)
+    except ValueError:
+        # Well formed but not a valid date, e.g. month 13
+        return None
+    if uploaded_at is None or not card_id.isdigit():
+        return None
+    return uploaded_at, int(card_id)
 
 def card_detail(request, card_id):
     """View for displaying details of a specific card"""
     try:
         card = StudentCard.objects.get(id=card_id)
-        return render(request, 'students/card_detail.html', {'card': card})
+        return render(request, 'students/card_detail.html', {
+            'card': card,
+            'visualizations': card.visualization_urls(),
+        })
     except StudentCard.DoesNotExist:
         messages.error(request, "Student card not found.")
         return redirect('card_list')
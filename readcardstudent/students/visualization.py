@@ -0,0 +1,218 @@
+import os
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .limits import card_budget, get_limiter
+from .models import StudentCard
+from .services import decode_image
+from .storage import FORMATS, derivative_format, encode_image
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Prefix of files being written, renamed to their final name once complete
+TEMP_PREFIX = '.tmp_'
+
+TITLES = {
+    'original': "Original Image",
+    'processed': "Processed Image",
+    'regions': "Detected Text Regions",
+}
+
+
+def to_bgr(image):
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image
+
+
+def compose_side_by_side(images, titles, height=400, title_height=36, gap=10):
+    """Place images next to each other at the same height with a title above each"""
+    panels = []
+    for image, title in zip(images, titles):
+        image = to_bgr(image)
+        scale = height / float(image.shape[0])
+        resized = cv2.resize(image, (max(int(image.shape[1] * scale), 1), height), interpolation=cv2.INTER_AREA)
+
+        panel = np.full((height + title_height, resized.shape[1]), 255, dtype=np.uint8)
+        panel = to_bgr(panel)
+        panel[title_height:] = resized
+        cv2.putText(panel, title, (5, title_height - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
+        panels.append(panel)
+
+    spacer = np.full((height + title_height, gap, 3), 255, dtype=np.uint8)
+    row = []
+    for panel in panels:
+        if row:
+            row.append(spacer)
+        row.append(panel)
+    return np.hstack(row)
+
+
+def render_visualizations(original, processed, regions):
+    """Build all visualization images from the pipeline's intermediate images"""
+    return {
+        'original': original,
+        'processed': processed,
+        'regions': regions,
+        'combined': compose_side_by_side(
+            [original, processed, regions],
+            [TITLES['original'], TITLES['processed'], TITLES['regions']],
+        ),
+    }
+
+
+def render_card_visualizations(student_card, processor):
+    """Re-run the cheap, OCR free stages of the pipeline for a stored card
+
+    The original is decoded within the pixel budget like an upload, see
+    services.decode_image. Returns None when the image can't be read,
+    including while an upload's original is still being written in the background.
+    """
+    try:
+        with student_card.image.open('rb') as image_file:
+            data = image_file.read()
+    except FileNotFoundError:
+        return None
+    image = decode_image(data)
+    if image is None:
+        return None
+
+    image = processor.prepare_image(image)
+    graph = processor.preprocess(image)
+    processed = graph[processor.PREPROCESSING_METHODS[0]]
+    regions = processor.visualize_text_regions(image, processor.detect_text_regions(image, graph))
+    return render_visualizations(image, processed, regions)
+
+
+class VisualizationCache:
+    """Visualizations rendered on first request and kept on disk
+
+    Files are evicted least recently used first once the cache grows over
+    max_bytes, and after max_age seconds without being requested.
+    """
+
+    def __init__(self, directory=None, max_bytes=None, max_age=None, evict_every=50):
+        self.directory = directory or os.path.join(settings.MEDIA_ROOT, 'visualizations')
+        self.max_bytes = max_bytes or getattr(settings, 'STUDENT_CARD_VISUALIZATION_CACHE_MAX_BYTES', 500 * 1024 * 1024)
+        self.max_age = max_age or getattr(settings, 'STUDENT_CARD_VISUALIZATION_CACHE_MAX_AGE', 30 * 24 * 3600)
+        self.evict_every = evict_every
+        # JPEG or WebP, see settings.STUDENT_CARD_DERIVATIVE_FORMAT
+        self.format = derivative_format()
+        self.quality = getattr(settings, 'STUDENT_CARD_VISUALIZATION_QUALITY', 80)
+        self._renders = 0
+        self._lock = threading.Lock()
+
+    def path(self, card_id, kind):
+        return os.path.join(self.directory, f"card_{card_id}_{kind}{FORMATS[self.format][0]}")
+
+    def _write(self, path, data):
+        """Write a file so concurrent readers see either no file or all of it"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def get(self, student_card, kind, processor):
+        """Absolute path of a visualization, rendering the card's visualizations if needed
+
+        Rendering takes a processing slot and runs under a CardBudget like
+        reading a card does.
+
+        Returns:
+            The file path, or None if the card image can't be read or the
+            visualization can't be encoded
+
+        Raises:
+            CapacityExceeded: When the visualization must be rendered but
+                every processing slot and queue place is taken
+        """
+        path = self.path(student_card.id, kind)
+        try:
+            # Mark as recently used for eviction
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        rendered = False
+        with get_limiter().admitted(), card_budget(), metrics.stage('visualization'):
+            images = render_card_visualizations(student_card, processor)
+            if images is None:
+                return None
+
+            os.makedirs(self.directory, exist_ok=True)
+            for image_kind, image in images.items():
+                encoded = encode_image(image, self.format, self.quality)
+                if encoded is None:
+                    continue
+                self._write(self.path(student_card.id, image_kind), encoded[0])
+                rendered = rendered or image_kind == kind
+
+        with self._lock:
+            self._renders += 1
+            evict = self._renders % self.evict_every == 0
+        if evict:
+            self.evict()
+        return path if rendered else None
+
+    def remove(self, card_id):
+        """Delete the cached visualizations of one card, in every format"""
+        for kind in StudentCard.VISUALIZATION_KINDS:
+            for extension, _ in FORMATS.values():
+                try:
+                    os.remove(os.path.join(self.directory, f"card_{card_id}_{kind}{extension}"))
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        """Delete expired files, then the least recently used ones until under max_bytes
+
+        Returns:
+            Tuple of (files deleted, bytes freed)
+        """
+        try:
+            # Files still being written are left alone
+            entries = [
+                entry for entry in os.scandir(self.directory)
+                if entry.is_file() and not entry.name.startswith(TEMP_PREFIX)
+            ]
+        except FileNotFoundError:
+            return 0, 0
+
+        files = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries),
+        )
+        total = sum(size for _, size, _ in files)
+        cutoff = time.time() - self.max_age
+
+        deleted = freed = 0
+        for mtime, size, path in files:
+            if mtime >= cutoff and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            deleted += 1
+            freed += size
+        return deleted, freed
+
+
+def get_visualization_cache():
+    """Return the visualization cache of this process"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = VisualizationCache()
+    return _cache